@@ -0,0 +1,93 @@
+# coding=utf-8
+# Copyright 2023, Shumin Deng
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Measures the docs/sec of convert_examples_to_features for a growing number of preprocessing workers."""
+
+import argparse
+import logging
+import time
+
+import numpy as np
+from transformers import DistilBertTokenizer
+
+from data_utils import convert_examples_to_features, processors
+
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", default="./Datasets/MAVEN_ERE", type=str, help="The input data directory.")
+    parser.add_argument("--task_name", default="maven-ere", type=str, help="One of: " + ", ".join(processors.keys()))
+    parser.add_argument("--split", default="train", type=str, help="train, valid or test")
+    parser.add_argument("--model_name_or_path", default="distilbert-base-uncased", type=str)
+    parser.add_argument("--do_lower_case", action="store_true")
+    parser.add_argument("--max_seq_length", default=128, type=int)
+    parser.add_argument("--max_mention_size", default=40, type=int)
+    parser.add_argument("--workers", default="1,2,4,8,16,32", type=str, help="Comma separated worker counts to time.")
+    parser.add_argument("--docs_per_shard", default=32, type=int)
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.WARN,
+    )
+
+    processor = processors[args.task_name]()
+    tokenizer = DistilBertTokenizer.from_pretrained(args.model_name_or_path, do_lower_case=args.do_lower_case)
+    # read the split once, so that only the conversion is timed
+    examples = list(getattr(processor, "get_{}_examples".format(args.split))(args.data_dir))
+    label4token_list = processor.get_labels4tokens()
+    label4sent_list = processor.get_labels4sent()
+    label4rel_list = processor.get_labels4doc()
+
+    reference = None
+    base_docs_per_sec = None
+    print("%8s %10s %12s %8s" % ("workers", "seconds", "docs/sec", "speedup"))
+    for num_workers in [int(w) for w in args.workers.split(",")]:
+        start = time.perf_counter()
+        features = convert_examples_to_features(
+            examples,
+            label4token_list,
+            label4sent_list,
+            label4rel_list,
+            args.max_seq_length,
+            args.max_mention_size,
+            tokenizer,
+            cls_token=tokenizer.cls_token,
+            cls_token_segment_id=0,
+            sep_token=tokenizer.sep_token,
+            pad_token=tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0],
+            task_name=args.task_name,
+            num_workers=num_workers,
+            docs_per_shard=args.docs_per_shard,
+        )
+        seconds = time.perf_counter() - start
+        docs_per_sec = len(features) / seconds
+        if base_docs_per_sec is None:
+            base_docs_per_sec = docs_per_sec
+        print("%8d %10.2f %12.1f %7.2fx" % (num_workers, seconds, docs_per_sec, docs_per_sec / base_docs_per_sec))
+
+        # the parallel conversion must not change the features, nor their order
+        features = [{name: np.asarray(value).tolist() for name, value in vars(f).items()} for f in features]
+        if reference is None:
+            reference = features
+        elif features != reference:
+            raise ValueError("Features converted with %d workers differ from the first run" % num_workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -18,12 +18,24 @@
 
 import json
 import codecs
+import collections
+import contextlib
+import hashlib
+import itertools
 import logging
+import multiprocessing
 import os
+import pickle
 import csv
-from typing import List
+import queue
+import shutil
+import threading
+from typing import Dict, Iterable, Iterator, List
 
+import numpy as np
+import torch
 import tqdm
+from torch.utils.data import ConcatDataset, Dataset, IterableDataset, Sampler, get_worker_info
 
 from transformers import PreTrainedTokenizer, BertTokenizer, XLNetTokenizer, RobertaTokenizer, DistilBertTokenizer, CamembertTokenizer, XLMRobertaTokenizer
 
@@ -32,32 +44,37 @@ logger = logging.getLogger(__name__)
 
 class InputExample(object):
     """A single training/test example for multiple choice"""
+    __slots__ = ("example_id", "mention_size", "list_tokens", "list_triggerL", "list_triggerR", "token_label_ids", "sent_label_ids", "rel_triples", "list_tokens_dependent", "window_start", "list_mention_id")
 
-    def __init__(self, example_id, mention_size, list_tokens, list_tokens_dependent, list_triggerL, list_triggerR, list_token_labels=None, list_sent_label=None, mat_rel_label=None):
-        """Constructs a InputExample.
+    def __init__(self, example_id, mention_size, list_tokens, list_tokens_dependent, list_triggerL, list_triggerR, token_label_ids=None, sent_label_ids=None, rel_triples=None, window_start=0, list_mention_id=None):
+        """Constructs a InputExample. The labels are ids in the label lists of the processor, see `DataProcessor.get_label_maps`.
         Args:
             example_id: str. unique id for the example.
             mention_size: int. the quantity of event mentions in one doc 
             tokens: list of [list of tokens]. 
             triggerL: list of int. beginning position of the trigger
             triggerR: list of int. endding position of the trigger
-            token_label: (Optional) string. list of (the label of the token list). This should be specified for train and valid examples, but not for test examples.
-            sent_label: (Optional) string. list of (the label of the sentence). This should be specified for train and valid examples, but not for test examples.
-            rel_label: (Optional) string. list of (the label of the relation between sentence pairs). This should be specified for train and valid examples, but not for test examples.
+            token_label_ids: (Optional) int16 array. the label ids of the tokens of all the sentences, concatenated. This should be specified for train and valid examples, but not for test examples.
+            sent_label_ids: (Optional) int16 array. the label id of each sentence. This should be specified for train and valid examples, but not for test examples.
+            rel_triples: (Optional) [num_rel, 3] int32 array of (head, tail, relation id). the labelled relations between sentence pairs, all other pairs are NA. This should be specified for train and valid examples, but not for test examples.
+            window_start: int. for a window of a longer document (see `split_example_windows`), the index of its first sentence in the document.
+            list_mention_id: (Optional) list of str. the MAVEN-ERE mention id of each sentence, written to MAVENERE_MENTION_ID_PATH by `iter_examples_to_features`.
         """
         self.example_id = example_id
         self.mention_size = mention_size
         self.list_tokens = list_tokens
         self.list_triggerL = list_triggerL
         self.list_triggerR = list_triggerR
-        self.list_token_labels = list_token_labels
-        self.list_sent_label = list_sent_label
-        self.mat_rel_label = mat_rel_label
+        self.token_label_ids = token_label_ids
+        self.sent_label_ids = sent_label_ids
+        self.rel_triples = rel_triples
         self.list_tokens_dependent = list_tokens_dependent
+        self.window_start = window_start
+        self.list_mention_id = list_mention_id
 
 
 class InputFeatures(object):
-    def __init__(self, example_id, mention_size, pad_token_label_id, list_input_ids, list_input_dependent, list_input_mask, list_segment_ids, list_token_labels, list_sent_label, mat_rel_label):
+    def __init__(self, example_id, mention_size, pad_token_label_id, list_input_ids, list_input_dependent, list_input_mask, list_segment_ids, list_token_labels, list_sent_label, rel_triples, window_start=0):
         self.example_id = example_id
         self.mention_size = mention_size
         self.pad_token_label_id = pad_token_label_id
@@ -66,14 +83,19 @@ class InputFeatures(object):
         self.list_segment_ids = list_segment_ids
         self.list_token_labels = list_token_labels
         self.list_sent_label = list_sent_label
-        self.mat_rel_label = mat_rel_label
+        self.rel_triples = rel_triples # [num_rel, 3] array of (head, tail, relation id), without the NA pairs
         self.list_input_dependent = list_input_dependent
+        self.window_start = window_start
 
 
 
 class DataProcessor(object):
     """Base class for data converters for multiple choice data sets."""
 
+    def __init__(self, index_dir=None):
+        """`index_dir` keeps the byte indexes of the json input files, see `load_json_object_index`."""
+        self.index_dir = index_dir
+
     def get_train_examples(self, data_dir):
         """Gets a collection of `InputExample`s for the train set."""
         raise NotImplementedError()
@@ -98,21 +120,76 @@ class DataProcessor(object):
         """Gets the list of sentence pair labels for this data set."""
         raise NotImplementedError()
 
+    def get_input_files(self, data_dir, set_type):
+        """Gets the files the examples of the `set_type` set are read from."""
+        raise NotImplementedError()
+
+    def get_num_examples(self, data_dir, set_type):
+        """Counts the examples of the `set_type` set without converting them."""
+        raise NotImplementedError()
+
+    def read_mention_sizes(self, data_dir, set_type):
+        """Yields the mention size of every document of the `set_type` set, in order, without building the examples."""
+        raise NotImplementedError()
+
+    def get_mention_sizes(self, data_dir, set_type):
+        """The `read_mention_sizes` of the `set_type` set. With an `index_dir` they are kept there as
+        `MentionSizes_<sha1 of the file>.json`, so they are read once per version of the file, as the byte indexes are.
+        """
+        sizes_file = None
+        if self.index_dir is not None:
+            digest = memoized_file_digest(self.get_input_files(data_dir, set_type)[0], os.path.join(self.index_dir, "file_digests.json"))
+            sizes_file = os.path.join(self.index_dir, "MentionSizes_{}.json".format(digest))
+            if os.path.isfile(sizes_file):
+                with open(sizes_file) as f:
+                    return json.load(f)
+        sizes = list(self.read_mention_sizes(data_dir, set_type))
+        if sizes_file is not None:
+            tmp_file = "%s.tmp-%d" % (sizes_file, os.getpid())
+            with open(tmp_file, "w") as f:
+                json.dump(sizes, f)
+            os.replace(tmp_file, sizes_file)
+        return sizes
+
+    def get_label_maps(self):
+        """Gets the label -> id maps of the tokens, the sentences and the sentence pairs, built once per processor."""
+        if getattr(self, "_label_maps", None) is None:
+            self._label_maps = tuple(
+                {label: i for i, label in enumerate(labels)} for labels in (self.get_labels4tokens(), self.get_labels4sent(), self.get_labels4doc())
+            )
+        return self._label_maps
+
 
 class OntoEventProcessor(DataProcessor):
     """Processor for the OntoEvent data set."""
     
     def get_train_examples(self, data_dir):
         logger.info("LOOKING AT {} train".format(data_dir))
-        return self.create_examples(os.path.join(data_dir,'OntoEvent-Doc/event_dict_on_doc_train.json'), "train", os.path.join(data_dir,'OutoEvent_dependent/train_tokens_dependent.json'))   # 修改增加依存句法的数据集
+        file_path, file_dependent = self.get_input_files(data_dir, "train")
+        return self.create_examples(file_path, "train", file_dependent)
 
     def get_valid_examples(self, data_dir):
         logger.info("LOOKING AT {} valid".format(data_dir))
-        return self.create_examples(os.path.join(data_dir,'OntoEvent-Doc/event_dict_on_doc_valid.json'), "valid", os.path.join(data_dir,'OutoEvent_dependent/valid_tokens_dependent.json'))   # 修改增加依存句法的特征的数据集
+        file_path, file_dependent = self.get_input_files(data_dir, "valid")
+        return self.create_examples(file_path, "valid", file_dependent)
 
     def get_test_examples(self, data_dir):
         logger.info("LOOKING AT {} test".format(data_dir))
-        return self.create_examples(os.path.join(data_dir,'OntoEvent-Doc/event_dict_on_doc_test.json'), "test", os.path.join(data_dir,'OutoEvent_dependent/test_tokens_dependent.json'))   # 修改增加依存句法的特征的数据集
+        file_path, file_dependent = self.get_input_files(data_dir, "test")
+        return self.create_examples(file_path, "test", file_dependent)
+
+    def get_input_files(self, data_dir, set_type):
+        return [
+            os.path.join(data_dir, 'OntoEvent-Doc/event_dict_on_doc_{}.json'.format(set_type)),
+            os.path.join(data_dir, 'OutoEvent_dependent/{}_tokens_dependent.json'.format(set_type)), # 依存句法的数据集
+        ]
+
+    def get_num_examples(self, data_dir, set_type):
+        return len(load_json_object_index(self.get_input_files(data_dir, set_type)[0], self.index_dir))
+
+    def read_mention_sizes(self, data_dir, set_type):
+        for _, dict_doc in iter_json_object_items(self.get_input_files(data_dir, set_type)[0]):
+            yield len(dict_doc["events"])
 
     def get_labels4sent(self): # 句子的事件类型获取(从数据集中)
         file_path = ONTOEVENT_LABEL_PATH 
@@ -134,89 +211,96 @@ class OntoEventProcessor(DataProcessor):
         return list_label4doc
     
     def create_examples(self, file_path, set_type, file_dependent_file):
-        """Creates examples for the training and valid sets."""
-        examples = []
-        data = json2dicts(file_path)[0]
-        data_01 = json2dicts(file_dependent_file)[0]
-
-        for doc_id in data.keys(): # 修改  把依存句法的特征加入进来
-            dict_doc = data[doc_id]
-            dict_doc_dependent = data_01[doc_id]
-            mention_size = len(dict_doc["events"])
-            list_mention_id = []
-            list_tokens = []
-            list_triggerL = []
-            list_triggerR = []
-            list_token_labels = []
-            list_sent_label = []
-            mat_rel_label = [] # 计算文档中的每个句子的关系
-            list_tokens_dependent = []
-             
-            for i in range(mention_size):
-                mat_rel_label.append([NAME_NO_RELATION]*mention_size)
-            dict_rel_pairs = dict_doc['relations']
-            for rel in dict_rel_pairs: # 每个文档中句子的关系
-                for event_index_pair in dict_rel_pairs[rel]:
-                    head_index = event_index_pair[0]
-                    tail_index = event_index_pair[1]
-                    mat_rel_label[head_index][tail_index] = rel 
-        
-            for event_instance in dict_doc["events"]:
-                list_token_label = [NAME_NON_TRIGGER] * len(event_instance['event_mention_tokens']) 
-                sid = event_instance['sent_id']
-                if type(event_instance['sent_id'] != str):
-                    sid = str(sid)    
-                # e_id = "%s-+-%s-+-%s" % (set_type, event_instance['doc_id'], sid)
-                e_id = "%s-+-%s-+-%s" % (event_instance['event_type'], event_instance['doc_id'], sid)
-                list_mention_id.append(e_id)
-                if (type(event_instance['trigger_pos']) == int):
-                    triL = event_instance['trigger_pos']
-                    triR = triL
-                else:
-                    triL = event_instance['trigger_pos'][0]
-                    triR = event_instance['trigger_pos'][1]
-                for i in range(triL, triR): 
-                    list_token_label[i] = event_instance['event_type']
-                
-                list_tokens.append(event_instance['event_mention_tokens'])
-                list_triggerL.append(triL) 
-                list_triggerR.append(triR)
-                list_token_labels.append(list_token_label)
-                list_sent_label.append(event_instance['event_type']) 
-
-            for event_instance_dependent in dict_doc_dependent['event'] :
-                list_tokens_dependent.append(event_instance_dependent['event_mention_dependent'])
-
-            examples.append(
-                InputExample(
-                    example_id=doc_id,
-                    mention_size=mention_size,
-                    list_tokens=list_tokens,
-                    list_triggerL=list_triggerL, # 触发词左边的位置
-                    list_triggerR=list_triggerR, # 触发词右边的位置
-                    list_token_labels=list_token_labels,
-                    list_sent_label=list_sent_label,
-                    mat_rel_label=mat_rel_label,
-                    list_tokens_dependent = list_tokens_dependent,
-                )
-            )
-        return examples
+        """Lazily yields examples for the training and valid sets, one document at a time.
+        The dependency entry of each document is read at its offset in the byte index of the dependency file, so both files
+        are streamed and only one document and its dependency entry are held in memory, whatever the order of the files.
+        """
+        dependent_index = load_json_object_index(file_dependent_file, self.index_dir)
+        with open(file_dependent_file, "rb") as f_dependent:
+            for doc_id, dict_doc in iter_json_object_items(file_path): # 修改  把依存句法的特征加入进来
+                dict_doc_dependent = read_json_object_value(f_dependent, dependent_index[doc_id])
+                yield self.create_example(doc_id, dict_doc, dict_doc_dependent)
+
+    def get_example(self, data_dir, set_type, doc_id):
+        """Reads the single document `doc_id` of the `set_type` set through the byte indexes of its files, e.g. for debugging."""
+        file_path, file_dependent = self.get_input_files(data_dir, set_type)
+        with open(file_path, "rb") as f, open(file_dependent, "rb") as f_dependent:
+            dict_doc = read_json_object_value(f, load_json_object_index(file_path, self.index_dir)[doc_id])
+            dict_doc_dependent = read_json_object_value(f_dependent, load_json_object_index(file_dependent, self.index_dir)[doc_id])
+        return self.create_example(doc_id, dict_doc, dict_doc_dependent)
+
+    def create_example(self, doc_id, dict_doc, dict_doc_dependent):
+        """Builds the example of one document from its entries in the document file and in the dependency file."""
+        label4token_map, label4sent_map, label4rel_map = self.get_label_maps()
+        mention_size = len(dict_doc["events"])
+        list_mention_id = []
+        list_tokens = []
+        list_triggerL = []
+        list_triggerR = []
+        list_token_labels = []
+        list_sent_label = []
+        dict_pair2rel = {} # 计算文档中的每个句子的关系, (head, tail) -> relation, pairs left out are NA
+        list_tokens_dependent = []
+         
+        dict_rel_pairs = dict_doc['relations']
+        for rel in dict_rel_pairs: # 每个文档中句子的关系
+            for event_index_pair in dict_rel_pairs[rel]:
+                head_index = event_index_pair[0]
+                tail_index = event_index_pair[1]
+                dict_pair2rel[(head_index, tail_index)] = rel 
     
+        for event_instance in dict_doc["events"]:
+            list_token_label = np.full([len(event_instance['event_mention_tokens'])], label4token_map[NAME_NON_TRIGGER], dtype=np.int16)
+            sid = event_instance['sent_id']
+            if type(event_instance['sent_id'] != str):
+                sid = str(sid)    
+            # e_id = "%s-+-%s-+-%s" % (set_type, event_instance['doc_id'], sid)
+            e_id = "%s-+-%s-+-%s" % (event_instance['event_type'], event_instance['doc_id'], sid)
+            list_mention_id.append(e_id)
+            if (type(event_instance['trigger_pos']) == int):
+                triL = event_instance['trigger_pos']
+                triR = triL
+            else:
+                triL = event_instance['trigger_pos'][0]
+                triR = event_instance['trigger_pos'][1]
+            list_token_label[triL:triR] = label4token_map[event_instance['event_type']]
+            
+            list_tokens.append(event_instance['event_mention_tokens'])
+            list_triggerL.append(triL) 
+            list_triggerR.append(triR)
+            list_token_labels.append(list_token_label)
+            list_sent_label.append(label4sent_map[event_instance['event_type']])
+
+        for event_instance_dependent in dict_doc_dependent['event'] :
+            list_tokens_dependent.append(event_instance_dependent['event_mention_dependent'])
+
+        return InputExample(
+            example_id=doc_id,
+            mention_size=mention_size,
+            list_tokens=list_tokens,
+            list_triggerL=list_triggerL, # 触发词左边的位置
+            list_triggerR=list_triggerR, # 触发词右边的位置
+            token_label_ids=concat_label_ids(list_token_labels),
+            sent_label_ids=np.array(list_sent_label, dtype=np.int16),
+            rel_triples=pair2rel_to_triples(dict_pair2rel, label4rel_map),
+            list_tokens_dependent = list_tokens_dependent,
+        )
+
 
 class MAVENEREProcessor(DataProcessor):
     """Processor for the MAVENERE data set."""
     
     def get_train_examples(self, data_dir):
         logger.info("LOOKING AT {} train".format(data_dir))
-        return self.create_examples(os.path.join(data_dir,'mav_train.jsonl'), "train")
+        return self.create_examples(self.get_input_files(data_dir, "train")[0], "train")
 
     def get_valid_examples(self, data_dir):
         logger.info("LOOKING AT {} valid".format(data_dir))
-        return self.create_examples(os.path.join(data_dir,'mav_valid.jsonl'), "valid")
+        return self.create_examples(self.get_input_files(data_dir, "valid")[0], "valid")
 
     def get_test_examples(self, data_dir):
         logger.info("LOOKING AT {} test".format(data_dir))
-        return self.create_examples(os.path.join(data_dir,'mav_test.jsonl'), "test")
+        return self.create_examples(self.get_input_files(data_dir, "test")[0], "test")
 
     def get_labels4sent(self):
         list_label4sent = ["None", "Know", "Warning", "Catastrophe", "Placing", "Causation", "Arriving", "Sending", "Protest", "Preventing_or_letting", "Motion", "Damaging", "Destroying", "Death", "Perception_active", "Presence", "Influence", "Receiving", "Check", "Hostile_encounter", "Killing", "Conquering", "Releasing", "Attack", "Earnings_and_losses", "Choosing", "Traveling", "Recovering", "Using", "Coming_to_be", "Cause_to_be_included", "Process_start", "Change_event_time", "Reporting", "Bodily_harm", "Suspicion", "Statement", "Cause_change_of_position_on_a_scale", "Coming_to_believe", "Expressing_publicly", "Request", "Control", "Supporting", "Defending", "Building", "Military_operation", "Self_motion", "GetReady", "Forming_relationships", "Becoming_a_member", "Action", "Removing", "Surrendering", "Agree_or_refuse_to_act", "Participation", "Deciding", "Education_teaching", "Emptying", "Getting", "Besieging", "Creating", "Process_end", "Body_movement", "Expansion", "Telling", "Change", "Legal_rulings", "Bearing_arms", "Giving", "Name_conferral", "Arranging", "Use_firearm", "Committing_crime", "Assistance", "Surrounding", "Quarreling", "Expend_resource", "Motion_directional", "Bringing", "Communication", "Containing", "Manufacturing", "Social_event", "Robbery", "Competition", "Writing", "Rescuing", "Judgment_communication", "Change_tool", "Hold", "Being_in_operation", "Recording", "Carry_goods", "Cost", "Departing", "GiveUp", "Change_of_leadership", "Escaping", "Aiming", "Hindering", "Preserving", "Create_artwork", "Openness", "Connect", "Reveal_secret", "Response", "Scrutiny", "Lighting", "Criminal_investigation", "Hiding_objects", "Confronting_problem", "Renting", "Breathing", "Patrolling", "Arrest", "Convincing", "Commerce_sell", "Cure", "Temporary_stay", "Dispersal", "Collaboration", "Extradition", "Change_sentiment", "Commitment", "Commerce_pay", "Filling", "Becoming", "Achieve", "Practice", "Cause_change_of_strength", "Supply", "Cause_to_amalgamate", "Scouring", "Violence", "Reforming_a_system", "Come_together", "Wearing", "Cause_to_make_progress", "Legality", "Employment", "Rite", "Publishing", "Adducing", "Exchange", "Ratification", "Sign_agreement", "Commerce_buy", "Imposing_obligation", "Rewards_and_punishments", "Institutionalization", "Testing", "Ingestion", "Labeling", "Kidnapping", "Submitting_documents", "Prison", "Justifying", "Emergency", "Terrorism", "Vocalizations", "Risk", "Resolve_problem", "Revenge", "Limiting", "Research", "Having_or_lacking_access", "Theft", "Incident", "Award"]
@@ -232,15 +316,23 @@ class MAVENEREProcessor(DataProcessor):
         list_label4doc = [key for key in relation_map_mavenere.keys()]
         list_label4doc.insert(0, NAME_NO_RELATION) 
         return list_label4doc
+
+    def get_input_files(self, data_dir, set_type):
+        return [os.path.join(data_dir, 'mav_{}.jsonl'.format(set_type))]
+
+    def get_num_examples(self, data_dir, set_type):
+        with open(self.get_input_files(data_dir, set_type)[0], "rb") as f:
+            return sum(1 for line in f if line.strip())
+
+    def read_mention_sizes(self, data_dir, set_type):
+        for dict_doc in iter_json_lines(self.get_input_files(data_dir, set_type)[0]):
+            yield len(dict_doc['tokens'])
     
     def create_examples(self, file_path, set_type):
-        """Creates examples for the training and valid sets."""
-        examples = []
-        data = json2dicts(file_path)
+        """Lazily yields examples for the training and valid sets, one jsonl line at a time."""
+        label4token_map, label4sent_map, label4rel_map = self.get_label_maps()
 
-        dict_docid2mentionids = {} 
-
-        for dict_doc in data:
+        for dict_doc in iter_json_lines(file_path):
             doc_id = dict_doc["id"] 
             mention_size = len(dict_doc['tokens'])
             list_tokens = dict_doc['tokens']
@@ -249,13 +341,10 @@ class MAVENEREProcessor(DataProcessor):
             list_triggerR = []
             list_token_labels = []
             list_sent_label = []
-            mat_rel_label = []
+            dict_pair2rel = {} # (head, tail) -> relation, pairs left out are NA
 
-            # initiate the mat_rel_label
             # Note that there are no labels between event instance pairs in the test set, thus the preformance calculated on the test set is actually meaningless 
             # We need to dump prediction results and submit them to MAVEN-ERE CodaLab competition or evaluate on the valid set instead 
-            for i in range(mention_size):
-                mat_rel_label.append([NAME_NO_RELATION]*mention_size)
 
             list_coref_sentid = [] 
             dict_eid2event = {}
@@ -283,10 +372,10 @@ class MAVENEREProcessor(DataProcessor):
                         if dict_eid2event.get(event_id_pair[0]) and dict_eid2event.get(event_id_pair[1]): 
                             head_index = dict_eid2event[event_id_pair[0]]['sent_id']
                             tail_index = dict_eid2event[event_id_pair[1]]['sent_id']
-                            mat_rel_label[head_index][tail_index] = rel
+                            dict_pair2rel[(head_index, tail_index)] = rel
             
                 for event_id_pair in list_coref_sentid:
-                    mat_rel_label[event_id_pair[0]][event_id_pair[1]] = NAME_COREF_RELATION
+                    dict_pair2rel[(event_id_pair[0], event_id_pair[1])] = NAME_COREF_RELATION
             else:
                 for event_instance in dict_doc['event_mentions']:
                     dict_sid2event[event_instance['sent_id']] = {'id': event_instance['id'], 'type': event_instance['type'], 'sent_id': event_instance['sent_id'], 'offset': event_instance['offset'], 'mention_id': event_instance['id']}   
@@ -300,7 +389,7 @@ class MAVENEREProcessor(DataProcessor):
                     event_instance = {'id': '', 'type': "None", 'sent_id': pos, 'offset': [0, 0]}
                     list_mention_id.append(doc_id + "-+-" + str(pos))
  
-                list_token_label = [NAME_NON_TRIGGER] * len(list_tokens[pos])
+                list_token_label = np.full([len(list_tokens[pos])], label4token_map[NAME_NON_TRIGGER], dtype=np.int16)
                 
                 if (type(event_instance['offset']) == int):
                     triL = event_instance['offset']
@@ -312,31 +401,25 @@ class MAVENEREProcessor(DataProcessor):
                     else: 
                         triL = event_instance['offset'][0]
                         triR = event_instance['offset'][1]
-                for i in range(triL, triR): 
-                    list_token_label[i] = event_instance['type']
+                list_token_label[triL:triR] = label4token_map[event_instance['type']]
                 
                 list_triggerL.append(triL) 
                 list_triggerR.append(triR)
                 list_token_labels.append(list_token_label) 
-                list_sent_label.append(event_instance['type'])
-
-            dict_docid2mentionids[doc_id] = list_mention_id
-
-            examples.append(
-                InputExample(
-                    example_id=doc_id,
-                    mention_size=mention_size,
-                    list_tokens=list_tokens,
-                    list_tokens_dependent=list_tokens_dependent,
-                    list_triggerL=list_triggerL,
-                    list_triggerR=list_triggerR,
-                    list_token_labels=list_token_labels,
-                    list_sent_label=list_sent_label,
-                    mat_rel_label=mat_rel_label,
-                )
+                list_sent_label.append(label4sent_map[event_instance['type']])
+
+            yield InputExample(
+                example_id=doc_id,
+                mention_size=mention_size,
+                list_tokens=list_tokens,
+                list_tokens_dependent=list_tokens_dependent,
+                list_triggerL=list_triggerL,
+                list_triggerR=list_triggerR,
+                token_label_ids=concat_label_ids(list_token_labels),
+                sent_label_ids=np.array(list_sent_label, dtype=np.int16),
+                rel_triples=pair2rel_to_triples(dict_pair2rel, label4rel_map),
+                list_mention_id=list_mention_id,
             )
-        dict2json(dict_docid2mentionids, MAVENERE_MENTION_ID_PATH)
-        return examples
 
 
 
@@ -377,18 +460,168 @@ def _read_roles(self, role_path):
 
     return template_dict, role_dict
 
+def pair2rel_to_triples(dict_pair2rel, label4rel_map):
+    """(head, tail) -> relation name dict to a [num_rel, 3] array of (head, tail, relation id), sorted by pair."""
+    triples = [(head, tail, label4rel_map[rel]) for (head, tail), rel in sorted(dict_pair2rel.items())]
+    return np.array(triples, dtype=np.int32).reshape(-1, 3)
+
+
+def window_starts(mention_size, window_size, window_stride):
+    """The first sentences of the windows of `window_size` sentences, every `window_stride` sentences, covering a document
+    (the last one ending with the document). A document that fits in one window, or a stride of 0, gives the single window [0]."""
+    if window_stride <= 0 or mention_size <= window_size:
+        return [0]
+    return list(range(0, mention_size - window_size, window_stride)) + [mention_size - window_size]
+
+
+def split_example_windows(example: InputExample, window_size, window_stride):
+    """Splits an example longer than `window_size` sentences into overlapping windows, see `window_starts`.
+    Each window is an example of its own, with the example_id of the document, the relations of the pairs inside the window
+    (renumbered from its first sentence) and that first sentence as `window_start`.
+    """
+    starts = window_starts(example.mention_size, window_size, window_stride)
+    if len(starts) == 1:
+        return [example]
+    token_offsets = np.cumsum([0] + [len(tokens) for tokens in example.list_tokens])
+    windows = []
+    for start in starts:
+        end = start + window_size
+        token_label_ids = sent_label_ids = rel_triples = None
+        if example.token_label_ids is not None:
+            token_label_ids = example.token_label_ids[token_offsets[start]:token_offsets[end]]
+        if example.sent_label_ids is not None:
+            sent_label_ids = example.sent_label_ids[start:end]
+        if example.rel_triples is not None:
+            head, tail = example.rel_triples[:, 0], example.rel_triples[:, 1]
+            rel_triples = example.rel_triples[(head >= start) & (head < end) & (tail >= start) & (tail < end)]
+            rel_triples = rel_triples - np.array([start, start, 0], dtype=rel_triples.dtype)
+        windows.append(InputExample(
+            example_id=example.example_id,
+            mention_size=window_size,
+            list_tokens=example.list_tokens[start:end],
+            list_tokens_dependent=example.list_tokens_dependent[start:end],
+            list_triggerL=example.list_triggerL[start:end],
+            list_triggerR=example.list_triggerR[start:end],
+            token_label_ids=token_label_ids,
+            sent_label_ids=sent_label_ids,
+            rel_triples=rel_triples,
+            window_start=example.window_start + start,
+        ))
+    return windows
+
+
+def concat_label_ids(list_label_ids):
+    """The label ids of the sentences of a document, concatenated into one array (the sentence offsets are those of the tokens)."""
+    return np.concatenate(list_label_ids) if list_label_ids else np.zeros([0], dtype=np.int16)
+
+
+def iter_json_lines(jsonFile) -> Iterator[dict]:
+    """Yields the json object on each line of `jsonFile`, one line at a time."""
+    with codecs.open(jsonFile, "r", "utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
 def json2dicts(jsonFile):
-        data = []
-        with codecs.open(jsonFile, "r", "utf-8") as f:
-            for line in f:
-                dic = json.loads(line)
-                data.append(dic)
-                lengh = 0
-                for name in dic.keys():
-                    array1 = dic[name]
-                    lengh = lengh + len(array1)
-                print(lengh)
-        return data
+    return list(iter_json_lines(jsonFile))
+
+
+def iter_json_object_items(jsonFile, chunk_size=1 << 20):
+    """Yields the (key, value) pairs of the top-level json object in `jsonFile` one at a time.
+    The file is read in chunks of `chunk_size` characters, so only the value being decoded is held in memory.
+    """
+    for key, value, _ in iter_json_object_entries(jsonFile, chunk_size):
+        yield key, value
+
+
+def iter_json_object_entries(jsonFile, chunk_size=1 << 20):
+    """As `iter_json_object_items`, also yielding the [start, end) byte span of each value in the file."""
+    decoder = json.JSONDecoder()
+    with codecs.open(jsonFile, "r", "utf-8") as f:
+        buf, pos, eof = "", 0, False
+        offset = 0 # byte offset of buf[pos] in the file
+
+        def advance(new_pos):
+            nonlocal pos, offset
+            offset += len(buf[pos:new_pos].encode("utf-8"))
+            pos = new_pos
+
+        def skip_to_next_char():
+            nonlocal buf, pos, eof
+            while True:
+                new_pos = pos
+                while new_pos < len(buf) and buf[new_pos].isspace():
+                    new_pos += 1
+                advance(new_pos)
+                if pos < len(buf) or eof:
+                    return buf[pos] if pos < len(buf) else ""
+                chunk = f.read(chunk_size)
+                buf, pos, eof = buf[pos:] + chunk, 0, not chunk
+
+        def decode_value():
+            nonlocal buf, pos, eof
+            skip_to_next_char()
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buf, pos)
+                    # a value touching the end of the buffer may be a truncated number, read on to be sure
+                    if end < len(buf) or eof:
+                        start = offset
+                        advance(end)
+                        return value, start, offset
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                chunk = f.read(chunk_size)
+                buf, pos, eof = buf[pos:] + chunk, 0, not chunk
+
+        if skip_to_next_char() != "{":
+            raise ValueError("%s does not hold a json object" % jsonFile)
+        advance(pos + 1)
+        if skip_to_next_char() == "}":
+            return
+        while True:
+            key, _, _ = decode_value()
+            if skip_to_next_char() != ":":
+                raise ValueError("Malformed json object in %s" % jsonFile)
+            advance(pos + 1)
+            value, start, end = decode_value()
+            yield key, value, (start, end)
+            sep = skip_to_next_char()
+            advance(pos + 1)
+            if sep == "}":
+                return
+            if sep != ",":
+                raise ValueError("Malformed json object in %s" % jsonFile)
+
+
+def load_json_object_index(jsonFile, index_dir=None):
+    """The key -> [start, end) byte span index of the values of the top-level json object in `jsonFile`, built in one streaming pass.
+    With an `index_dir` (e.g. the features cache directory) the index is kept there as `JsonIndex_<sha1 of the file>.json`,
+    so it is built once per version of the file and the dataset directory is never written to; otherwise it is only kept in memory.
+    """
+    index_file = None
+    if index_dir is not None:
+        digest = memoized_file_digest(jsonFile, os.path.join(index_dir, "file_digests.json"))
+        index_file = os.path.join(index_dir, "JsonIndex_{}.json".format(digest))
+        if os.path.isfile(index_file):
+            with open(index_file) as f:
+                return json.load(f)
+    logger.info("Indexing %s", jsonFile)
+    spans = {key: list(span) for key, _, span in iter_json_object_entries(jsonFile)}
+    if index_file is not None:
+        tmp_file = "%s.tmp-%d" % (index_file, os.getpid())
+        with open(tmp_file, "w") as f:
+            json.dump(spans, f)
+        os.replace(tmp_file, index_file)
+    return spans
+
+
+def read_json_object_value(f, span):
+    """Reads the value at the byte `span` of a json file opened in binary mode, see `load_json_object_index`."""
+    f.seek(span[0])
+    return json.loads(f.read(span[1] - span[0]).decode("utf-8"))
 
 
 def dict2json(dic, jsonFile):
@@ -398,8 +631,13 @@ def dict2json(dic, jsonFile):
         print("Finishing writing a dict into " + jsonFile)
     
     
-def convert_examples_to_features(
-    examples: List[InputExample],
+def convert_examples_to_features(*args, **kwargs) -> List[InputFeatures]:
+    """Loads a data file into a list of `InputFeatures`, see `iter_examples_to_features` for the arguments."""
+    return list(iter_examples_to_features(*args, **kwargs))
+
+
+def iter_examples_to_features(
+    examples: Iterable[InputExample],
     label4token_list: List[str],
     label4sent_list: List[str],
     label4rel_list: List[str], 
@@ -417,166 +655,1005 @@ def convert_examples_to_features(
     sequence_a_segment_id=0,
     mask_padding_with_zero=True,
     model_name=None,
-    task_name=None
-) -> List[InputFeatures]:
+    task_name=None,
+    num_workers=1,
+    docs_per_shard=32,
+    doc_cache_dir=None,
+    token_ids_dir=None,
+    window_stride=0,
+    doc_cache_max_bytes=0,
+) -> Iterator[InputFeatures]:
     """
-    Loads a data file into a list of `InputFeatures`
+    Yields the `InputFeatures` of a data file, one document at a time, so the features of a whole split are never held in memory.
+        `examples` may be any iterable, e.g. the generators returned by the processors; it is consumed in a single pass.
         `cls_token_at_end` define the location of the CLS token:
             - False (Default, BERT/XLM pattern): [CLS] + A + [SEP] + B + [SEP]
             - True (XLNet/GPT pattern): A + [SEP] + B + [SEP] + [CLS]
         `cls_token_segment_id` define the segment id associated to the CLS token (0 for BERT, 2 for XLNet)
-    """ 
+        `num_workers` > 1 converts shards of `docs_per_shard` documents in a process pool. Example ids are still
+            assigned here, in reading order, and features are returned in the same order, so the output does not
+            depend on the number of workers.
+        `doc_cache_dir` keeps the feature of every document under the digest of its content (see `DocumentFeatureStore`),
+            so only the documents that are new or changed since the last call are converted. It must be specific to
+            the tokenizer, labels and the other arguments, which the digest does not cover. Once the split is converted, the
+            documents used least recently are evicted until it takes at most `doc_cache_max_bytes` (0 for no limit).
+        `token_ids_dir` keeps the vocabulary ids of the sentences of every document, before truncation, so they are shared
+            by all splits and all `max_length` / `max_size`. It must be specific to the tokenizer. It is bounded by
+            `doc_cache_max_bytes` as well.
+        `window_stride` > 0 splits the documents longer than `max_size` sentences into windows of `max_size` sentences
+            starting every `window_stride` sentences (see `split_example_windows`), one feature each, instead of truncating them.
+        `task_name` "maven-ere" writes the example id -> doc id and doc id -> mention ids maps of the split, once all of it has been converted.
+    """
+    if window_stride > max_size:
+        raise ValueError("window_stride ({}) cannot be larger than max_size ({}), sentences would be skipped".format(window_stride, max_size)) 
     
     label4token_map = {label4token: i for i, label4token in enumerate(label4token_list)}
     label4sent_map = {label: i for i, label in enumerate(label4sent_list)}
     label4rel_map = {label: i for i, label in enumerate(label4rel_list)}
-    pad_token_label_id = label4token_map[NAME_PADDING]
-
-    list_example_id = set()
-    for (ex_index, example) in tqdm.tqdm(enumerate(examples), desc="convert examples to features"):
-        list_example_id.add(example.example_id)
-    example_id_map = {example_id: i+1 for i, example_id in enumerate(list_example_id)} # example_id counts from 1
-    dict_exid2docid = {i+1: example_id for i, example_id in enumerate(list_example_id)} # example_id counts from 1
+    conversion_kwargs = dict(
+        label4token_map=label4token_map,
+        label4sent_map=label4sent_map,
+        label4rel_map=label4rel_map,
+        max_length=max_length,
+        max_size=max_size,
+        vocab_lookup=VocabLookup(tokenizer),
+        token_ids_store=DigestStore(token_ids_dir) if token_ids_dir is not None else None,
+        cls_token_at_end=cls_token_at_end,
+        cls_token=cls_token,
+        cls_token_segment_id=cls_token_segment_id,
+        sep_token=sep_token,
+        sep_token_extra=sep_token_extra,
+        pad_on_left=pad_on_left,
+        pad_token=pad_token,
+        pad_token_segment_id=pad_token_segment_id,
+        sequence_a_segment_id=sequence_a_segment_id,
+        mask_padding_with_zero=mask_padding_with_zero,
+    )
+
+    example_id_map = {} # example_id counts from 1, in order of first appearance
+    dict_docid2mentionids = {}
+    doc_store = None
+    if doc_cache_dir is not None:
+        doc_store = DocumentFeatureStore(doc_cache_dir, fills=dict(
+            list_input_ids=pad_token,
+            list_input_dependent=pad_token,
+            list_input_mask=0 if mask_padding_with_zero else 1,
+            list_segment_ids=pad_token_segment_id,
+            list_token_labels=label4token_map[NAME_PADDING],
+            list_sent_label=len(label4sent_map),
+        ))
+    num_reused = 0
+
+    def numbered_examples():
+        """Yields (ex_index, example_id, example, digest, cached feature); the example is dropped when its feature is cached."""
+        nonlocal num_reused
+        def windows():
+            for example in examples:
+                if example.list_mention_id is not None:
+                    dict_docid2mentionids[example.example_id] = example.list_mention_id
+                for window in split_example_windows(example, max_size, window_stride):
+                    yield window
+
+        for (ex_index, example) in enumerate(windows()):
+            if ex_index % 500 == 0:
+                logger.info("Writing example %d" % (ex_index))
+            if example.example_id not in example_id_map:
+                example_id_map[example.example_id] = len(example_id_map) + 1
+            example_id = example_id_map[example.example_id]
+            digest = cached = None
+            if doc_store is not None:
+                digest = example_digest(example)
+                cached = doc_store.get(digest, example_id)
+            if cached is not None:
+                num_reused += 1
+                yield ex_index, example_id, None, digest, cached
+            else:
+                yield ex_index, example_id, example, digest, None
+
+    def store_new_features(shard, shard_features):
+        if doc_store is not None:
+            for (_, _, _, digest, cached), feature in zip(shard, shard_features):
+                if cached is None:
+                    doc_store.put(digest, feature)
+
+    num_features = 0
+    if num_workers > 1:
+        with multiprocessing.Pool(num_workers, initializer=_init_conversion_worker, initargs=(conversion_kwargs,)) as pool, \
+                tqdm.tqdm(desc="convert examples to features") as progress:
+            pending = collections.deque()
+
+            def collect_oldest_shard():
+                shard, result = pending.popleft()
+                shard_features = result.get()
+                store_new_features(shard, shard_features)
+                progress.update(len(shard_features))
+                return shard_features
+
+            for shard in _iter_shards(numbered_examples(), docs_per_shard):
+                pending.append((shard, pool.apply_async(_convert_shard, (shard,))))
+                if len(pending) >= 2 * num_workers: # bound the number of documents held in flight
+                    for feature in collect_oldest_shard():
+                        num_features += 1
+                        yield feature
+            while pending:
+                for feature in collect_oldest_shard():
+                    num_features += 1
+                    yield feature
+    else:
+        for item in tqdm.tqdm(numbered_examples(), desc="convert examples to features"):
+            item_features = _convert_shard([item], conversion_kwargs)
+            store_new_features([item], item_features)
+            num_features += 1
+            yield item_features[0]
+    if doc_store is not None:
+        logger.info("Reused the cached features of %d documents, converted %d", num_reused, num_features - num_reused)
+        if doc_cache_max_bytes > 0:
+            doc_store.prune(doc_cache_max_bytes)
+    if token_ids_dir is not None and doc_cache_max_bytes > 0:
+        conversion_kwargs["token_ids_store"].prune(doc_cache_max_bytes)
+
+    # only reached once every example has been converted, a consumer stopping early leaves both maps as they were
     if task_name == "maven-ere": 
+        dict_exid2docid = {i: example_id for example_id, i in example_id_map.items()}
         dict2json(dict_exid2docid, MAVENERE_EXAMPLE_ID_PATH) 
+        dict2json(dict_docid2mentionids, MAVENERE_MENTION_ID_PATH)
+
+
+def convert_example_to_feature(
+    example: InputExample,
+    example_id: int,
+    ex_index: int,
+    label4token_map,
+    label4sent_map,
+    label4rel_map,
+    max_length: int,
+    max_size: int,
+    vocab_lookup: "VocabLookup",
+    token_ids_store: "DigestStore" = None,
+    cls_token_at_end=False,
+    cls_token="[CLS]",
+    cls_token_segment_id=1,
+    sep_token="[SEP]",
+    sep_token_extra=False,
+    pad_on_left=False,
+    pad_token=0,
+    pad_token_segment_id=0,
+    sequence_a_segment_id=0,
+    mask_padding_with_zero=True,
+) -> InputFeatures:
+    """Converts one document into its padded `InputFeatures`, see `convert_examples_to_features`.
+    The fields are filled into [max_size, max_length] arrays initialised with their padding value, so padding and
+    truncation are slicing.
+    """
+    pad_token_label_id = label4token_map[NAME_PADDING]
+
+    # only the labelled pairs are kept, pairs of truncated mentions are dropped
+    mat_size = min(max_size, example.mention_size) 
+    head, tail, rel_id = example.rel_triples.T
+    rel_triples = example.rel_triples[(head < mat_size) & (tail < mat_size) & (rel_id != label4rel_map[NAME_NO_RELATION])].astype(np.int64)
+
+    # the ids of all the sentences of the document, in one lookup or from the cache
+    if token_ids_store is not None:
+        tokens_digest = hashlib.sha1(json.dumps(example.list_tokens).encode("utf-8")).hexdigest()
+        doc_token_ids = token_ids_store.load(tokens_digest)
+        if doc_token_ids is None:
+            doc_token_ids = vocab_lookup.document_ids(example.list_tokens)
+            token_ids_store.save(tokens_digest, doc_token_ids)
+        else:
+            token_ids_store.touch(tokens_digest)
+    else:
+        doc_token_ids = vocab_lookup.document_ids(example.list_tokens)
+    token_ids, token_offsets = doc_token_ids
+    cls_token_id, sep_token_id = vocab_lookup([cls_token, sep_token])
+
+    list_input_ids = np.full([max_size, max_length], pad_token, dtype=np.int64)
+    list_input_dependent = np.full([max_size, max_length], pad_token, dtype=np.int64)
+    list_attention_mask = np.full([max_size, max_length], 0 if mask_padding_with_zero else 1, dtype=np.int64)
+    list_token_type_ids = np.full([max_size, max_length], pad_token_segment_id, dtype=np.int64)
+    list_label4token_ids = np.full([max_size, max_length], pad_token_label_id, dtype=np.int64)
+    list_label4sent_ids = np.full([max_size], len(label4sent_map), dtype=np.int64)
+
+    # Account for [CLS] and [SEP] with "-2" and with "-3" for RoBERTa.
+    special_tokens_count = 3 if sep_token_extra else 2
+    max_num_tokens = max_length - special_tokens_count
+    num_special_after = 2 if sep_token_extra else 1 # [SEP] (and the extra [SEP] of roberta) after the tokens
+    for i in range(mat_size):
+        num_tokens = min(token_offsets[i + 1] - token_offsets[i], max_num_tokens)
+        # layout of the real part: [CLS] tokens [SEP] ([SEP]), or tokens [SEP] ([SEP]) [CLS]
+        length = num_tokens + special_tokens_count
+        start = max_length - length if pad_on_left else 0
+        first = start + (0 if cls_token_at_end else 1) # position of the first token
+        cls_pos = start + length - 1 if cls_token_at_end else start
+        sep_pos = first + num_tokens
+
+        list_input_ids[i, first:first + num_tokens] = token_ids[token_offsets[i]:token_offsets[i] + num_tokens]
+        list_input_ids[i, sep_pos:sep_pos + num_special_after] = sep_token_id
+        list_input_ids[i, cls_pos] = cls_token_id
+        list_attention_mask[i, start:start + length] = 1 if mask_padding_with_zero else 0
+        list_token_type_ids[i, start:start + length] = sequence_a_segment_id
+        list_token_type_ids[i, cls_pos] = cls_token_segment_id
+        list_label4token_ids[i, first:first + num_tokens] = example.token_label_ids[token_offsets[i]:token_offsets[i] + num_tokens]
+        # the dependency flags of the special tokens are 0
+        list_input_dependent[i, start:start + length] = 0
+        list_input_dependent[i, first:first + num_tokens] = example.list_tokens_dependent[i][:num_tokens]
+    list_label4sent_ids[:mat_size] = example.sent_label_ids[:mat_size]
+
+    feature = InputFeatures(example_id=example_id, mention_size=example.mention_size, pad_token_label_id=pad_token_label_id, list_input_ids=list_input_ids, list_input_dependent=list_input_dependent, list_input_mask=list_attention_mask, list_segment_ids=list_token_type_ids, list_token_labels=list_label4token_ids, list_sent_label=list_label4sent_ids, rel_triples=rel_triples, window_start=example.window_start)
+
+    if ex_index < 2:
+        logger.info("**** Example ****")
+        logger.info("example_id: {}".format(example.example_id))
+        logger.info("mention_size: {}".format(example.mention_size))
+        logger.info("pad_token_label_id: {}".format(pad_token_label_id))
+        logger.info("list_input_ids: {}".format(" ".join(map(str, list_input_ids.tolist()))))
+        logger.info("list_input_dependent: {}".format(" ".join(map(str, list_input_dependent.tolist()))))
+        logger.info("list_input_mask: {}".format(" ".join(map(str, list_attention_mask.tolist()))))
+        logger.info("list_segment_ids: {}".format(" ".join(map(str, list_token_type_ids.tolist()))))
+        logger.info("list_token_labels: {}".format(" ".join(map(str, list_label4token_ids.tolist()))))
+        logger.info("list_sent_label: {}".format(" ".join(map(str, list_label4sent_ids.tolist()))))
+        logger.info("rel_triples: {}".format(" ".join(map(str, rel_triples.tolist()))))
+    return feature
+
+
+class VocabLookup(object):
+    """The token to id mapping of a tokenizer as a plain dict (added tokens included), as in `convert_tokens_to_ids`:
+    unknown tokens map to the id of the unk token. Picklable, so the workers do not need the tokenizer.
+    """
+
+    def __init__(self, tokenizer: PreTrainedTokenizer):
+        self.vocab = dict(tokenizer.get_vocab())
+        self.unk_id = self.vocab.get(tokenizer.unk_token)
+
+    def __call__(self, tokens):
+        vocab, unk_id = self.vocab, self.unk_id
+        return np.fromiter((vocab.get(token, unk_id) for token in tokens), dtype=np.int64, count=len(tokens))
+
+    def document_ids(self, list_tokens):
+        """The ids of all the sentences of a document, concatenated, and the [num_sentences + 1] offsets of the sentences."""
+        offsets = np.zeros([len(list_tokens) + 1], dtype=np.int64)
+        offsets[1:] = np.cumsum([len(tokens) for tokens in list_tokens])
+        return self(list(itertools.chain.from_iterable(list_tokens))).astype(np.int32), offsets
+
+
+_worker_conversion_kwargs = None
+
+
+def _init_conversion_worker(conversion_kwargs):
+    global _worker_conversion_kwargs
+    _worker_conversion_kwargs = conversion_kwargs
+
+
+def _convert_shard(shard, conversion_kwargs=None):
+    conversion_kwargs = _worker_conversion_kwargs if conversion_kwargs is None else conversion_kwargs
+    return [
+        cached if cached is not None else convert_example_to_feature(example, example_id, ex_index, **conversion_kwargs)
+        for (ex_index, example_id, example, _, cached) in shard
+    ]
+
+
+def _iter_shards(iterable, shard_size):
+    shard = []
+    for item in iterable:
+        shard.append(item)
+        if len(shard) == shard_size:
+            yield shard
+            shard = []
+    if shard:
+        yield shard
     
-    features = []
-    for (ex_index, example) in tqdm.tqdm(enumerate(examples), desc="convert examples to features"):
-        if ex_index % 500 == 0:
-            print("-" * 20)
-            logger.info("Writing example %d of %d" % (ex_index, len(examples)))
-            print("-" * 20)
-
-        list_input_ids = []
-        list_attention_mask = []
-        list_token_type_ids = []
-        list_label4token_ids = []
-        list_label4sent_ids = []
-        mat_rel_label_ids = []
-        list_input_dependent = []
-
-        # initial the mat_rel_label_ids
-        for i in range(max_size):
-            mat_rel_label_ids.append([label4rel_map[NAME_NO_RELATION]]*max_size)  
-        mat_size = min(max_size, example.mention_size) 
-        for i in range(mat_size):
-            for j in range(mat_size):
-                rel_name = example.mat_rel_label[i][j] 
-                mat_rel_label_ids[i][j] = label4rel_map[rel_name] 
-
-        for i in range(example.mention_size):
-            tokens = []
-            tokens.extend(example.list_tokens[i])
-            label4token_ids = []
-            input_dependent = example.list_tokens_dependent[i]
-            for token_name in example.list_token_labels[i]: 
-                label4token_ids.append(label4token_map[token_name])
- 
-            # Account for [CLS] and [SEP] with "-2" and with "-3" for RoBERTa.
-            special_tokens_count = 3 if sep_token_extra else 2
-            if len(tokens) > max_length - special_tokens_count:
-                tokens = tokens[:(max_length - special_tokens_count)]
-                input_dependent = input_dependent[:(max_length - special_tokens_count)]
-                label4token_ids = label4token_ids[:(max_length - special_tokens_count)]
-            
-            tokens.append(sep_token)
-            input_dependent.append(0)
-            label4token_ids.append(pad_token_label_id)
-            if sep_token_extra:
-                # roberta uses an extra separator b/w pairs of sentences
-                tokens.append(sep_token)
-                label4token_ids.append(pad_token_label_id) 
-            token_type_ids = [sequence_a_segment_id] * len(tokens)
-
-            if cls_token_at_end:
-                tokens.append(cls_token)
-                label4token_ids.append(pad_token_label_id) 
-                token_type_ids.append(cls_token_segment_id)
-                input_dependent.append(0)
-            else:
-                tokens.insert(0, cls_token)
-                label4token_ids.insert(0, pad_token_label_id)
-                token_type_ids.insert(0, cls_token_segment_id)
-                input_dependent.insert(0, 0)
-
-            input_ids = tokenizer.convert_tokens_to_ids(tokens) 
-
-            # The mask has 1 for real tokens and 0 for padding tokens. Only real tokens are attended to.
-            attention_mask = [1 if mask_padding_with_zero else 0] * len(input_ids)
-            # Zero-pad up to the sequence length.
-            padding_length = max_length - len(input_ids)
-            if pad_on_left:
-                input_ids = ([pad_token] * padding_length) + input_ids
-                input_dependent = ([pad_token] * padding_length) + input_dependent
-                attention_mask = ([0 if mask_padding_with_zero else 1] * padding_length) + attention_mask
-                token_type_ids = ([pad_token_segment_id] * padding_length) + token_type_ids
-                label4token_ids = ([label4token_map[NAME_PADDING]] * padding_length) + label4token_ids 
+
+def feature_column_shapes(max_length, max_size):
+    """The per-document shape of every dense column of the feature cache, in the order of the dataset tuples.
+    The attention mask is stored as the [start, end) span of the real tokens of each sentence and the token type ids,
+    which DistilBERT does not read, are not stored.
+    """
+    return collections.OrderedDict([
+        ("example_id", ()),
+        ("mention_size", ()),
+        ("pad_token_label_id", ()),
+        ("list_input_ids", (max_size, max_length)),
+        ("list_input_dependent", (max_size, max_length)),
+        ("list_input_span", (max_size, 2)),
+        ("list_token_labels", (max_size, max_length)),
+        ("list_sent_label", (max_size,)),
+        ("window_start", ()),
+    ])
+
+
+def input_spans(list_input_mask):
+    """The [start, end) columns of the real tokens of every sentence of a [max_size, max_length] attention mask
+    (built with mask_padding_with_zero), [0, 0) for the padding sentences."""
+    real = np.asarray(list_input_mask) != 0
+    start = real.argmax(-1)
+    return np.stack([start, start + real.sum(-1)], axis=-1)
+
+
+def compact_dtype(values):
+    """The smallest integer dtype holding all of `values`."""
+    if values.size == 0:
+        return np.int8
+    return np.result_type(np.min_scalar_type(values.min()), np.min_scalar_type(values.max()))
+
+
+def feature_item(feature: InputFeatures, max_length, max_size):
+    """A feature as a `FeatureDataset` item: its dense columns in the order of `feature_column_shapes`, then its relation triples."""
+    columns = [
+        input_spans(feature.list_input_mask) if name == "list_input_span" else np.asarray(getattr(feature, name))
+        for name in feature_column_shapes(max_length, max_size)
+    ]
+    return tuple(columns) + (np.asarray(feature.rel_triples, dtype=np.int64).reshape(-1, 3),)
+
+
+def write_feature_columns(features: List[InputFeatures], column_dir, max_length, max_size):
+    """Writes `features` to the existing directory `column_dir` as one contiguous .npy array per field, each one in the
+    smallest integer dtype its values fit in (uint16 for the input ids of a 30k vocabulary, int8 for most labels).
+    The relation triples of all documents are concatenated into `rel_triples`, document i owning the rows
+    `rel_offsets[i]:rel_offsets[i+1]`.
+    """
+    def save_column(name, values):
+        np.save(os.path.join(column_dir, name + ".npy"), values.astype(compact_dtype(values)))
+
+    fields = list(zip(*[feature_item(feature, max_length, max_size) for feature in features]))
+    for name, field in zip(feature_column_shapes(max_length, max_size), fields):
+        save_column(name, np.stack(field))
+
+    rel_offsets = np.zeros([len(features) + 1], dtype=np.int64)
+    rel_offsets[1:] = np.cumsum([len(triples) for triples in fields[-1]])
+    np.save(os.path.join(column_dir, "rel_offsets.npy"), rel_offsets)
+    save_column("rel_triples", np.concatenate(fields[-1]))
+
+
+def write_feature_shards(features: Iterable[InputFeatures], cache_dir, max_length, max_size, shard_size=256):
+    """Writes `features` to `cache_dir` in shards of `shard_size` documents, each one a `write_feature_columns` directory,
+    and returns their number. `features` may be a generator, only one shard of it is held in memory at a time.
+    The directory is filled under a temporary name and renamed at the end, so a reader never sees a partial cache;
+    it is removed if `features` raises or is stopped.
+    """
+    tmp_dir = "%s.tmp-%d" % (cache_dir.rstrip(os.sep), os.getpid())
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    shards = []
+    try:
+        for shard_features in _iter_shards(features, shard_size):
+            shard_name = "shard-%05d" % len(shards)
+            os.makedirs(os.path.join(tmp_dir, shard_name))
+            write_feature_columns(shard_features, os.path.join(tmp_dir, shard_name), max_length, max_size)
+            shards.append({"name": shard_name, "num_features": len(shard_features)})
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    num_features = sum(shard["num_features"] for shard in shards)
+    fields = list(feature_column_shapes(max_length, max_size).keys()) + ["rel_triples", "rel_offsets"]
+    meta = {"format_version": FEATURE_CACHE_VERSION, "num_features": num_features, "max_length": max_length, "max_size": max_size, "fields": fields, "shards": shards}
+    with open(os.path.join(tmp_dir, FEATURE_CACHE_META), "w") as f:
+        json.dump(meta, f)
+    if os.path.exists(cache_dir):
+        # moved aside rather than deleted in place, so the swap itself is a single rename
+        old_dir = "%s.old-%d" % (cache_dir.rstrip(os.sep), os.getpid())
+        os.rename(cache_dir, old_dir)
+        os.rename(tmp_dir, cache_dir)
+        shutil.rmtree(old_dir)
+    else:
+        os.rename(tmp_dir, cache_dir)
+    return num_features
+
+
+def is_feature_cache_complete(cache_dir):
+    meta_file = os.path.join(cache_dir, FEATURE_CACHE_META)
+    if not os.path.isfile(meta_file):
+        return False
+    with open(meta_file) as f:
+        return json.load(f).get("format_version") == FEATURE_CACHE_VERSION
+
+
+def stale_feature_caches(cache_dir):
+    """The entries next to `cache_dir` named as it is but for their key (the part after the last "_"), i.e. the caches of the
+    same kind and parameters built from other data files, labels or tokenizers, together with their lock files, and the
+    temporary or moved aside directories left by interrupted `write_feature_shards` calls, of any key.
+    """
+    parent, name = os.path.split(cache_dir.rstrip(os.sep))
+    prefix, key = name.rsplit("_", 1)
+    stale = []
+    for entry in sorted(os.listdir(parent or ".")):
+        if not entry.startswith(prefix + "_"):
+            continue
+        entry_key, _, suffix = entry[len(prefix) + 1:].partition(".")
+        if "_" in entry_key or len(entry_key) != len(key):
+            continue # the cache of other parameters, e.g. Cached_train_x_128_50 next to Cached_train_x_128_500
+        if suffix.startswith(("tmp-", "old-")):
+            pid = suffix[4:]
+            if not pid.isdigit() or not _is_process_alive(int(pid)):
+                stale.append(os.path.join(parent, entry))
+        elif entry_key != key and suffix in ("", "lock"):
+            stale.append(os.path.join(parent, entry))
+    return stale
+
+
+def prune_feature_caches(cache_dir, remove=False):
+    """Logs the `stale_feature_caches` of `cache_dir`, and deletes them if `remove`, which must not be done while another
+    run may still read or write one of them (e.g. a run on another version of the data sharing the cache directory).
+    """
+    for path in stale_feature_caches(cache_dir):
+        if not remove:
+            logger.info("Stale feature cache %s, delete it or run with --prune_features_cache", path)
+            continue
+        logger.info("Deleting the stale feature cache %s", path)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.exists(path):
+            os.remove(path)
+
+
+def _is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError: # e.g. the process of another user
+        return True
+    return True
+
+
+def read_feature_columns(column_dir, fields) -> Dict[str, np.ndarray]:
+    """Memory-maps the columns `fields` written by `write_feature_columns`. Nothing is read from disk until a row is accessed.
+    The columns keep their compact dtypes, `collate_features` widens them batch by batch.
+    """
+    return collections.OrderedDict((name, np.load(os.path.join(column_dir, name + ".npy"), mmap_mode="c")) for name in fields)
+
+
+def read_feature_shards(cache_dir, fields=None) -> List[Dict[str, np.ndarray]]:
+    """Memory-maps the columns of every shard written by `write_feature_shards`, only the `fields` asked for (all by default)."""
+    with open(os.path.join(cache_dir, FEATURE_CACHE_META)) as f:
+        meta = json.load(f)
+    fields = meta["fields"] if fields is None else fields
+    return [read_feature_columns(os.path.join(cache_dir, shard["name"]), fields) for shard in meta["shards"]]
+
+
+def file_digest(path, memo=None):
+    """The sha1 of the content of `path`.
+    `memo` maps absolute paths to [size, mtime_ns, digest]; a file whose size and mtime did not change is not read again.
+    """
+    stat = os.stat(path)
+    key = os.path.abspath(path)
+    if memo is not None and memo.get(key, [None, None])[:2] == [stat.st_size, stat.st_mtime_ns]:
+        return memo[key][2]
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(chunk)
+    if memo is not None:
+        memo[key] = [stat.st_size, stat.st_mtime_ns, sha1.hexdigest()]
+    return sha1.hexdigest()
+
+
+def memoized_file_digest(path, memo_file):
+    """The `file_digest` of `path`, remembered in `memo_file` (json) as by `feature_cache_key`."""
+    memo = {}
+    if os.path.isfile(memo_file):
+        with open(memo_file) as f:
+            memo = json.load(f)
+    known = dict(memo)
+    digest = file_digest(path, memo)
+    if memo != known:
+        tmp_file = "%s.tmp-%d" % (memo_file, os.getpid())
+        with open(tmp_file, "w") as f:
+            json.dump(memo, f)
+        os.replace(tmp_file, memo_file)
+    return digest
+
+
+def feature_cache_key(input_files, tokenizer: PreTrainedTokenizer, label_lists, conversion_params, memo_file=None):
+    """A content hash of everything the features depend on: the input files, the tokenizer vocabulary and casing,
+    the label lists, the conversion parameters and `FEATURE_CACHE_VERSION`.
+    The file digests are remembered in `memo_file` (json), so that an unchanged dataset is not hashed on every run.
+    """
+    memo = {}
+    if memo_file is not None and os.path.isfile(memo_file):
+        with open(memo_file) as f:
+            memo = json.load(f)
+    key = {
+        "format_version": FEATURE_CACHE_VERSION,
+        "input_files": [file_digest(path, memo) for path in input_files],
+        "tokenizer": [type(tokenizer).__name__, tokenizer.init_kwargs.get("do_lower_case"), sorted(tokenizer.get_vocab().items())],
+        "label_lists": label_lists,
+        "conversion_params": conversion_params,
+    }
+    if memo_file is not None:
+        tmp_file = "%s.tmp-%d" % (memo_file, os.getpid())
+        with open(tmp_file, "w") as f:
+            json.dump(memo, f)
+        os.replace(tmp_file, memo_file)
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def example_digest(example: InputExample):
+    """The sha1 of the content of an example, its example_id and mention ids left out."""
+    content = {}
+    for name in InputExample.__slots__:
+        value = getattr(example, name)
+        if name not in ("example_id", "list_mention_id"):
+            content[name] = value.tolist() if isinstance(value, np.ndarray) else value
+    return hashlib.sha1(json.dumps(content, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class DigestStore(object):
+    """Pickled values, one file each, named after a digest of what they were computed from.
+    Files are written under a temporary name and renamed, so concurrent writers and readers never see a partial one.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest + ".pkl")
+
+    def load(self, digest):
+        try:
+            with open(self.path(digest), "rb") as f:
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def touch(self, digest):
+        """Marks a value as used, see `prune`."""
+        try:
+            os.utime(self.path(digest))
+        except OSError:
+            pass
+
+    def save(self, digest, value):
+        path = self.path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = "%s.tmp-%d" % (path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def prune(self, max_bytes):
+        """Deletes the values used least recently (written or touched) until the store takes at most `max_bytes`."""
+        files = []
+        for dir_path, _, file_names in os.walk(self.root):
+            for file_name in file_names:
+                try:
+                    stat = os.stat(os.path.join(dir_path, file_name))
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, os.path.join(dir_path, file_name)))
+        total_bytes = sum(size for _, size, _ in files)
+        num_deleted = 0
+        for _, size, path in sorted(files):
+            if total_bytes <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_bytes -= size
+            num_deleted += 1
+        if num_deleted:
+            logger.info("Evicted %d entries from %s, %.1f MB left", num_deleted, self.root, total_bytes / 2**20)
+
+
+class DocumentFeatureStore(DigestStore):
+    """The features of single documents, named after the `example_digest` of their example.
+    Only the rows of the kept sentences and the columns holding one of their tokens are stored, in compact dtypes; the padding
+    is restored from `fills`, the padding value of every [max_size, max_length] and [max_size] field of the features.
+    The example_id is not stored, since it depends on the position of the document in its split.
+    """
+
+    def __init__(self, root, fills):
+        super(DocumentFeatureStore, self).__init__(root)
+        self.fills = fills
+
+    def get(self, digest, example_id):
+        record = self.load(digest)
+        if record is None:
+            return None
+        self.touch(digest)
+        rows, columns = record["rows"], slice(*record["columns"])
+        fields = dict(record["scalars"])
+        for name, block in record["blocks"].items():
+            value = np.full(record["shapes"][name], self.fills[name], dtype=np.int64)
+            if value.ndim == 2:
+                value[:rows, columns] = block
             else:
-                input_ids = input_ids + ([pad_token] * padding_length)
-                input_dependent = input_dependent + ([pad_token] * padding_length)
-                attention_mask = attention_mask + ([0 if mask_padding_with_zero else 1] * padding_length)
-                token_type_ids = token_type_ids + ([pad_token_segment_id] * padding_length)
-                label4token_ids = label4token_ids + ([label4token_map[NAME_PADDING]] * padding_length)
-
-            assert len(input_ids) == max_length
-            assert len(input_dependent) == max_length
-            assert len(attention_mask) == max_length
-            assert len(token_type_ids) == max_length
-            assert len(label4token_ids) == max_length
+                value[:rows] = block
+            fields[name] = value
+        fields["rel_triples"] = record["rel_triples"].astype(np.int64)
+        return InputFeatures(example_id=example_id, **fields)
+
+    def put(self, digest, feature: InputFeatures):
+        rows = min(feature.mention_size, len(feature.list_sent_label))
+        real = np.asarray(feature.list_input_mask)[:rows] != self.fills["list_input_mask"]
+        real_columns = np.nonzero(real.any(0))[0]
+        columns = (int(real_columns[0]), int(real_columns[-1]) + 1) if real_columns.size else (0, 0)
+        record = {"rows": rows, "columns": columns, "shapes": {}, "blocks": {}, "scalars": {}}
+        for name, value in vars(feature).items():
+            if name in self.fills:
+                value = np.asarray(value)
+                block = value[:rows, columns[0]:columns[1]] if value.ndim == 2 else value[:rows]
+                record["shapes"][name] = value.shape
+                record["blocks"][name] = block.astype(compact_dtype(block))
+            elif name == "rel_triples":
+                value = np.asarray(value, dtype=np.int64).reshape(-1, 3)
+                record["rel_triples"] = value.astype(compact_dtype(value))
+            elif name != "example_id":
+                record["scalars"][name] = value
+        self.save(digest, record)
+
+
+@contextlib.contextmanager
+def feature_cache_lock(cache_dir):
+    """Holds an exclusive lock on `cache_dir` across processes, so that parallel runs sharing a cache directory build
+    each cache once and wait for it instead of building it side by side. A no-op where `fcntl` is not available.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    with open(cache_dir.rstrip(os.sep) + ".lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class FeatureDataset(Dataset):
+    """Documents of the feature cache: the dense columns followed by the [num_rel, 3] relation triples of the document,
+    as rows of the memory-mapped columns in their compact dtypes."""
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.dense_columns = [columns[name] for name in columns if name not in ("rel_triples", "rel_offsets")]
+        self.rel_triples = columns["rel_triples"]
+        self.rel_offsets = columns["rel_offsets"]
+
+    def __len__(self):
+        return len(self.rel_offsets) - 1
+
+    def __getitem__(self, index):
+        start, end = int(self.rel_offsets[index]), int(self.rel_offsets[index + 1])
+        return tuple(column[index] for column in self.dense_columns) + (self.rel_triples[start:end],)
+
+    def document_sizes(self, chunk_size=1024):
+        """The number of kept sentences and the length in tokens of the longest of them, for every document."""
+        input_span = self.columns["list_input_span"]
+        num_sentences = np.minimum(self.columns["mention_size"], input_span.shape[1])
+        sentence_length = np.zeros([len(self)], dtype=np.int64)
+        for start in range(0, len(self), chunk_size):
+            span = input_span[start:start + chunk_size].astype(np.int64)
+            sentence_length[start:start + chunk_size] = (span[..., 1] - span[..., 0]).max(-1)
+        return num_sentences, sentence_length
+
+
+class ConcatFeatureDataset(ConcatDataset):
+    """The `FeatureDataset`s of the shards of a feature cache, as one map-style dataset."""
+
+    def document_sizes(self):
+        sizes = [dataset.document_sizes() for dataset in self.datasets]
+        return np.concatenate([size[0] for size in sizes]), np.concatenate([size[1] for size in sizes])
+
+
+class StreamingFeatureDataset(IterableDataset):
+    """Streams the documents of the shards of a feature cache for training, through a shuffle buffer of at most
+    `shuffle_buffer_size` documents, so the memory needed does not grow with the corpus.
+    Every epoch (see `set_epoch`) the shards are visited in a new random order, the documents of each shard in a random order.
+    The DDP ranks split the shards, every num_replicas-th shard of the epoch order each, and the DataLoader workers of a
+    rank split its shards, so every shard is read by one process only. Each rank takes `len(self)` documents, those of its
+    shards cut short or wrapped around, so that all ranks run the same number of steps.
+    """
+
+    def __init__(self, shards, shuffle_buffer_size=1000, num_replicas=1, rank=0, seed=0):
+        if 0 < len(shards) < num_replicas:
+            raise ValueError("{} shards cannot be split among {} ranks, use a smaller shard size".format(len(shards), num_replicas))
+        self.shards = shards
+        self.shard_sizes = [len(columns["rel_offsets"]) - 1 for columns in shards]
+        self.shuffle_buffer_size = max(1, shuffle_buffer_size)
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.num_per_replica = sum(self.shard_sizes) // num_replicas
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.num_per_replica
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+        # the shard order is shared by all workers and ranks, the order within the shards is not
+        shard_order = np.random.RandomState([self.seed, self.epoch]).permutation(len(self.shards))
+        rng = np.random.RandomState([self.seed, self.epoch, self.rank, worker_id])
+        rank_shards = shard_order[self.rank::self.num_replicas]
+        # position p of the rank takes its document p modulo the number of documents of its shards
+        rank_sizes = [self.shard_sizes[k] for k in rank_shards]
+        rank_ends = np.cumsum(rank_sizes, dtype=np.int64)
+        positions = np.arange(self.num_per_replica) % max(sum(rank_sizes), 1)
+        position_shards = np.searchsorted(rank_ends, positions, side="right")
+
+        def items():
+            for s in range(worker_id, len(rank_shards), num_workers):
+                dataset = FeatureDataset(self.shards[rank_shards[s]])
+                shard_positions = positions[position_shards == s] - (rank_ends[s] - rank_sizes[s])
+                for index in rng.permutation(shard_positions):
+                    yield dataset[index]
+
+        return _shuffle_buffer(items(), self.shuffle_buffer_size, rng)
+
+
+class PipelinedFeatureDataset(IterableDataset):
+    """Trains on the features of a split while they are converted for the first time, instead of after the whole split has been.
+    `make_features` returns a fresh iterator of the `InputFeatures` of the split, e.g. one of `iter_examples_to_features`.
+    In an epoch that finds the cache `cache_dir` incomplete, a background thread runs it and hands every feature both to
+    the training loop, through a bounded queue and a shuffle buffer, and, if `write_cache`, to `write_feature_shards`,
+    so the cache is ready for the next epochs and the next runs. Once complete, the cache is streamed as by `StreamingFeatureDataset`.
+    The thread takes the cache lock and checks the cache again before converting, so that a cache completed by another run
+    in the meantime is streamed instead. When training stops reading early, the conversion stops too, without writing the cache.
+    `num_features` is the number of documents of the split (see `DataProcessor.get_num_examples`), which is needed before
+    any is converted. In that epoch the DDP ranks split the documents, every num_replicas-th each, the last ones being dropped
+    so that all ranks run the same number of steps; each rank converts the whole split, and only the first one writes the cache.
+    Not meant for DataLoader workers, use the `num_workers` of the conversion.
+    """
+
+    def __init__(self, make_features, cache_dir, num_features, max_length, max_size, write_cache=True, shard_size=256, shuffle_buffer_size=1000, num_replicas=1, rank=0, seed=0):
+        self.make_features = make_features
+        self.cache_dir = cache_dir
+        self.max_length = max_length
+        self.max_size = max_size
+        self.write_cache = write_cache
+        self.shard_size = shard_size
+        self.shuffle_buffer_size = max(1, shuffle_buffer_size)
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.num_per_replica = num_features // num_replicas
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.num_per_replica
+
+    def __iter__(self):
+        if get_worker_info() is not None:
+            raise RuntimeError("PipelinedFeatureDataset cannot be read by DataLoader workers")
+        if is_feature_cache_complete(self.cache_dir):
+            dataset = StreamingFeatureDataset(
+                read_feature_shards(self.cache_dir),
+                shuffle_buffer_size=self.shuffle_buffer_size,
+                num_replicas=self.num_replicas,
+                rank=self.rank,
+                seed=self.seed,
+            )
+            dataset.set_epoch(self.epoch)
+            return iter(dataset)
+        rng = np.random.RandomState([self.seed, self.epoch, self.rank])
+        return _shuffle_buffer(self.produced_items(), self.shuffle_buffer_size, rng)
+
+    def produced_items(self):
+        items_queue = queue.Queue(maxsize=self.shuffle_buffer_size)
+        end = object()
+        stop = threading.Event() # set when training stops reading, the producer then gives up at its next document
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    items_queue.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+            raise _ProducerStopped()
+
+        def tee_features():
+            features = self.make_features()
+            try:
+                for feature in features:
+                    put(feature_item(feature, self.max_length, self.max_size))
+                    yield feature
+            finally:
+                features.close() # stops the conversion workers
+
+        def produce():
+            try:
+                if self.write_cache:
+                    with feature_cache_lock(self.cache_dir):
+                        # another run may have completed the cache while this one waited for the lock
+                        if is_feature_cache_complete(self.cache_dir):
+                            for columns in read_feature_shards(self.cache_dir):
+                                dataset = FeatureDataset(columns)
+                                for index in range(len(dataset)):
+                                    put(dataset[index])
+                        else:
+                            write_feature_shards(tee_features(), self.cache_dir, self.max_length, self.max_size, shard_size=self.shard_size)
+                else:
+                    for _ in tee_features():
+                        pass
+                put(end)
+            except _ProducerStopped:
+                pass
+            except BaseException as e:
+                try:
+                    put(e)
+                except _ProducerStopped:
+                    pass
+
+        producer = threading.Thread(target=produce, name="feature-producer", daemon=True)
+        producer.start()
+        try:
+            doc_index = 0
+            while True:
+                item = items_queue.get()
+                if item is end:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                if doc_index % self.num_replicas == self.rank and doc_index < self.num_per_replica * self.num_replicas:
+                    yield item
+                doc_index += 1
+        finally:
+            stop.set()
+            producer.join()
+
+
+class _ProducerStopped(Exception):
+    """Raised in the producer of `PipelinedFeatureDataset` when training stopped reading its documents."""
+
+
+def _shuffle_buffer(items, buffer_size, rng):
+    """Yields `items` in a random order, holding at most `buffer_size` of them."""
+    buffer = []
+    for item in items:
+        if len(buffer) < buffer_size:
+            buffer.append(item)
+        else:
+            j = rng.randint(len(buffer))
+            yield buffer[j]
+            buffer[j] = item
+    for j in rng.permutation(len(buffer)):
+        yield buffer[j]
+
+
+class BucketBatchSampler(Sampler):
+    """Batches documents of similar size under a budget of padded sentences and/or padded tokens per batch.
+    A batch of n documents costs n * (its largest sentence count) sentences and that times its longest sentence in tokens,
+    i.e. the shape `collate_features` pads it to. A document over budget on its own becomes a batch of one.
+
+    Training (shuffle=True): the documents are sorted by size and cut into buckets of `bucket_size` neighbours,
+    shuffled within each bucket, packed into batches, and the batches are shuffled; call `set_epoch` every epoch.
+    Evaluation (shuffle=False): the documents are packed in order of size.
+    With `num_replicas` > 1 each rank takes every num_replicas-th batch, the list being padded so that all ranks run the same number of steps.
+    """
+
+    def __init__(self, num_sentences, sentence_length, max_sentences=0, max_tokens=0, shuffle=False, bucket_size=100, num_replicas=1, rank=0, seed=0):
+        if max_sentences <= 0 and max_tokens <= 0:
+            raise ValueError("BucketBatchSampler needs a sentence or a token budget")
+        self.num_sentences = np.maximum(np.asarray(num_sentences, dtype=np.int64), 1)
+        self.sentence_length = np.maximum(np.asarray(sentence_length, dtype=np.int64), 1)
+        self.max_sentences = max_sentences
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.set_epoch(0)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.batches = self.make_batches()
+
+    def make_batches(self):
+        order = np.lexsort((self.sentence_length, self.num_sentences)) # by sentence count, then by length
+        rng = np.random.RandomState(self.seed + self.epoch)
+        if self.shuffle:
+            order = np.concatenate([rng.permutation(order[start:start + self.bucket_size]) for start in range(0, len(order), self.bucket_size)] or [order])
+
+        batches = []
+        batch, batch_sentences, batch_length = [], 0, 0
+        for index in order.tolist():
+            sentences = max(batch_sentences, int(self.num_sentences[index]))
+            length = max(batch_length, int(self.sentence_length[index]))
+            over_budget = (self.max_sentences > 0 and (len(batch) + 1) * sentences > self.max_sentences) or \
+                (self.max_tokens > 0 and (len(batch) + 1) * sentences * length > self.max_tokens)
+            if batch and over_budget:
+                batches.append(batch)
+                batch, sentences, length = [], int(self.num_sentences[index]), int(self.sentence_length[index])
+            batch.append(index)
+            batch_sentences, batch_length = sentences, length
+        if batch:
+            batches.append(batch)
+
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        if self.num_replicas > 1:
+            num_per_replica = -(-len(batches) // self.num_replicas)
+            batches += [batches[i % len(batches)] for i in range(num_per_replica * self.num_replicas - len(batches))]
+            batches = batches[self.rank::self.num_replicas]
+        return batches
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+def sentence_packing(lengths, pack_length):
+    """Next-fit packing of the sentences of at most `pack_length` tokens one after the other into rows of `pack_length` tokens,
+    a sentence opening a new row when it does not fit behind the previous one. Returns pack_sent and pack_token [num_rows, pack_length],
+    the sentence and the position in it of every column of the rows (-1 and 0 for the padding), and long_sent, the longer sentences."""
+    lengths = np.asarray(lengths, dtype=np.int64)
+    fits = lengths <= pack_length
+    fit_sent = np.flatnonzero(fits)
+    rows, offsets, row, offset = np.zeros(len(fit_sent), dtype=np.int64), np.zeros(len(fit_sent), dtype=np.int64), -1, 0
+    for i, length in enumerate(lengths[fit_sent].tolist()):
+        if row < 0 or offset + length > pack_length:
+            row, offset = row + 1, 0
+        rows[i], offsets[i] = row, offset
+        offset += length
+    pack_sent = np.full([row + 1, pack_length], -1, dtype=np.int64)
+    pack_token = np.zeros([row + 1, pack_length], dtype=np.int64)
+    fit_lengths = lengths[fit_sent]
+    token = np.arange(fit_lengths.sum()) - np.repeat(np.cumsum(fit_lengths) - fit_lengths, fit_lengths)
+    row, column = np.repeat(rows, fit_lengths), np.repeat(offsets, fit_lengths) + token
+    pack_sent[row, column] = np.repeat(fit_sent, fit_lengths)
+    pack_token[row, column] = token
+    return pack_sent, pack_token, np.flatnonzero(~fits)
+
+
+def collate_features(batch, pack_length=0):
+    """Stacks a batch of `FeatureDataset` items into long tensors, padded only as far as the batch needs it:
+    the sentence rows are cut to the largest (truncated) mention size of the batch and the token columns to those
+    holding a real token in at least one of the kept sentences, so the shapes follow the data rather than max_size x max_length.
+    Returns (example_id, mention_size, pad_token_label_id, input_ids, input_dependent, attention_mask, token_labels,
+    sent_label, rel_triples, window_start), the attention mask being rebuilt from the token spans and the relation triples concatenated
+    into one [num_rel, 4] tensor of (document index in the batch, head, tail, relation id).
+    With a `pack_length`, the `sentence_packing` of the real sentences of the documents, numbered one document after the other,
+    follows as (pack_sent, pack_token, long_sent).
+    """
+    fields = list(zip(*batch))
+    example_id, mention_size, pad_token_label_id, input_ids, input_dependent, input_span, token_labels, sent_label, window_start = [np.stack(field) for field in fields[:-1]]
+    num_rows = max(1, int(np.minimum(mention_size, input_span.shape[1]).max()))
+    input_span = input_span[:, :num_rows].astype(np.int64)
+    # the real tokens of a sentence are contiguous, so the columns holding one are a single span whichever side is padded
+    real = input_span[..., 1] > input_span[..., 0]
+    columns = slice(int(input_span[..., 0][real].min()), int(input_span[..., 1][real].max())) if real.any() else slice(0, 1)
+    positions = np.arange(columns.start, columns.stop)
+    attention_mask = (positions >= input_span[..., :1]) & (positions < input_span[..., 1:])
+
+    def widen(array):
+        return torch.from_numpy(np.ascontiguousarray(array, dtype=np.int64))
+
+    rel_triples = np.concatenate([np.concatenate([np.full([len(triples), 1], i, dtype=np.int64), np.asarray(triples, dtype=np.int64)], axis=1) for i, triples in enumerate(fields[-1])], axis=0)
+    packing = ()
+    if pack_length:
+        if columns.start > 0:
+            raise ValueError("Sentence packing needs the padding on the right of the sentences")
+        real_rows = np.arange(num_rows) < np.minimum(mention_size, num_rows)[:, None]
+        lengths = input_span[..., 1] - input_span[..., 0]
+        packing = tuple(widen(array) for array in sentence_packing(lengths[real_rows], pack_length))
+    return (
+        widen(example_id),
+        widen(mention_size),
+        widen(pad_token_label_id),
+        widen(input_ids[:, :num_rows, columns]),
+        widen(input_dependent[:, :num_rows, columns]),
+        widen(attention_mask),
+        widen(token_labels[:, :num_rows, columns]),
+        widen(sent_label[:, :num_rows]),
+        widen(rel_triples),
+        widen(window_start),
+    ) + packing
 
-            example_id = example_id_map[example.example_id]
-            
-            list_input_ids.append(input_ids)
-            list_input_dependent.append(input_dependent)
-            list_attention_mask.append(attention_mask)
-            list_token_type_ids.append(token_type_ids)
-            list_label4token_ids.append(label4token_ids)
-            label4sent_id = label4sent_map[example.list_sent_label[i]]
-            list_label4sent_ids.append(label4sent_id)
-
-        # padding or truncation
-        if example.mention_size <= max_size: # padding 
-            for i in range(example.mention_size, max_size):
-                list_input_ids.append([pad_token] * max_length)
-                list_input_dependent.append([pad_token] * max_length)
-                list_attention_mask.append([0 if mask_padding_with_zero else 1] * max_length)
-                list_token_type_ids.append([pad_token_segment_id] * max_length)
-                list_label4token_ids.append([pad_token_label_id] * max_length)
-                list_label4sent_ids.append(len(label4sent_map))
-        else: # truncation
-            list_input_ids = list_input_ids[:max_size]
-            list_input_dependent = list_input_dependent[:max_size]
-            list_attention_mask = list_attention_mask[:max_size]  
-            list_token_type_ids = list_token_type_ids[:max_size] 
-            list_label4token_ids = list_label4token_ids[:max_size]  
-            list_label4sent_ids = list_label4sent_ids[:max_size]
-
-        assert len(list_input_ids) == max_size
-        assert len(list_input_dependent) == max_size
-        assert len(list_attention_mask) == max_size
-        assert len(list_input_ids) == max_size
-        assert len(list_token_type_ids) == max_size
-        assert len(list_label4token_ids) == max_size
-        assert len(list_label4sent_ids) == max_size
-        assert len(mat_rel_label_ids) == max_size
-        assert len(mat_rel_label_ids[0]) == max_size 
-
-        features.append(InputFeatures(example_id=example_id, mention_size=example.mention_size, pad_token_label_id=pad_token_label_id, list_input_ids=list_input_ids, list_input_dependent=list_input_dependent, list_input_mask=list_attention_mask, list_segment_ids=list_token_type_ids, list_token_labels=list_label4token_ids, list_sent_label=list_label4sent_ids, mat_rel_label=mat_rel_label_ids))
-
-        if ex_index < 2:
-                logger.info("**** Example ****")
-                logger.info("example_id: {}".format(example.example_id))
-                logger.info("mention_size: {}".format(example.mention_size))
-                logger.info("pad_token_label_id: {}".format(pad_token_label_id))
-                logger.info("list_input_ids: {}".format(" ".join(map(str, list_input_ids))))
-                logger.info("list_input_dependent: {}".format(" ".join(map(str, list_input_dependent))))
-                logger.info("list_input_mask: {}".format(" ".join(map(str, list_attention_mask))))
-                logger.info("list_segment_ids: {}".format(" ".join(map(str, list_token_type_ids))))
-                logger.info("list_token_labels: {}".format(" ".join(map(str, list_label4token_ids))))
-                logger.info("list_sent_label: {}".format(" ".join(map(str, list_label4sent_ids))))
-                logger.info("mat_rel_label: {}".format(" ".join(map(str, mat_rel_label_ids))))
-    return features
-    
 
 processors = {"ontoevent-doc": OntoEventProcessor, "maven-ere": MAVENEREProcessor} # other dataset can also be used here
 
@@ -591,4 +1668,7 @@ ONTOEVENT_LABEL_PATH = "./Datasets/OntoEvent-Doc/event_dict_label_data.json"
 # # file path for the json data contains all ontoevent event type labels
 
 MAVENERE_EXAMPLE_ID_PATH = "./Datasets/MAVEN_ERE/map_exid_to_docid.json" 
-MAVENERE_MENTION_ID_PATH = "./Datasets/MAVEN_ERE/map_docid_to_mentionids.json" 
\ No newline at end of file
+MAVENERE_MENTION_ID_PATH = "./Datasets/MAVEN_ERE/map_docid_to_mentionids.json" 
+
+FEATURE_CACHE_VERSION = 5
+FEATURE_CACHE_META = "meta.json"
@@ -7,6 +7,7 @@ import logging
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from torch.nn import CrossEntropyLoss
 from torchmetrics import HingeLoss
 from transformers import BertPreTrainedModel, BertModel, RobertaPreTrainedModel, RobertaModel, XLNetPreTrainedModel, XLNetModel, DistilBertPreTrainedModel, DistilBertModel
@@ -15,7 +16,6 @@ from collections import OrderedDict, namedtuple, defaultdict
 import dgl
 import dgl.nn.pytorch as dglnn
 
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 logger = logging.getLogger(__name__)
 
 relation_map_ontoevent = {'BEFORE': 1, 'AFTER': 2, 'EQUAL': 3, 'CAUSE': 4, 'CAUSEDBY': 5, 'COSUPER': 6, 'SUBSUPER': 7, 'SUPERSUB': 8}
@@ -29,6 +29,139 @@ NA_REL_WEIGHT_TEMP = 0.3
 NA_REL_WEIGHT_CAUSAL = 0.02
 NA_REL_WEIGHT_SUB = 0.01
 
+# the real sentences of a batch of documents padded to [batch_size, max_mention_size] rows:
+# sizes [batch_size] the real sentences of every document, offsets [batch_size+1] where they start once concatenated,
+# index [num_mention] their rows in the padded layout flattened to [batch_size*max_mention_size]
+RaggedBatch = namedtuple("RaggedBatch", ["sizes", "offsets", "index"])
+
+
+def ragged_batch(mention_size, max_mention_size, device):
+    sizes = mention_size.to(device).long().clamp(max=max_mention_size)
+    offsets = F.pad(torch.cumsum(sizes, 0), (1, 0))
+    rows = torch.arange(max_mention_size, device=device)
+    index = (torch.arange(sizes.size(0), device=device).unsqueeze(1) * max_mention_size + rows)[rows < sizes.unsqueeze(1)]
+    return RaggedBatch(sizes, offsets, index)
+
+
+def sentence_pairs(ragged, max_mention_size):
+    """ The sentence pairs scored by the Document head, as (doc, head, tail) index tensors:
+        (i, j) with i != j in row-major order for each doc, or the single (0, 0) pair of a doc with one mention.
+    """
+    rows = torch.arange(max_mention_size, device=ragged.sizes.device)
+    size = ragged.sizes.view(-1, 1, 1)
+    head, tail = rows.view(1, -1, 1), rows.view(1, 1, -1)
+    pairs = ((head < size) & (tail < size) & (head != tail)) | ((size == 1) & (head == 0) & (tail == 0))
+    return torch.nonzero(pairs, as_tuple=True)
+
+
+class SentencePairs(object):
+    """ The features [h_i, h_j, h_i*h_j(, h_i-h_j)] of the sentence pairs (doc, head, tail) of a [batch_size, max_size, hidden_size] sent_embed,
+        never materialized as a whole [num_pairs, dim_expand*hidden_size] tensor.
+        factorized: a Linear over them is split into projections of every sentence, computed once and added per pair, and a bilinear form
+        with a diagonal matrix per output for h_i*h_j, computed per doc. The memory is O(num_sent*hidden_size*num_outputs + max_size^2*num_outputs)
+        per doc instead of O(max_size^2*hidden_size).
+        tile_size: the features are materialized tile_size pairs at a time, and recomputed in the backward pass rather than kept,
+        so that the memory of the features does not grow with the number of pairs. When factorized, only the h_i*h_j products are,
+        the projections of the sentences being computed once for all the tiles.
+    """
+    def __init__(self, sent_embed, doc, head, tail, dim_expand, factorized=True, tile_size=0):
+        self.sent_embed = sent_embed
+        self.doc, self.head, self.tail = doc, head, tail
+        self.dim_expand = dim_expand
+        self.factorized = factorized
+        self.tile_size = tile_size
+
+    def __len__(self):
+        return self.doc.size(0)
+
+    def features(self, doc, head, tail):
+        t1, t2 = self.sent_embed[doc, head], self.sent_embed[doc, tail]
+        return torch.cat([t1, t2, torch.mul(t1, t2), t1 - t2][:self.dim_expand], dim=-1)
+
+    def linear_tile(self, doc, head, tail, weight, bias):
+        return F.linear(self.features(doc, head, tail), weight, bias)
+
+    def product_tile(self, doc, head, tail, weight):
+        return F.linear(self.sent_embed[doc, head] * self.sent_embed[doc, tail], weight)
+
+    def tiled(self, function, *params):
+        """ function(doc, head, tail, *params) of all the pairs, tile_size pairs at a time """
+        list_scores = []
+        for start in range(0, len(self), self.tile_size):
+            tile = slice(start, start + self.tile_size)
+            if torch.is_grad_enabled():
+                list_scores.append(checkpoint(function, self.doc[tile], self.head[tile], self.tail[tile], *params, use_reentrant=False))
+            else:
+                list_scores.append(function(self.doc[tile], self.head[tile], self.tail[tile], *params))
+        return torch.cat(list_scores, dim=0)
+
+    def linear(self, weight, bias=None):
+        """ F.linear(pair features, weight, bias), weight [num_outputs, dim_expand*hidden_size] """
+        tiled = self.tile_size and len(self) > self.tile_size
+        if not self.factorized:
+            return self.tiled(self.linear_tile, weight, bias) if tiled else self.linear_tile(self.doc, self.head, self.tail, weight, bias)
+        batch_size, max_mention_size, hidden_size = self.sent_embed.size()
+        blocks = weight.split(hidden_size, dim=1)
+        head_proj = torch.matmul(self.sent_embed, blocks[0].t()) # [batch_size, max_size, num_outputs]
+        tail_proj = torch.matmul(self.sent_embed, blocks[1].t())
+        if self.dim_expand == 4:
+            diff_proj = torch.matmul(self.sent_embed, blocks[3].t())
+            head_proj, tail_proj = head_proj + diff_proj, tail_proj - diff_proj
+        scores = head_proj[self.doc, self.head] + tail_proj[self.doc, self.tail]
+        if self.dim_expand >= 3 and tiled:
+            scores = scores + self.tiled(self.product_tile, blocks[2])
+        elif self.dim_expand >= 3:
+            # h_i^T diag(w_r) h_j of all the sentence pairs of every doc, [batch_size, max_size, num_outputs, max_size]
+            weighted = self.sent_embed.unsqueeze(2) * blocks[2]
+            product = torch.matmul(weighted.view(batch_size, -1, hidden_size), self.sent_embed.transpose(1, 2)).view(batch_size, max_mention_size, -1, max_mention_size)
+            scores = scores + product[self.doc, self.head, :, self.tail]
+        if bias is not None:
+            scores = scores + bias
+        return scores
+
+
+# the relation ids of every relation family, NA first, a relation's position in the list being its label within the family
+RELATION_FAMILIES = {
+    "maven-ere": OrderedDict([("temporal", [0, 1, 2, 3, 4, 5, 6]), ("causal", [0, 7, 8]), ("sub", [0, 9]), ("corref", [0, 10])]),
+    "ontoevent-doc": OrderedDict([("temporal", [0, 1, 2, 3]), ("causal", [0, 4, 5]), ("sub", [0, 6, 7, 8])]),
+}
+
+
+# energies of the Token, Sentence and Document heads, label_vec being one-hot labels or predicted label scores
+def one_hot(labels, num_labels):
+    return F.one_hot(labels.long(), num_labels).float()
+
+
+def local_energy(mat_local, embed, label_vec):
+    """ sum over all items of <label_vec, mat_local @ embed>, embed [..., hidden_size], label_vec [..., num_labels] """
+    return torch.einsum("...h,th,...t->", embed, mat_local, label_vec)
+
+
+def transition_energy(mat_label, label_vec):
+    """ sum over all pairs of neighbouring tokens of y_i^T @ mat_label @ y_{i+1}, label_vec [num_sent, max_seq_length, num_labels] """
+    return torch.einsum("nis,st,nit->", label_vec[:, :-1], mat_label, label_vec[:, 1:])
+
+
+def label_energy(vec_label, mat_label, label_vec, weight=None):
+    """ sum over all items of vec_label^T @ sigmoid(mat_label @ y), label_vec [num_items, num_labels], weighted by weight [num_items] if given """
+    label_scores = torch.sigmoid(label_vec @ mat_label.t())
+    if weight is not None:
+        label_scores = label_scores * weight.unsqueeze(1)
+    return torch.einsum("t,nt->", vec_label.view(-1), label_scores)
+
+
+def weighted_hinge_loss(logits, labels, weight):
+    """ the Crammer-Singer hinge loss of torchmetrics' HingeLoss, max(0, 1 - s_y + max_{c != y} s_c), averaged with weight [num_items] """
+    target = F.one_hot(labels.long(), logits.size(-1)).bool()
+    margin = logits[target] - logits.masked_fill(target, float("-inf")).max(-1)[0]
+    return torch.sum(torch.clamp(1 - margin, min=0) * weight) / torch.sum(weight)
+
+
+def energy_hinge_loss(margin, energy_gold, energy_pred):
+    """ max(0, margin + E(gold) - E(pred)), computed on the device and kept in the autograd graph """
+    return torch.clamp(margin + energy_gold - energy_pred, min=0)
+
+
 class RelGraphConvLayer(nn.Module):
     def __init__(self,
                  in_feat,
@@ -100,10 +233,15 @@ class SPEECH_DistilBert(DistilBertPreTrainedModel): # BertPreTrainedModel, Rober
     def __init__(self, config):
         super().__init__(config)
         self.lm = DistilBertModel(config) # BertModel,RobertaModel,XLNetModel,DistilBertModel 
+        # sentences longer than encoder_max_length tokens are encoded in overlapping windows, 0 encodes them whole
+        self.encoder_max_length = getattr(config, "encoder_max_length", 0)
+        self.token_window_stride = getattr(config, "token_window_stride", 0)
+        # short sentences are packed into shared encoder rows of pack_length tokens, 0 encodes every sentence in a row of its own
+        self.pack_length = getattr(config, "pack_length", 0)
         self.num_labels4token = config.num_labels # 数据集中句子的事件类型个数+None+NAME_NON_TRIGGER+NAME_PADDING  103
         self.num_labels4sent = config.num_labels - 2 # 数据集中句子的事件类型个数+None  101
         self.relation_size = dict_num_sent2rel[config.num_labels] + 1 # +1 for NA
-        self.maxpooling = nn.MaxPool1d(128) # 构建一个池化层 定义池化层大小为128
+        self.maxpooling = nn.AdaptiveMaxPool1d(1) # 池化层, 对每个句子的所有token取最大值, 不依赖于序列长度
         # self.hidden_dropout_prob = config.hidden_dropout_prob
         self.hidden_dropout_prob = 0.2  # 随机杀死百分之二十的神经元
         self.dropout = nn.Dropout(self.hidden_dropout_prob)
@@ -120,6 +258,7 @@ class SPEECH_DistilBert(DistilBertPreTrainedModel): # BertPreTrainedModel, Rober
         self.ratio_loss_doc_plus = 1 # \mu_3 
         self.ratio_loss_doc = 0.1 # \lambda_3
         self.attention = Attention(config.hidden_size, 2)
+        self.attention_proj = nn.Linear(config.hidden_size * 2, config.hidden_size) # the 2 heads of self.attention back to hidden_size
         self.selfattention = SelfAttention(config.hidden_size, 8)
         print("*"*20, "Speech", "*"*20)
         print("self.ratio_loss_token_plus", self.ratio_loss_token_plus)
@@ -137,121 +276,145 @@ class SPEECH_DistilBert(DistilBertPreTrainedModel): # BertPreTrainedModel, Rober
         # classes of subtasks
         self.token = Token(self.num_labels4token, config.hidden_size, self.hidden_dropout_prob, self.ratio_loss_token_plus) # hidden_size(隐藏层维度,隐藏层的神经元个数)
         self.sent = Sentence(self.num_labels4sent, config.hidden_size, self.hidden_dropout_prob, self.ratio_loss_sent_plus) 
-        self.doc = Document(self.relation_size, config.hidden_size, self.hidden_dropout_prob, self.ratio_loss_doc_plus)
+        self.doc = Document(self.relation_size, config.hidden_size, self.hidden_dropout_prob, self.ratio_loss_doc_plus, getattr(config, "pair_scoring", "concat"), getattr(config, "pair_memory_mb", 0),
+            getattr(config, "na_pair_ratio", 0), getattr(config, "max_na_pairs", 0))
 
         self.init_weights()
     
-    def get_pos_in_batch(num, list_num, max_mention_size):
-        """ num: the reconstructed pos in the real batch (the real batch size is a sum of real mention sizes) 
-            list_num: the list of real mention size
-            max_mention_size: the maximum number of event mentions in one doc 
-            return: the pos index in the padding normalized batch whose size is [batch_size, max_size] 
-        """
-        batch_size = list_num.size(0)
-        if batch_size == 1 or num <= list_num[0].item():
-           return 0, num
-        sum_num = 0
-        for i in range(batch_size-1):
-            sum_num += min(list_num[i].item(), max_mention_size) 
-            if sum_num < num <= sum_num + min(list_num[i+1].item(), max_mention_size):
-                return i+1, num - sum_num - 1
-         
-    def forward(self, example_id=None, task_name=None, doc_ere_task_type=None, max_mention_size=None, pad_token_label_id=None, input_ids=None, input_dependent=None, attention_mask=None, token_type_ids=None, position_ids=None, head_mask=None, inputs_embeds=None, mention_size=None, labels4token=None, labels4sent=None, mat_rel_label=None):
-        batch_size = int(input_ids.size(0) / max_mention_size[0].item())
+    def encode(self, input_ids, attention_mask=None, head_mask=None, inputs_embeds=None, sentence_pack=None):
+        if self.pack_length and sentence_pack is not None and inputs_embeds is None:
+            return self.encode_packed(input_ids, attention_mask, sentence_pack, head_mask=head_mask)
+        return self.encode_windows(input_ids, attention_mask=attention_mask, head_mask=head_mask, inputs_embeds=inputs_embeds)
+
+    def encode_packed(self, input_ids, attention_mask, sentence_pack, head_mask=None):
+        """Encodes the sentences packed into rows of pack_length tokens as planned by data_utils.sentence_packing at collate time,
+        (pack_sent, pack_token, long_sent), with a block-diagonal attention mask and the positions restarting at every sentence,
+        and unpacks the token embeddings. The DistilBERT layers are run one by one, as the model itself takes neither position ids
+        nor a mask per query; each sentence is encoded as in a row of its own, the longer ones go through encode_windows."""
+        pack_sent, pack_token, long_sent = sentence_pack
+        num_sent, max_seq_length = input_ids.size()
+        num_rows = pack_sent.size(0)
+        token_embed = self.lm.embeddings.word_embeddings.weight.new_zeros([num_sent, max_seq_length, self.config.hidden_size])
+        if num_rows > 0:
+            packed = pack_sent >= 0
+            sent = pack_sent.clamp(min=0)
+            packed_ids = torch.where(packed, input_ids[sent, pack_token], input_ids.new_full([1], self.config.pad_token_id or 0))
+            embeddings = self.lm.embeddings
+            hidden = embeddings.dropout(embeddings.LayerNorm(embeddings.word_embeddings(packed_ids) + embeddings.position_embeddings(pack_token)))
+            block_mask = (pack_sent.unsqueeze(2) == pack_sent.unsqueeze(1)).unsqueeze(1) # [rows, 1, pack_length, pack_length], the padding forms a block of its own
+            head_masks = self.lm.get_head_mask(head_mask, self.config.num_hidden_layers)
+            for layer, layer_head_mask in zip(self.lm.transformer.layer, head_masks): # the DistilBERT TransformerBlock, with the block-diagonal mask
+                attention = layer.attention
+                heads = lambda x: x.view(num_rows, -1, attention.n_heads, attention.dim // attention.n_heads).transpose(1, 2)
+                context = F.scaled_dot_product_attention(
+                    heads(attention.q_lin(hidden)),
+                    heads(attention.k_lin(hidden)),
+                    heads(attention.v_lin(hidden)),
+                    attn_mask=block_mask,
+                    dropout_p=attention.dropout.p if self.training else 0.0,
+                )
+                if layer_head_mask is not None: # [1, n_heads, 1, 1], scales the attention weights of every head and so its context
+                    context = context * layer_head_mask
+                hidden = layer.sa_layer_norm(attention.out_lin(context.transpose(1, 2).reshape(num_rows, -1, attention.dim)) + hidden)
+                hidden = layer.output_layer_norm(layer.ffn(hidden) + hidden)
+            # the padding columns all go to one spare row, dropped afterwards
+            targets = torch.where(packed, sent * max_seq_length + pack_token, pack_sent.new_full([1], num_sent * max_seq_length))
+            token_embed = hidden.new_zeros([num_sent * max_seq_length + 1, hidden.size(-1)]).index_copy(0, targets.view(-1), hidden.reshape(-1, hidden.size(-1)))
+            token_embed = token_embed[:-1].view(num_sent, max_seq_length, -1)
+        if long_sent.numel() > 0:
+            long_embed = self.encode_windows(input_ids[long_sent], attention_mask=attention_mask[long_sent], head_mask=head_mask)[0]
+            token_embed = token_embed.index_copy(0, long_sent, long_embed.to(token_embed.dtype))
+        return (token_embed,)
+
+    def encode_windows(self, input_ids, attention_mask=None, head_mask=None, inputs_embeds=None):
+        """Runs the encoder on sentences longer than encoder_max_length as overlapping windows of encoder_max_length tokens,
+        all encoded in one batch, and averages the embeddings of every token over the windows holding it.
+        Every window is [CLS] + a slice of the sentence + [SEP], so a sentence of at most encoder_max_length tokens is encoded
+        exactly as without windows; the [CLS] added to the later windows and the [SEP] added to the earlier ones are dropped."""
+        window_length = self.encoder_max_length
+        if not window_length or input_ids.size(1) <= window_length:
+            return self.lm(input_ids, attention_mask=attention_mask, head_mask=head_mask, inputs_embeds=inputs_embeds)
+        num_sent, max_seq_length = input_ids.size()
+        inner_length = window_length - 2
+        stride = min(self.token_window_stride or max(inner_length // 2, 1), inner_length)
+        lengths = attention_mask.long().sum(1) # the padding is on the right
+        sep_ids = input_ids.gather(1, (lengths - 1).clamp(min=0).unsqueeze(1))
+        pad_ids = torch.full_like(sep_ids, self.config.pad_token_id or 0)
+        last_start = max_seq_length - window_length
+        window_ids, window_mask, window_targets = [], [], []
+        end = -1 # the position of the last column of the previous window
+        for start in list(range(0, last_start, stride)) + [last_start]:
+            # a sentence takes the next window only while it goes on after the previous one
+            rows = torch.nonzero(lengths - 1 > end, as_tuple=True)[0]
+            if rows.numel() == 0:
+                break
+            end = start + window_length - 1
+            content = slice(start + 1, end)
+            continues = (lengths[rows] - 1 > end).unsqueeze(1)
+            ends = (lengths[rows] - 1 == end).unsqueeze(1) # the [SEP] of the sentence falls on the last column
+            window_ids.append(torch.cat([input_ids[rows, :1], input_ids[rows, content], torch.where(continues | ends, sep_ids[rows], pad_ids[rows])], dim=1))
+            window_mask.append(torch.cat([attention_mask[rows, :1], attention_mask[rows, content], (continues | ends).to(attention_mask.dtype)], dim=1))
+            # the flat position of every window column in the sentences, -1 for the [CLS] and [SEP] added for the window only
+            targets = rows.unsqueeze(1) * max_seq_length + torch.arange(start, end + 1, device=input_ids.device)
+            if start > 0:
+                targets[:, 0] = -1
+            targets[:, -1] = torch.where(ends[:, 0], targets[:, -1], targets.new_full([1], -1))
+            window_targets.append(targets)
+        window_mask = torch.cat(window_mask)
+        hidden = self.lm(torch.cat(window_ids), attention_mask=window_mask, head_mask=head_mask)[0]
+        targets = torch.cat(window_targets).view(-1)
+        keep = (targets >= 0) & (window_mask.view(-1) > 0)
+        hidden = hidden.reshape(-1, hidden.size(-1))[keep]
+        targets = targets[keep]
+        merged = hidden.new_zeros([num_sent * max_seq_length, hidden.size(-1)]).index_add_(0, targets, hidden)
+        counts = hidden.new_zeros([num_sent * max_seq_length]).index_add_(0, targets, hidden.new_ones([targets.size(0)]))
+        merged = merged / counts.clamp(min=1).unsqueeze(1)
+        return (merged.view(num_sent, max_seq_length, -1),)
+
+    def forward(self, example_id=None, task_name=None, doc_ere_task_type=None, max_mention_size=None, pad_token_label_id=None, input_ids=None, input_dependent=None, attention_mask=None, token_type_ids=None, position_ids=None, head_mask=None, inputs_embeds=None, mention_size=None, labels4token=None, labels4sent=None, rel_triples=None, sentence_pack=None):
         num_or_max_mention = max_mention_size[0].item()
+        batch_size = mention_size.size(0)
         max_seq_length = input_ids.size(1)
-        if_special = 0
-        if batch_size < math.ceil(input_ids.size(0) / max_mention_size[0].item()): # abnormal......may happen in the last batch?
-            if_special = 1 
-            batch_size = 1 # regard the rest samples exist in one batch, note that their labels, mention_size and doc_token_emb should also be reshaped
-            num_or_max_mention = input_ids.size(0)
-            real_batch_size = mat_rel_label.size(0)
-            real_max_mention = mat_rel_label.size(1)
-            mention_size_rebuilt = torch.ones([1], dtype=torch.long).to(device)
-            labels4token_rebuilt = (torch.ones([1, num_or_max_mention, max_seq_length], dtype=torch.long) * pad_token_label_id[0].item()).to(device)
-            labels4sent_rebuilt = (torch.ones([1, num_or_max_mention], dtype=torch.long) * pad_token_label_id[0].item()).to(device)
-            mat_rel_label_rebulit = torch.zeros([1, num_or_max_mention, num_or_max_mention], dtype=torch.long).to(device)  
-            count_num_mention = 0
-            for i in range(real_batch_size):
-                real_num_mention = min(mention_size[i].item(), real_max_mention)
-                real_num_mention = min(real_num_mention, num_or_max_mention)
-                real_num_mention = min(real_num_mention, num_or_max_mention - i*real_max_mention)
-                labels4token_rebuilt[0, count_num_mention: count_num_mention + real_num_mention, :] = labels4token[i, :real_num_mention, :]
-                labels4sent_rebuilt[0, count_num_mention: count_num_mention + real_num_mention] = labels4sent[i, :real_num_mention] 
-                mat_rel_label_rebulit[0, count_num_mention: count_num_mention + real_num_mention, count_num_mention: count_num_mention + real_num_mention] = mat_rel_label[i, :real_num_mention, :real_num_mention]
-                count_num_mention += real_num_mention 
-            mention_size_rebuilt[0] = count_num_mention 
-                      
-        outputs = self.lm(
-            input_ids,
-            attention_mask=attention_mask,
+        # the real sentences of the documents, built once and shared by the heads
+        ragged = ragged_batch(mention_size, num_or_max_mention, input_ids.device)
+        # only the real sentences are encoded, as one packed batch, the padding sentence rows keep zero embeddings
+        real_rows = ragged.index if inputs_embeds is None else torch.arange(input_ids.size(0), device=input_ids.device)
+        outputs = self.encode(
+            input_ids[real_rows],
+            attention_mask=attention_mask[real_rows],
             # token_type_ids=token_type_ids,
             # position_ids=position_ids,
             head_mask=head_mask,
             inputs_embeds=inputs_embeds,
+            sentence_pack=sentence_pack,
         )
+        if real_rows.size(0) < input_ids.size(0):
+            outputs = (outputs[0].new_zeros([input_ids.size(0), max_seq_length, outputs[0].size(-1)]).index_copy_(0, real_rows, outputs[0]),) + tuple(outputs[1:])
         input_dependent = input_dependent
         doc_token_embed = outputs[0].view(batch_size, num_or_max_mention, max_seq_length, -1) # [batch_size, max_size, max_length, hidden_size]
-        doc_token_embed_01 = doc_token_embed[0]
+        # the attention runs over the real sentences only, the padding rows are left as they are
+        doc_token_embed_01 = outputs[0][ragged.index]
         token_embed_real_update = doc_token_embed
-        doc_token_embed_01_real, token_dependent = self.attention(doc_token_embed_01, 128, input_dependent)
+        doc_token_embed_01_real, token_dependent = self.attention(doc_token_embed_01, max_seq_length, input_dependent[ragged.index])
         token_dependent = token_dependent.transpose(1, 2)
         doc_token_embed_01_real = torch.bmm(doc_token_embed_01_real.unsqueeze(2), token_dependent.float())
         doc_token_embed_01_real = doc_token_embed_01_real.transpose(1, 2)
-        linear_layer = nn.Linear(1536, 768).cuda()
-        doc_token_embed_01_real = doc_token_embed_01_real.to(linear_layer.weight.device)
-        doc_token_embed_01_real = linear_layer(doc_token_embed_01_real)
-        doc_token_embed_01_real = token_embed_real_update + doc_token_embed_01_real
+        doc_token_embed_01_real = self.attention_proj(doc_token_embed_01_real)
+        doc_token_embed_01_real = outputs[0].new_zeros(outputs[0].size()).index_copy(0, ragged.index, doc_token_embed_01_real)
+        doc_token_embed_01_real = token_embed_real_update + doc_token_embed_01_real.view_as(doc_token_embed)
         # doc_token_embed_01_real = doc_token_embed_01_real.unsqueeze(0).to("cuda:0")
 
-        if if_special == 1:
-            doc_token_embed_rebuilt = doc_token_embed.clone()
-            real_batch_size = mat_rel_label.size(0)
-            real_max_mention = mat_rel_label.size(1)
-            count_num_mention = 0 
-            for i in range(real_batch_size):
-                real_num_mention = min(mention_size[i].item(), real_max_mention)
-                real_num_mention = min(real_num_mention, num_or_max_mention)
-                real_num_mention = min(real_num_mention, num_or_max_mention - i*real_max_mention)
-                doc_token_embed_rebuilt[0, count_num_mention: count_num_mention + real_num_mention, :, :] = doc_token_embed[:, real_max_mention*i: real_max_mention*i + real_num_mention, :, :]
-                count_num_mention += real_num_mention 
-             
-            mention_size = mention_size_rebuilt
-            labels4token = labels4token_rebuilt
-            labels4sent = labels4sent_rebuilt 
-            mat_rel_label = mat_rel_label_rebulit
-            doc_token_embed = doc_token_embed_rebuilt.clone() 
-
         if labels4token is not None: 
-            loss_token, logits_token, token_labels_real, doc_token_embed_real, pred_token_embedding = self.token(doc_token_embed, labels4token, mention_size, attention_mask, pad_token_label_id, input_dependent) # 训练触发词的能量
+            loss_token, logits_token, token_labels_real, doc_token_embed_real, pred_token_embedding = self.token(doc_token_embed, labels4token, ragged, attention_mask, pad_token_label_id, input_dependent) # 训练触发词的能量
             outputs = (logits_token, token_labels_real,) + outputs[2:]
             # get sentence embedding
             # # for max_pooling
             # doc_sent_embed = self.maxpooling(doc_token_embed.view(batch_size*num_or_max_mention, max_seq_length, -1).transpose(1, 2)).contiguous().view(batch_size, num_or_max_mention, self.config.hidden_size)
             # doc_sent_embed = F.relu(doc_sent_embed) # [batch_size, max_size, hidden_size] 
             # # for task_based
-            embedding_dim = 768
-            # 获取当前的句子数
-            current_sentence_count = pred_token_embedding.size(0)
-
-            if current_sentence_count > max_mention_size:
-                # 裁剪多余的句子 embedding
-                sentence_trigger_embedding = pred_token_embedding[:max_mention_size, :]
-            elif current_sentence_count < max_mention_size:
-                # 计算需要填充的句子数
-                padding_count = max_mention_size - current_sentence_count
-
-                # 创建填充的零向量 [padding_count, 768]
-                padding_tensor = torch.zeros(padding_count, embedding_dim, device=pred_token_embedding.device)
-
-                # 拼接原始 embedding 和填充向量
-                sentence_trigger_embedding = torch.cat((pred_token_embedding, padding_tensor), dim=0)
-            else:
-                # 等于 max_mention_size 的情况，直接使用原始 embedding
-                sentence_trigger_embedding = pred_token_embedding
-
-            # 确保 sentence_trigger_embedding 已经被赋值
-            sentence_trigger_embedding = sentence_trigger_embedding.unsqueeze(0).unsqueeze(2)  # 形状变为 1 * 40 * 1 * 768
+            # the trigger embedding of every real sentence in its row of the padded layout, zero for the padding rows
+            sentence_trigger_embedding = pred_token_embedding.new_zeros([batch_size * num_or_max_mention, pred_token_embedding.size(-1)]).index_copy(0, ragged.index, pred_token_embedding)
+            sentence_trigger_embedding = sentence_trigger_embedding.view(batch_size, num_or_max_mention, 1, -1)  # [batch_size, max_size, 1, hidden_size]
 
             # Step 3: 在第 2 个维度拼接 (将 tensor2_expanded 拼接到 tensor1_reduced 的末尾)
             doc_token_embed_01_real = torch.cat((doc_token_embed_01_real, sentence_trigger_embedding), dim=2)
@@ -274,10 +437,11 @@ class SPEECH_DistilBert(DistilBertPreTrainedModel): # BertPreTrainedModel, Rober
             # # Reshape to get the final output
             # output = pooled_x.view(1, 50, 768)
             if self.aggr == "task_based": 
-                indices_trigger_token = (labels4token < self.num_labels4sent - 2).nonzero() # not non-trigger or padding 
-                for trigger_index in indices_trigger_token:
-                    if trigger_index[0] < doc_sent_embed.size(0) and trigger_index[1] < doc_sent_embed.size(1) and trigger_index[2] < max_seq_length:
-                        doc_sent_embed[trigger_index[0]][trigger_index[1]] = doc_token_embed[trigger_index[0]][trigger_index[1]][trigger_index[2]]
+                # a sentence takes the embedding of its last trigger token (not non-trigger or padding), the others keep theirs
+                is_trigger = labels4token < self.num_labels4sent - 2
+                last_trigger = torch.where(is_trigger, torch.arange(max_seq_length, device=labels4token.device), -1).max(-1)[0] # [batch_size, max_size]
+                trigger_embed = doc_token_embed.gather(2, last_trigger.clamp(min=0)[:, :, None, None].expand(-1, -1, 1, doc_token_embed.size(-1))).squeeze(2)
+                doc_sent_embed.copy_(torch.where((last_trigger >= 0).unsqueeze(-1), trigger_embed, doc_sent_embed))
             elif self.aggr == "mean" or self.aggr == "max":
                 for i in range(batch_size):
                     for j in range(num_or_max_mention):
@@ -292,23 +456,21 @@ class SPEECH_DistilBert(DistilBertPreTrainedModel): # BertPreTrainedModel, Rober
                 doc_sent_embed = F.relu(doc_sent_embed) # [batch_size, max_size, hidden_size]  
             # doc_sent_embed = self.dropout(doc_sent_embed)
             if labels4sent is not None:
-                loss_sent, logits_sent, labels_sent_real, proto_embed = self.sent(doc_sent_embed, labels4sent, mention_size, pred_token_embedding) # 句子能量训练
+                loss_sent, logits_sent, labels_sent_real, proto_embed = self.sent(doc_sent_embed, labels4sent, ragged, pred_token_embedding) # 句子能量训练
                 outputs = (logits_sent, labels_sent_real,) + outputs
-                if mat_rel_label is not None: 
+                if rel_triples is not None: 
                     if doc_ere_task_type != "doc_joint":
-                        loss_doc, logits_sentpair, labels_doc = self.doc(doc_sent_embed, mat_rel_label, mention_size, task_name, doc_ere_task_type, pred_token_embedding)
+                        loss_doc, logits_sentpair, labels_doc = self.doc(doc_sent_embed, doc_token_embed_01_real, rel_triples, ragged, task_name, doc_ere_task_type, sentence_trigger_embedding.squeeze(2))
                         outputs = (logits_sentpair, labels_doc,) + outputs
                     else:
                         if task_name == "maven-ere":
-                            loss_doc, logits_sentpair_temp, labels_sentpair_temporal, logits_sentpair_causal, labels_sentpair_causal, logits_sentpair_sub, labels_sentpair_sub, logits_sentpair_corref, labels_sentpair_corref = self.doc(doc_sent_embed, doc_token_embed_01_real, mat_rel_label, mention_size, task_name, doc_ere_task_type, pred_token_embedding, max_mention_size)
+                            loss_doc, logits_sentpair_temp, labels_sentpair_temporal, logits_sentpair_causal, labels_sentpair_causal, logits_sentpair_sub, labels_sentpair_sub, logits_sentpair_corref, labels_sentpair_corref = self.doc(doc_sent_embed, doc_token_embed_01_real, rel_triples, ragged, task_name, doc_ere_task_type, sentence_trigger_embedding.squeeze(2))
                             outputs = (logits_sentpair_temp, labels_sentpair_temporal, logits_sentpair_causal, labels_sentpair_causal, logits_sentpair_sub, labels_sentpair_sub, logits_sentpair_corref, labels_sentpair_corref,) + outputs 
                         else:
-                            loss_doc, logits_sentpair_temp, labels_sentpair_temporal, logits_sentpair_causal, labels_sentpair_causal, logits_sentpair_sub, labels_sentpair_sub = self.doc(doc_sent_embed, doc_token_embed_01_real, mat_rel_label, mention_size, task_name, doc_ere_task_type, pred_token_embedding, max_mention_size)
+                            loss_doc, logits_sentpair_temp, labels_sentpair_temporal, logits_sentpair_causal, labels_sentpair_causal, logits_sentpair_sub, labels_sentpair_sub = self.doc(doc_sent_embed, doc_token_embed_01_real, rel_triples, ragged, task_name, doc_ere_task_type, sentence_trigger_embedding.squeeze(2))
                             outputs = (logits_sentpair_temp, labels_sentpair_temporal, logits_sentpair_causal, labels_sentpair_causal, logits_sentpair_sub, labels_sentpair_sub,) + outputs 
                     loss_all = self.ratio_loss_token*loss_token + self.ratio_loss_sent*loss_sent + self.ratio_loss_doc*loss_doc
-                
-        torch.autograd.set_detect_anomaly(True)
-        
+
         outputs = (loss_all,) + outputs
             
         return outputs
@@ -321,19 +483,12 @@ class Token(nn.Module):
         self.ratio_loss_token_plus = ratio_loss_token_plus # 1
         self.dropout = nn.Dropout(hidden_dropout_prob)
         self.attention = Attention(hidden_size, 2)
+        self.attention_proj = nn.Linear(hidden_size * 2, hidden_size) # the 2 heads of self.attention back to hidden_size
         self.token_classifier = nn.Linear(hidden_size, self.tokentype_size) # 输入的神经元个数为hidden_size 输出的个数为103 只有一层隐藏层？
         # ？
-        self.mat_local4token = nn.Embedding(self.tokentype_size, hidden_size).to(device) # nn.Embedding((num_embeddings,embedding_dim) 字典大小为103，维度为768
-        self.mat_label4token = nn.Embedding(self.tokentype_size, self.tokentype_size).to(device) # 103,103
-
-    def get_para_vec_mat(self, para_type): # 获取参数向量图
-        mat_local4token = self.mat_local4token(torch.tensor(range(0, self.tokentype_size)).to(device))
-        mat_label4token = self.mat_label4token(torch.tensor(range(0, self.tokentype_size)).to(device))
-        if para_type == "mat_local":
-            return mat_local4token
-        else:
-            return mat_label4token 
-         
+        self.mat_local4token = nn.Embedding(self.tokentype_size, hidden_size) # nn.Embedding((num_embeddings,embedding_dim) 字典大小为103，维度为768
+        self.mat_label4token = nn.Embedding(self.tokentype_size, self.tokentype_size) # 103,103
+
     def calculate_prob(self, token_embed):
         # token_embed = self.dropout(token_embed)
         # logits_token = F.softmax(self.token_classifier(token_embed)) # 分类器
@@ -341,76 +496,41 @@ class Token(nn.Module):
         return logits_token # 18*128*103
 
     def token_energy_function(self, token_embed, token_y): # 词的能量计算
-        token_local_energy_temp = torch.matmul(self.get_para_vec_mat("mat_local"), token_embed.transpose(1, 2)) # 18*103*128  18*  token_embed  18*128*768
-        token_local_energy = torch.sum(torch.mul(token_y, token_local_energy_temp.transpose(1, 2)))
-        batch_size = token_y.size(0)
-        seq_length = token_y.size(1)
-        for i in range(seq_length-1):
-            token_label_energy = torch.sum(torch.matmul(torch.matmul(token_y[:, i, :], self.get_para_vec_mat("mat_label")), token_y[:, i+1, :].transpose(0, 1)))
-        token_energy = token_local_energy + token_label_energy
-        return token_energy
-    
-    def label2vec(self, label, label_size):
-        batch_size = label.size(0)
-        seq_len = label.size(1) 
-        label_vec = torch.zeros([batch_size, seq_len, label_size]).to(device)
-        for i in range(batch_size):
-            for j in range(seq_len):
-                label_vec[i][j][label[i][j]] = 1
-        return label_vec
+        return local_energy(self.mat_local4token.weight, token_embed, token_y) + transition_energy(self.mat_label4token.weight, token_y)
     
-    def get_the_real_token_task(self, token_embed, token_labels, mention_size, attention_mask, input_dependent): # 获得真实值
-        batch_size = token_embed.size(0)
-        max_mention_size = token_embed.size(1)
-        max_seq_length = token_embed.size(2) 
-        hidden_size = token_embed.size(3)
-        attention_mask = attention_mask.view(batch_size, max_mention_size, max_seq_length)
-        input_dependent = input_dependent.view(batch_size, max_mention_size, max_seq_length)
-        num_mention = 0
-        norm_mention_size = [max_mention_size] * batch_size 
-        for i in range(batch_size):
-           norm_mention_size[i] = min(mention_size[i].item(), max_mention_size) 
-           num_mention += norm_mention_size[i]
-        token_embed_real = torch.zeros([num_mention, max_seq_length, hidden_size], dtype=torch.float).to(device)
-        token_labels_real = torch.zeros([num_mention, max_seq_length], dtype=torch.long).to(device)
-        attention_mask_real = torch.zeros([num_mention, max_seq_length], dtype=torch.float).to(device)
-        token_dependent = torch.zeros([num_mention, max_seq_length], dtype=torch.float).to(device)
-        count_mention = 0
-        for i in range(batch_size):
-            token_embed_real[count_mention:count_mention+norm_mention_size[i], :, :] = token_embed[i, :norm_mention_size[i], :, :]
-            token_labels_real[count_mention:count_mention+norm_mention_size[i], :] = token_labels[i, :norm_mention_size[i], :]
-            attention_mask_real[count_mention:count_mention+norm_mention_size[i], :] = attention_mask[i, :norm_mention_size[i], :]
-            token_dependent[count_mention:count_mention+norm_mention_size[i], :] = input_dependent[i, :norm_mention_size[i], :]
-            count_mention += norm_mention_size[i]
+    def get_the_real_token_task(self, token_embed, token_labels, ragged, attention_mask, input_dependent): # 获得真实值
+        batch_size, max_mention_size, max_seq_length, hidden_size = token_embed.size()
+        token_embed_real = token_embed.reshape(batch_size * max_mention_size, max_seq_length, hidden_size)[ragged.index]
+        token_labels_real = token_labels.reshape(batch_size * max_mention_size, max_seq_length)[ragged.index].long()
+        attention_mask_real = attention_mask.view(batch_size * max_mention_size, max_seq_length)[ragged.index].float()
+        token_dependent = input_dependent.view(batch_size * max_mention_size, max_seq_length)[ragged.index].float()
         return token_embed_real, token_labels_real, attention_mask_real, token_dependent
 
-    def forward(self, token_embed, token_labels, mention_size, attention_mask, pad_token_label_id, input_dependent):
-        token_embed_real, token_labels_real, attention_mask_real, token_dependent= self.get_the_real_token_task(token_embed, token_labels, mention_size, attention_mask, input_dependent)
+    def forward(self, token_embed, token_labels, ragged, attention_mask, pad_token_label_id, input_dependent):
+        token_embed_real, token_labels_real, attention_mask_real, token_dependent= self.get_the_real_token_task(token_embed, token_labels, ragged, attention_mask, input_dependent)
         token_embed_real_update = token_embed_real
-        token_embed_real, token_dependent = self.attention(token_embed_real, 128, token_dependent)
+        token_embed_real, token_dependent = self.attention(token_embed_real, token_embed_real.size(1), token_dependent)
         token_dependent = token_dependent.transpose(1, 2)
         token_embed_real = torch.bmm(token_embed_real.unsqueeze(2), token_dependent.float())
         token_embed_real = token_embed_real.transpose(1, 2)
-        linear_layer = nn.Linear(1536, 768).cuda()
-        token_embed_real = token_embed_real.to(linear_layer.weight.device)
-        token_embed_real = linear_layer(token_embed_real)
+        token_embed_real = self.attention_proj(token_embed_real)
         token_embed_real = token_embed_real_update+token_embed_real #16,42,768
         logits_token = self.calculate_prob(token_embed_real)
 
         if token_labels_real is not None:
             loss_hinge = HingeLoss(ignore_index=pad_token_label_id[0].item()) # [self.tokentype_size-2, self.tokentype_size-1], self.tokentype_size-1==pad_token_label_id[0].item()
             loss_token_hinge = loss_hinge(logits_token.view(-1, self.tokentype_size), token_labels_real.view(-1))
-            label_vec = self.label2vec(token_labels_real, self.tokentype_size)
+            label_vec = one_hot(token_labels_real, self.tokentype_size)
             _, pred_token = torch.max(logits_token, dim=2)
-            pred_vec = self.label2vec(pred_token, self.tokentype_size) 
-            loss_token_energy = torch.max( torch.tensor([0, loss_token_hinge + self.token_energy_function(token_embed_real, label_vec) - self.token_energy_function(token_embed_real, pred_vec)], dtype=torch.float) ) # 触发词能量损失函数
+            pred_vec = one_hot(pred_token, self.tokentype_size) 
+            loss_token_energy = energy_hinge_loss(loss_token_hinge, self.token_energy_function(token_embed_real, label_vec), self.token_energy_function(token_embed_real, pred_vec)) # 触发词能量损失函数
 
             # # ignore redundant padding tokens
             logits_token = logits_token.view(-1, self.tokentype_size)
             token_labels_real = token_labels_real.view(-1)
             valid_token_indice = torch.nonzero(torch.ne(token_labels_real, pad_token_label_id[0].item()))[:, 0]
-            logits_token_valid = torch.zeros([valid_token_indice.size(0) + 2, self.tokentype_size], dtype=torch.float).to(device) 
-            token_labels_real_valid = torch.zeros([valid_token_indice.size(0) + 2], dtype=torch.long).to(device)
+            logits_token_valid = torch.zeros([valid_token_indice.size(0) + 2, self.tokentype_size], dtype=torch.float, device=logits_token.device) 
+            token_labels_real_valid = torch.zeros([valid_token_indice.size(0) + 2], dtype=torch.long, device=logits_token.device)
             logits_token_valid[[0, -1], :] = logits_token[[0, -1], :]
             token_labels_real_valid[[0, -1]] = token_labels_real[[0, -1]]
             if valid_token_indice.size(0) > 1:  
@@ -427,24 +547,9 @@ class Token(nn.Module):
             sent_size, seq_len, embedding_dim = token_embed_real.size()
             pred_token = pred_token.view(sent_size, seq_len)  # [16, 42]
 
-            # 初始化一个张量来存储最终的触发词 embedding
-            sentence_trigger_embedding = torch.zeros(sent_size, embedding_dim, device=token_embed_real.device)
-
-            # 遍历每个句子，提取预测的触发词 embedding
-            for i in range(sent_size):
-                sentence_embedding = token_embed_real[i]  # 当前句子的 embedding [42, 768]
-                predicted_classes = pred_token[i]  # 当前句子的预测类别 [42]
-
-                # 找到 logits 最大值的触发词位置 (例如，选择前 k 个最高概率的词也可以)
-                trigger_indices = (predicted_classes != pad_token_label_id[0].item()).nonzero(
-                    as_tuple=False).squeeze()  # 排除 padding
-
-                if trigger_indices.numel() > 0:  # 如果有触发词
-                    trigger_embeddings = sentence_embedding[trigger_indices]  # 提取对应触发词 embedding
-                    sentence_trigger_embedding[i] = trigger_embeddings.mean(dim=0)  # 聚合: 平均池化
-                else:
-                    sentence_trigger_embedding[i] = torch.zeros(embedding_dim,
-                                                                device=token_embed_real.device)  # 无触发词返回零向量
+            # 每个句子预测的触发词 (排除 padding) 的 embedding 平均池化, 无触发词返回零向量
+            is_trigger = (pred_token != pad_token_label_id[0]).unsqueeze(-1).to(token_embed_real.dtype)
+            sentence_trigger_embedding = (token_embed_real * is_trigger).sum(1) / is_trigger.sum(1).clamp(min=1)
 
         return loss_token, logits_token_valid, token_labels_real_valid, token_embed_real, sentence_trigger_embedding
 
@@ -454,31 +559,20 @@ class Sentence(nn.Module):
     def __init__(self, proto_size, hidden_size, hidden_dropout_prob, ratio_loss_sent_plus):
         super(Sentence, self).__init__()
         self.dropout = nn.Dropout(hidden_dropout_prob)
-        self.maxpooling = nn.MaxPool1d(128)
-        self.prototypes = nn.Embedding(proto_size, hidden_size).to(device) # 101,768
-        self.mat_local4sent = nn.Embedding(proto_size, hidden_size).to(device) # 101,768
-        self.vec_label4sent = nn.Embedding(proto_size, 1).to(device) # 101,1
-        self.mat_label4sent = nn.Embedding(proto_size, proto_size).to(device) # 101,101
+        self.maxpooling = nn.AdaptiveMaxPool1d(1)
+        self.prototypes = nn.Embedding(proto_size, hidden_size) # 101,768
+        self.mat_local4sent = nn.Embedding(proto_size, hidden_size) # 101,768
+        self.vec_label4sent = nn.Embedding(proto_size, 1) # 101,1
+        self.mat_label4sent = nn.Embedding(proto_size, proto_size) # 101,101
         self.classifier = nn.Linear(hidden_size, proto_size) # 768,101
         self.proto_size = proto_size # 101
         self.hidden_size = hidden_size #768
         self.ratio_loss_sent_plus = ratio_loss_sent_plus # 1
         
     def get_proto_embedding(self):
-        proto_embedding = self.prototypes(torch.tensor(range(0, self.proto_size)).to(device))
+        proto_embedding = self.prototypes.weight
         return proto_embedding # [proto_size, hidden_size]
     
-    def get_para_vec_mat(self, para_type):
-        mat_local4sent = self.mat_local4sent(torch.tensor(range(0, self.proto_size)).to(device))
-        vec_label4sent = self.vec_label4sent(torch.tensor(range(0, self.proto_size)).to(device))
-        mat_label4sent = self.mat_label4sent(torch.tensor(range(0, self.proto_size)).to(device))
-        if para_type == "mat_local":
-            return mat_local4sent
-        elif para_type == "vec_label":
-            return vec_label4sent
-        else:
-            return mat_label4sent     
-
     def __dist__(self, x, y, dim):
         dist = torch.pow(x - y, 2).sum(dim)
         # dist = torch.where(torch.isnan(dist), torch.full_like(dist, 1e-8), dist)
@@ -493,47 +587,24 @@ class Sentence(nn.Module):
     def batch_measurement(self, r, P, X):
         batch_size = X.size(0)
         proto_size = P.size(0) 
-        return - torch.maximum(torch.zeros([batch_size, proto_size]).to(device), self.__dist__(P.unsqueeze(0), X.unsqueeze(1), 2) - r) 
+        return - torch.maximum(torch.zeros([batch_size, proto_size], device=X.device), self.__dist__(P.unsqueeze(0), X.unsqueeze(1), 2) - r) 
     
     def calculate_prob(self, r, P, X):
         return F.softmax(self.batch_measurement(r, P, X))
         # return F.relu(self.batch_measurement(r, P, X))
         # return self.batch_measurement(r, P, X)
 
-    def label2vec(self, label, label_size):
-        batch_size = label.size(0)
-        label_vec = torch.zeros([batch_size, label_size]).to(device)
-        for i in range(batch_size):
-            label_vec[i][label[i]] = 1
-        return label_vec
-
     def sent_energy_function(self, sent_emb, sent_y):
-        sent_local_energy_temp = torch.matmul(self.get_para_vec_mat("mat_local"), sent_emb.transpose(0, 1))
-        sent_local_energy = torch.sum(torch.mul(sent_y, sent_local_energy_temp.transpose(0, 1)))
-        sent_label_energy = torch.sum(torch.matmul(self.get_para_vec_mat("vec_label").transpose(0, 1), torch.sigmoid(torch.matmul(self.get_para_vec_mat("mat_label"), sent_y.transpose(0, 1)))))
-        sent_energy = sent_local_energy + sent_label_energy 
-        return sent_energy
-
-    def get_the_real_sent_task(self, sent_embed, sent_labels, mention_size):
-        batch_size = sent_embed.size(0)
-        max_mention_size = sent_embed.size(1)
-        hidden_size = sent_embed.size(2) 
-        num_mention = 0
-        norm_mention_size = [max_mention_size] * batch_size                 
-        for i in range(batch_size):
-            norm_mention_size[i] = min(mention_size[i].item(), max_mention_size) 
-            num_mention += norm_mention_size[i]
-        sent_embed_real = torch.zeros([num_mention, hidden_size], dtype=torch.float).to(device)
-        sent_labels_real = torch.zeros([num_mention], dtype=torch.long).to(device)
-        count_mention = 0
-        for i in range(batch_size):
-            sent_embed_real[count_mention:count_mention+norm_mention_size[i], :] = sent_embed[i, :norm_mention_size[i], :]
-            sent_labels_real[count_mention:count_mention+norm_mention_size[i]] = sent_labels[i, :norm_mention_size[i]] 
-            count_mention += norm_mention_size[i]
+        return local_energy(self.mat_local4sent.weight, sent_emb, sent_y) + label_energy(self.vec_label4sent.weight, self.mat_label4sent.weight, sent_y)
+
+    def get_the_real_sent_task(self, sent_embed, sent_labels, ragged):
+        batch_size, max_mention_size, hidden_size = sent_embed.size()
+        sent_embed_real = sent_embed.reshape(batch_size * max_mention_size, hidden_size)[ragged.index]
+        sent_labels_real = sent_labels.reshape(batch_size * max_mention_size)[ragged.index].long()
         return sent_embed_real, sent_labels_real  
         
-    def forward(self, sent_embed, sent_labels, mention_size, pred_token_embedding):
-        sent_embed_real, sent_labels_real = self.get_the_real_sent_task(sent_embed, sent_labels, mention_size) 
+    def forward(self, sent_embed, sent_labels, ragged, pred_token_embedding):
+        sent_embed_real, sent_labels_real = self.get_the_real_sent_task(sent_embed, sent_labels, ragged) 
         proto_embed = self.get_proto_embedding()
         sent_embed_real = sent_embed_real + pred_token_embedding
         logits_sent = self.calculate_prob(1, proto_embed, sent_embed_real)
@@ -541,8 +612,8 @@ class Sentence(nn.Module):
         if sent_labels_real is not None:
             loss_hinge = HingeLoss() # ignore_index=0
             loss_sent_hinge = loss_hinge(logits_sent.view(-1, self.proto_size), sent_labels_real.view(-1))    
-            label_vec = self.label2vec(sent_labels_real, self.proto_size) 
-            loss_sent_energy = torch.max( torch.tensor([0, loss_sent_hinge + self.sent_energy_function(sent_embed_real, label_vec) - self.sent_energy_function(sent_embed_real, logits_sent)], dtype=torch.float) )
+            label_vec = one_hot(sent_labels_real, self.proto_size) 
+            loss_sent_energy = energy_hinge_loss(loss_sent_hinge, self.sent_energy_function(sent_embed_real, label_vec), self.sent_energy_function(sent_embed_real, logits_sent))
             loss_fct = CrossEntropyLoss()
             loss_sent_plus = loss_fct(logits_sent.view(-1, self.proto_size), sent_labels_real.view(-1))
             loss_sent = ENERGY_WEIGHT*loss_sent_energy + self.ratio_loss_sent_plus * loss_sent_plus
@@ -551,13 +622,22 @@ class Sentence(nn.Module):
     
 
 class Document(nn.Module):
-    def __init__(self, relation_size, hidden_size, hidden_dropout_prob, ratio_loss_doc_plus):
+    def __init__(self, relation_size, hidden_size, hidden_dropout_prob, ratio_loss_doc_plus, pair_scoring="concat", pair_memory_mb=0, na_pair_ratio=0, max_na_pairs=0):
         super(Document, self).__init__()
         self.relation_size = relation_size
+        # concat: the classifiers run on the materialized pair features, factorized: on SentencePairs
+        self.pair_scoring = pair_scoring
+        # in training, only a sample of the NA sentence pairs is scored: na_pair_ratio of them, at most max_na_pairs per batch (0: no limit)
+        self.na_pair_ratio = na_pair_ratio
+        self.max_na_pairs = max_na_pairs
         self.dropout = nn.Dropout(hidden_dropout_prob) 
         self.ratio_loss_doc_plus = ratio_loss_doc_plus
         # self.ere_classifier = nn.Linear(hidden_size*4, relation_size)
         self.dim_expand = 3 # 2, 3, 4  维度扩展
+        # the number of sentence pairs whose float features fit in pair_memory_mb, scored one tile at a time, 0 scores all pairs at once;
+        # factorized, a pair only materializes its h_i*h_j product
+        pair_floats = hidden_size if pair_scoring == "factorized" else hidden_size * self.dim_expand
+        self.pair_tile_size = max(1, int(pair_memory_mb * 2**20) // (pair_floats * 4)) if pair_memory_mb > 0 else 0
         self.ere_classifier = nn.Linear(hidden_size*self.dim_expand, relation_size)
         # hidden_dim = 200
         # self.ere_classifier = nn.Sequential(
@@ -582,6 +662,7 @@ class Document(nn.Module):
             nn.Dropout(hidden_dropout_prob)
         )
         self.sent_embedding = nn.Parameter(torch.randn(hidden_size))
+        self.doc_embedding = DocEmbedding(hidden_size, hidden_size, hidden_size, 4)
         self.ere_classifier_joint = nn.Linear(hidden_size*self.dim_expand, relation_size)
         self.ere_classifier_temp_onto = nn.Linear(hidden_size*self.dim_expand, 1+3)
         self.ere_classifier_causal_onto = nn.Linear(hidden_size*self.dim_expand, 1+2)
@@ -591,158 +672,126 @@ class Document(nn.Module):
         self.ere_classifier_sub_maven = nn.Linear(hidden_size*self.dim_expand, 1+1)
         self.ere_classifier_corref_maven = nn.Linear(hidden_size*self.dim_expand, 1+1)
 
-        self.mat_local4doc = nn.Embedding(relation_size, hidden_size*self.dim_expand).to(device)
-        self.vec_label4doc = nn.Embedding(relation_size, 1).to(device)
-        self.mat_label4doc = nn.Embedding(relation_size, relation_size).to(device)
+        self.mat_local4doc = nn.Embedding(relation_size, hidden_size*self.dim_expand)
+        self.vec_label4doc = nn.Embedding(relation_size, 1)
+        self.mat_label4doc = nn.Embedding(relation_size, relation_size)
   
-    def get_para_vec_mat(self, para_type, list_ids):
-        # list_ids = list(range(0, self.relation_size))
-        mat_local4doc = self.mat_local4doc(torch.tensor(list_ids).to(device))
-        vec_label4doc = self.vec_label4doc(torch.tensor(list_ids).to(device))
-        mat_label4doc = self.mat_label4doc(torch.tensor(list_ids).to(device))[:, list_ids]
-        if para_type == "mat_local":
-            return mat_local4doc
-        elif para_type == "vec_label":
-            return vec_label4doc
-        else:
-            return mat_label4doc 
-        
     def get_embedding_interaction(self, t1, t2):
         if self.dim_expand == 2:
-            return torch.cat([t1, t2], dim=0)
+            return torch.cat([t1, t2], dim=-1)
         elif self.dim_expand == 3: 
-            return torch.cat([t1, t2, torch.mul(t1, t2)], dim=0) # we choose this one
+            return torch.cat([t1, t2, torch.mul(t1, t2)], dim=-1) # we choose this one
         elif self.dim_expand == 4:  
-            return torch.cat([t1, t2, torch.mul(t1, t2), t1 - t2], dim=0) 
+            return torch.cat([t1, t2, torch.mul(t1, t2), t1 - t2], dim=-1) 
     
-    def label2vec(self, label, label_size):
-        batch_size = label.size(0)
-        label_vec = torch.zeros([batch_size, label_size]).to(device)
-        for i in range(batch_size):
-            label_vec[i][label[i]] = 1
-        return label_vec
-    
-    def doc_energy_function(self, X, Y, list_ids):
-        doc_local_energy_temp = torch.matmul(self.get_para_vec_mat("mat_local", list_ids), X.transpose(0, 1))
-        doc_local_energy = torch.sum(torch.mul(Y, doc_local_energy_temp.transpose(0, 1)))
-        doc_label_energy = torch.sum(torch.matmul(self.get_para_vec_mat("vec_label", list_ids).transpose(0, 1), torch.sigmoid(torch.matmul(self.get_para_vec_mat("mat_label", list_ids), Y.transpose(0, 1)))))
-        doc_energy = doc_local_energy + doc_label_energy 
-        return doc_energy
+    def score_pairs(self, classifier, inputs_sentpair):
+        if isinstance(inputs_sentpair, SentencePairs):
+            return inputs_sentpair.linear(classifier.weight, classifier.bias)
+        return classifier(inputs_sentpair)
+
+    def doc_energy_function(self, X, Y, list_ids, pair_weights=None):
+        # the energy parameters of the relations in list_ids, in the order of the columns of Y
+        mat_local = self.mat_local4doc.weight[list_ids]
+        vec_label = self.vec_label4doc.weight[list_ids]
+        mat_label = self.mat_label4doc.weight[list_ids][:, list_ids]
+        # the local energy is linear in Y, so the pair weights can scale Y
+        Y_weighted = Y if pair_weights is None else Y * pair_weights.unsqueeze(1)
+        if isinstance(X, SentencePairs):
+            doc_local_energy = torch.sum(Y_weighted * X.linear(mat_local))
+        else:
+            doc_local_energy = local_energy(mat_local, X, Y_weighted)
+        return doc_local_energy + label_energy(vec_label, mat_label, Y, pair_weights)
     
-    def get_event_re_task(self, sent_embed, mat_rel_label, mention_size, task_name, doc_ere_task_type):
-        batch_size = sent_embed.size(0)
-        max_mention_size = sent_embed.size(1)
-        hidden_size = sent_embed.size(2)
-        num_rel = self.relation_size
-        num_mention = 0
-        num_mention_pair = 0
-        norm_mention_size = [max_mention_size] * batch_size  
-        for i in range(batch_size):
-            norm_mention_size[i] = min(mention_size[i].item(), max_mention_size)  
-            num_mention += norm_mention_size[i]
-            if norm_mention_size[i] != 1: 
-                num_mention_pair += norm_mention_size[i] * (norm_mention_size[i] - 1)
-            else:
-                num_mention_pair += 1 
-        
-        inputs_sentpair = torch.zeros([num_mention_pair, hidden_size*self.dim_expand], dtype=torch.float).to(device)
-        labels_sentpair = torch.zeros([num_mention_pair], dtype=torch.long).to(device)
-
-        count_example_pair = 0
-        for k in range(batch_size):
-            num_mention_one_doc = norm_mention_size[k]
-            if num_mention_one_doc != 1: 
-                for i in range(num_mention_one_doc):
-                    for j in range(num_mention_one_doc):
-                        if i != j:
-                            inputs_sentpair[count_example_pair] = self.get_embedding_interaction(sent_embed[k][i], sent_embed[k][j])
-                            labels_sentpair[count_example_pair] = mat_rel_label[k][i][j].item()
-                            count_example_pair += 1 
-            else:
-                inputs_sentpair[count_example_pair] = self.get_embedding_interaction(sent_embed[k][0], sent_embed[k][0])
-                labels_sentpair[count_example_pair] = mat_rel_label[k][0][0].item()
-                count_example_pair += 1
+    def get_pair_labels(self, rel_triples, doc_size, num_mention_pair):
+        """ Scatters the (doc index, head, tail, relation id) triples into the labels of the sentence pairs enumerated in get_event_re_task, 
+            i.e. (i, j) with i != j in row-major order for each doc, or the single (0, 0) pair of a doc with one mention. Unlabelled pairs are NA (0).
+        """
+        labels_sentpair = torch.zeros([num_mention_pair], dtype=torch.long, device=doc_size.device)
+        if rel_triples.size(0) == 0:
+            return labels_sentpair
+        doc_num_pair = torch.where(doc_size == 1, torch.ones_like(doc_size), doc_size * (doc_size - 1))
+        doc_pair_start = torch.cumsum(doc_num_pair, dim=0) - doc_num_pair
+        doc, head, tail, rel = rel_triples.to(doc_size.device).unbind(1)
+        size = doc_size[doc]
+        valid = (head < size) & (tail < size) & ((head != tail) | (size == 1))
+        pos = doc_pair_start[doc] + head * (size - 1) + tail - (tail > head).long()
+        labels_sentpair[pos[valid]] = rel[valid]
+        return labels_sentpair
+
+    def get_event_re_task(self, sent_embed, rel_triples, ragged, task_name, doc_ere_task_type):
+        batch_size, max_mention_size, hidden_size = sent_embed.size()
+        doc, head, tail = sentence_pairs(ragged, max_mention_size)
+        labels_sentpair = self.get_pair_labels(rel_triples, ragged.sizes, doc.size(0))
+        pair_weights = None
+        if self.training and (self.na_pair_ratio > 0 or self.max_na_pairs > 0):
+            doc, head, tail, labels_sentpair, pair_weights = self.sample_na_pairs(doc, head, tail, labels_sentpair)
+        if self.pair_scoring == "factorized" or self.pair_tile_size:
+            inputs_sentpair = SentencePairs(sent_embed, doc, head, tail, self.dim_expand, self.pair_scoring == "factorized", self.pair_tile_size)
+        else:
+            inputs_sentpair = self.get_embedding_interaction(sent_embed[doc, head], sent_embed[doc, tail])
         
         if doc_ere_task_type == "doc_all":
-            return inputs_sentpair, labels_sentpair
+            return inputs_sentpair, labels_sentpair, pair_weights
         else:
             if task_name == "ontoevent-doc":
                 labels_sentpair_temporal, labels_sentpair_causal, labels_sentpair_sub = self.labels_sentpair_rebuilt(labels_sentpair, task_name)
-                return inputs_sentpair, labels_sentpair_temporal, labels_sentpair_causal, labels_sentpair_sub  
+                return inputs_sentpair, labels_sentpair_temporal, labels_sentpair_causal, labels_sentpair_sub, pair_weights
             elif task_name == "maven-ere":
                 labels_sentpair_temporal, labels_sentpair_causal, labels_sentpair_sub, labels_sentpair_corref = self.labels_sentpair_rebuilt(labels_sentpair, task_name)
-                return inputs_sentpair, labels_sentpair_temporal, labels_sentpair_causal, labels_sentpair_sub, labels_sentpair_corref
+                return inputs_sentpair, labels_sentpair_temporal, labels_sentpair_causal, labels_sentpair_sub, labels_sentpair_corref, pair_weights
 
-    def labels_sentpair_rebuilt(self, labels_sentpair, task_name):
-        # rebuild the labels_sentpair for different ere task on different dataset
-        labels_sentpair_temporal = labels_sentpair.clone()
-        labels_sentpair_causal = labels_sentpair.clone()
-        labels_sentpair_sub = labels_sentpair.clone()
-        labels_sentpair_corref = labels_sentpair.clone()
-        label_size = labels_sentpair.size(0)
+    def sample_na_pairs(self, doc, head, tail, labels_sentpair):
+        """ Keeps all the sentence pairs with a relation and a uniform sample of the NA pairs, drawn anew at every step.
+            The kept NA pairs are weighted by num_NA / num_kept, so that the weighted losses estimate those over all the pairs.
+        """
+        na = torch.nonzero(labels_sentpair == 0, as_tuple=True)[0]
+        num_na = na.size(0)
+        num_keep = int(math.ceil(self.na_pair_ratio * num_na)) if self.na_pair_ratio > 0 else num_na
+        if self.max_na_pairs > 0:
+            num_keep = min(num_keep, self.max_na_pairs)
+        if num_keep >= num_na:
+            return doc, head, tail, labels_sentpair, None
+        keep = torch.ones_like(labels_sentpair, dtype=torch.bool)
+        keep[na[torch.randperm(num_na, device=na.device)[num_keep:]]] = False
+        pair_weights = torch.ones(labels_sentpair.size(0), dtype=torch.float, device=labels_sentpair.device)
+        pair_weights[na] = num_na / max(num_keep, 1)
+        return doc[keep], head[keep], tail[keep], labels_sentpair[keep], pair_weights[keep]
 
-        if task_name == "maven-ere":
-            for i in range(label_size):
-                label = labels_sentpair[i].item() 
-                if label not in list(range(1, 7)):
-                    labels_sentpair_temporal[i] = 0
-
-                if label not in list(range(7, 9)):
-                    labels_sentpair_causal[i] = 0
-                else:
-                    labels_sentpair_causal[i] = labels_sentpair_causal[i] - 6
-
-                if label != 9: 
-                    labels_sentpair_sub[i] = 0
-                else:
-                    labels_sentpair_sub[i] = labels_sentpair_sub[i] - 8 
-                
-                if label != 10:
-                    labels_sentpair_corref[i] = 0
-                else:
-                    labels_sentpair_corref[i] = labels_sentpair_corref[i] - 9
-
-            return labels_sentpair_temporal, labels_sentpair_causal, labels_sentpair_sub, labels_sentpair_corref 
-        
-        elif task_name == "ontoevent-doc":
-            for i in range(label_size):
-                label = labels_sentpair[i].item() 
-                if label not in list(range(1, 4)):
-                    labels_sentpair_temporal[i] = 0
-
-                if label not in list(range(4, 6)):
-                    labels_sentpair_causal[i] = 0
-                else:
-                    labels_sentpair_causal[i] = labels_sentpair_causal[i] - 3
- 
-                if label not in list(range(6, 9)):
-                    labels_sentpair_sub[i] = 0
-                else:
-                    labels_sentpair_sub[i] = labels_sentpair_sub[i] - 5
-
-            return labels_sentpair_temporal, labels_sentpair_causal, labels_sentpair_sub 
-
-    def calculate_ere_loss(self, logits_ere, labels_ere, sentpair_emb, relation_size, list_ids, task_name, doc_ere_task_type):
+    def labels_sentpair_rebuilt(self, labels_sentpair, task_name):
+        # rebuild the labels_sentpair for different ere task on different dataset, through a lookup table per relation family
+        list_labels = []
+        for relation_ids in RELATION_FAMILIES[task_name].values():
+            table = torch.zeros([self.relation_size], dtype=torch.long, device=labels_sentpair.device)
+            table[relation_ids] = torch.arange(len(relation_ids), device=labels_sentpair.device)
+            list_labels.append(table[labels_sentpair])
+        return tuple(list_labels)
+
+    def calculate_ere_loss(self, logits_ere, labels_ere, sentpair_emb, relation_size, list_ids, task_name, doc_ere_task_type, pair_weights=None):
         if labels_ere is not None:
-            loss_hinge = HingeLoss() # ignore_index=0, num_classes=relation_size
-            loss_doc_hinge = loss_hinge(logits_ere.view(-1, relation_size), labels_ere.view(-1))
-            label_vec = self.label2vec(labels_ere, relation_size)
-            loss_doc_energy = torch.max( torch.tensor([0, loss_doc_hinge + self.doc_energy_function(sentpair_emb, label_vec, list_ids) - self.doc_energy_function(sentpair_emb, logits_ere, list_ids)], dtype=torch.float) )
+            if pair_weights is None:
+                loss_hinge = HingeLoss() # ignore_index=0, num_classes=relation_size
+                loss_doc_hinge = loss_hinge(logits_ere.view(-1, relation_size), labels_ere.view(-1))
+            else:
+                loss_doc_hinge = weighted_hinge_loss(logits_ere.view(-1, relation_size), labels_ere.view(-1), pair_weights)
+            # the weighted mean over all the pairs is estimated from the sampled ones
+            reduction = "mean" if pair_weights is None else "none"
+            label_vec = one_hot(labels_ere, relation_size)
+            loss_doc_energy = energy_hinge_loss(loss_doc_hinge, self.doc_energy_function(sentpair_emb, label_vec, list_ids, pair_weights), self.doc_energy_function(sentpair_emb, logits_ere, list_ids, pair_weights))
             if doc_ere_task_type == "doc_all" or (task_name == "ontoevent-doc" and doc_ere_task_type != "doc_causal"):
-                weight_tensor = torch.ones([relation_size]).to(device)
+                weight_tensor = torch.ones([relation_size], device=logits_ere.device)
                 weight_tensor[0] = NA_REL_WEIGHT # as there are too many NA relations, we should decrease their weight in loss and focus more on valid labels' training 
                 weight_tensor = weight_tensor / torch.sum(weight_tensor) 
-                loss_fct = CrossEntropyLoss(weight=weight_tensor) # , ignore_index=0
+                loss_fct = CrossEntropyLoss(weight=weight_tensor, reduction=reduction) # , ignore_index=0
                 # loss_fct = CrossEntropyLoss()
             elif task_name == "ontoevent-doc" and doc_ere_task_type == "doc_causal": 
-                weight_tensor = torch.ones([relation_size]).to(device)
+                weight_tensor = torch.ones([relation_size], device=logits_ere.device)
                 weight_tensor[0] = NA_REL_WEIGHT / 2
                 weight_tensor = weight_tensor / torch.sum(weight_tensor) 
-                loss_fct = CrossEntropyLoss(weight=weight_tensor) # , ignore_index=0
+                loss_fct = CrossEntropyLoss(weight=weight_tensor, reduction=reduction) # , ignore_index=0
                 # loss_fct = CrossEntropyLoss() 
             else: 
                 if task_name == "maven-ere":
-                    weight_tensor = torch.ones([relation_size]).to(device)
+                    weight_tensor = torch.ones([relation_size], device=logits_ere.device)
                     if doc_ere_task_type == "doc_sub": 
                         weight_tensor[0] = NA_REL_WEIGHT_SUB
                     elif doc_ere_task_type == "doc_temporal":
@@ -750,70 +799,41 @@ class Document(nn.Module):
                     elif doc_ere_task_type == "doc_causal":
                         weight_tensor[0] = NA_REL_WEIGHT_CAUSAL
                     weight_tensor = weight_tensor / torch.sum(weight_tensor) 
-                    loss_fct = CrossEntropyLoss(weight=weight_tensor) # , ignore_index=0               
-            loss_doc_plus = loss_fct(logits_ere.view(-1, relation_size)+1e-10, labels_ere.view(-1)) # +1e-10 to avoid nan in loss
+                    loss_fct = CrossEntropyLoss(weight=weight_tensor, reduction=reduction) # , ignore_index=0               
+            if pair_weights is None:
+                loss_doc_plus = loss_fct(logits_ere.view(-1, relation_size)+1e-10, labels_ere.view(-1)) # +1e-10 to avoid nan in loss
+            else: # the class-weighted mean over all the pairs
+                loss_doc_plus = torch.sum(loss_fct(logits_ere.view(-1, relation_size)+1e-10, labels_ere.view(-1)) * pair_weights) / torch.sum(loss_fct.weight[labels_ere.view(-1)] * pair_weights)
             
             loss_doc = ENERGY_WEIGHT*loss_doc_energy + self.ratio_loss_doc_plus*loss_doc_plus
 
             return loss_doc
 
-    def forward(self, sent_embed, doc_token_embed, mat_rel_label, mention_size, task_name, doc_ere_task_type, sentence_trigger_embedding, max_mention_size):
-        embedding_dim = 768
-        # 获取当前的句子数
-        current_sentence_count = sentence_trigger_embedding.size(0)
-
-        if current_sentence_count > max_mention_size:
-            # 裁剪多余的句子 embedding
-            sentence_trigger_embedding = sentence_trigger_embedding[:max_mention_size, :]
-        elif current_sentence_count < max_mention_size:
-            # 计算需要填充的句子数
-            padding_count = max_mention_size - current_sentence_count
-
-            # 创建填充的零向量 [padding_count, 768]
-            padding_tensor = torch.zeros(padding_count, embedding_dim, device=sentence_trigger_embedding.device)
-
-            # 拼接原始 embedding 和填充向量
-            sentence_trigger_embedding = torch.cat((sentence_trigger_embedding, padding_tensor), dim=0)
+    def forward(self, sent_embed, doc_token_embed, rel_triples, ragged, task_name, doc_ere_task_type, sentence_trigger_embedding):
+        # sentence_trigger_embedding [batch_size, max_size, hidden_size], zero for the padding rows
         sent_embed = sent_embed + sentence_trigger_embedding
         # HACK
+        # one graph per doc over its real sentences and a doc node, so that a doc does not depend on the padding rows of its batch
+        batch_size, max_size, hidden_size = sent_embed.size()
         graphs = []
         node_features = []
-        # 循环内部定义 node_feature
-        for idx, doc_span_info in enumerate(sent_embed):
-            sent2mention_id = defaultdict(list)
-            d = defaultdict(list)  # 存储边连接关系的字典
-            node_feature = sent_embed[idx]  # sent_num * hidden_size
+        for idx, sent_num in enumerate(ragged.sizes.tolist()):
+            node_feature = sent_embed[idx, :sent_num]  # sent_num * hidden_size
             node_feature += self.sent_embedding
-            sent_num = node_feature.size(0)
-            for i in range(node_feature.size(0)):
-                for j in range(node_feature.size(0)):
-                    if i != j:
-                        d[('node', 's-s', 'node')].append((i, j))
-            doc_start_idx = len(node_feature)
-            for j in range(len(sent_embed[idx])):
-                sent_idx = j
-                d[('node', 'doc-s', 'node')].append((doc_start_idx, sent_idx))
-                d[('node', 'doc-s', 'node')].append((sent_idx, doc_start_idx))
-            node_features.append(node_feature)
-            node_features_big = torch.cat(node_features, dim=0)
-            graph = dgl.heterograph(d)
+            # s-s edges between all the sentences, doc-s edges both ways between the doc node (the last one) and every sentence
+            sent_ids = torch.arange(sent_num)
+            doc_ids = torch.full([sent_num], sent_num, dtype=torch.long)
+            graph = dgl.heterograph({
+                ('node', 's-s', 'node'): torch.nonzero(sent_ids.unsqueeze(1) != sent_ids, as_tuple=True),
+                ('node', 'doc-s', 'node'): (torch.stack([doc_ids, sent_ids], 1).view(-1), torch.stack([sent_ids, doc_ids], 1).view(-1)),
+            }, num_nodes_dict={'node': sent_num + 1})
             graphs.append(graph)
-        sent_emb_dim = token_emb_dim = doc_emb_dim = 768
-        num_heads = 4
-        doc_embedding_model = DocEmbedding(sent_emb_dim, token_emb_dim, doc_emb_dim, num_heads).to('cuda')
-        num_docs = len(sent_embed)  # 文档数量
-        doc_node_emb_list = []  # 每个文档对应的节点向量列表
-        for i in range(num_docs):
-            doc_sent_emb = sent_embed[i]
-            doc_token_emb = doc_token_embed[i]
             # 使用 DocEmbedding 模型生成当前文档对应的节点向量
-            document_embedding = doc_embedding_model([doc_sent_emb.clone()], [doc_token_emb.clone()])
+            document_embedding = self.doc_embedding([node_feature.clone()], [doc_token_embed[idx, :sent_num].clone()])
             document_embeddings = torch.mean(document_embedding, dim=1)
             document_embeddings = torch.nn.functional.normalize(document_embeddings, dim=1)
-            doc_node_emb_list.append(document_embeddings)
-        # 将所有文档的节点向量拼接为一个大的张量
-        doc_node_feature = torch.cat(doc_node_emb_list, dim=0)
-        node_features_big = torch.cat((node_features_big, doc_node_feature), dim=0)
+            node_features.append(torch.cat([node_feature, document_embeddings], dim=0))
+        node_features_big = torch.cat(node_features, dim=0)
         graph_big = dgl.batch(graphs).to(node_features_big.device)
         feature_bank = [node_features_big]
         # with residual connection
@@ -823,44 +843,20 @@ class Document(nn.Module):
         feature_bank = torch.cat(feature_bank, dim=-1)
         node_features_big = self.middle_layer(feature_bank)
 
-        # unbatch
-        graphs = dgl.unbatch(graph_big)
-        cur_idx = 0
-        # doc_span_context_list = []
-        doc_sent_context_list = []
-        for idx, graph in enumerate(graphs):
-            sent_num = sent_embed[idx].size(0)
-            node_num = graphs[idx].number_of_nodes('node')
-            doc_sent_context_list.append(node_features_big[cur_idx:cur_idx + sent_num])
-
-            # span_context_list = []
-            # mention_context = node_features_big[cur_idx + sent_num:cur_idx + node_num]
-            # for mid_s, mid_e in doc_span_info_list[idx].span_mention_range_list:
-            #     multi_ment_context = mention_context[mid_s:mid_e]
-            #     if self.config.seq_reduce_type == 'AWA':
-            #         span_context = self.span_mention_reducer(multi_ment_context, keepdim=True)
-            #     elif self.config.seq_reduce_type == 'MaxPooling':
-            #         span_context = multi_ment_context.max(dim=0, keepdim=True)[0]
-            #     elif self.config.seq_reduce_type == 'MeanPooling':
-            #         span_context = multi_ment_context.mean(dim=0, keepdim=True)
-            #     else:
-            #         raise Exception('Unknown seq_reduce_type {}'.format(self.config.seq_reduce_type))
-            #
-            #     span_context_list.append(span_context)
-            # doc_span_context_list.append(span_context_list)
-            cur_idx += node_num
-        for sent_gcn_emb in doc_sent_context_list:
-            sent_gcn_emb = sent_gcn_emb
-        sent_embed_gcn = sent_embed + sent_gcn_emb
+        # unbatch: the sentence nodes back to the rows of their sentences, each doc being followed by its doc node
+        doc_of_sent = torch.repeat_interleave(torch.arange(batch_size, device=ragged.sizes.device), ragged.sizes)
+        sent_nodes = torch.arange(doc_of_sent.size(0), device=doc_of_sent.device) + doc_of_sent
+        sent_gcn_emb = node_features_big.new_zeros([batch_size * max_size, hidden_size]).index_copy(0, ragged.index, node_features_big[sent_nodes])
+        sent_embed_gcn = sent_embed + sent_gcn_emb.view(batch_size, max_size, hidden_size)
         # sent_embed_gcn = sent_embed_gcn - sent_embed
 
         if doc_ere_task_type == "doc_all":
-            sentpair_emb, labels_sentpair = self.get_event_re_task(sent_embed, mat_rel_label, mention_size, task_name, doc_ere_task_type)
+            sentpair_emb, labels_sentpair, pair_weights = self.get_event_re_task(sent_embed, rel_triples, ragged, task_name, doc_ere_task_type)
             # logits_sentpair = self.ere_classifier(sentpair_emb) # F.softmax() 
             # logits_sentpair_all = F.softmax(self.ere_classifier(sentpair_emb))
-            logits_sentpair_all = F.relu(self.ere_classifier(sentpair_emb))
+            logits_sentpair_all = F.relu(self.score_pairs(self.ere_classifier, sentpair_emb))
             label_ids = list(range(0, self.relation_size))
-            loss_doc_all = self.calculate_ere_loss(logits_sentpair_all, labels_sentpair, sentpair_emb, self.relation_size, label_ids, task_name, doc_ere_task_type)
+            loss_doc_all = self.calculate_ere_loss(logits_sentpair_all, labels_sentpair, sentpair_emb, self.relation_size, label_ids, task_name, doc_ere_task_type, pair_weights)
             return loss_doc_all, logits_sentpair_all, labels_sentpair 
         if task_name == "maven-ere":
             ratio_temp = 1
@@ -871,44 +867,41 @@ class Document(nn.Module):
             size_causal = 1 + 2 # +1 for NA
             size_sub = 1 + 1 # +1 for NA
             size_corref = 1 + 1 # +1 for NA
-            label_temp_ids = list(range(0, size_temp))
-            label_causal_ids = [0, 7, 8]
-            label_sub_ids = [0, 9]
-            label_corref_ids = [0, 10]
-            inputs_sentpair, labels_sentpair_temporal, labels_sentpair_causal, labels_sentpair_sub, labels_sentpair_corref = self.get_event_re_task(sent_embed_gcn, mat_rel_label, mention_size, task_name, doc_ere_task_type)
+            label_temp_ids, label_causal_ids, label_sub_ids, label_corref_ids = RELATION_FAMILIES[task_name].values()
+            inputs_sentpair, labels_sentpair_temporal, labels_sentpair_causal, labels_sentpair_sub, labels_sentpair_corref, pair_weights = self.get_event_re_task(sent_embed_gcn, rel_triples, ragged, task_name, doc_ere_task_type)
             if doc_ere_task_type == "doc_temporal":
                 # logits_sentpair_temp = F.softmax(self.ere_classifier_temp_maven(inputs_sentpair))
-                logits_sentpair_temp = F.relu(self.ere_classifier_temp_maven(inputs_sentpair))
-                loss_doc_temp = self.calculate_ere_loss(logits_sentpair_temp, labels_sentpair_temporal, inputs_sentpair, size_temp, label_temp_ids, task_name, doc_ere_task_type)
+                logits_sentpair_temp = F.relu(self.score_pairs(self.ere_classifier_temp_maven, inputs_sentpair))
+                loss_doc_temp = self.calculate_ere_loss(logits_sentpair_temp, labels_sentpair_temporal, inputs_sentpair, size_temp, label_temp_ids, task_name, doc_ere_task_type, pair_weights)
                 return loss_doc_temp, logits_sentpair_temp, labels_sentpair_temporal
             elif doc_ere_task_type == "doc_causal":
                 # logits_sentpair_causal = F.softmax(self.ere_classifier_causal_maven(inputs_sentpair))
-                logits_sentpair_causal = F.relu(self.ere_classifier_causal_maven(inputs_sentpair))
-                loss_doc_causal = self.calculate_ere_loss(logits_sentpair_causal, labels_sentpair_causal, inputs_sentpair, size_causal, label_causal_ids, task_name, doc_ere_task_type)
+                logits_sentpair_causal = F.relu(self.score_pairs(self.ere_classifier_causal_maven, inputs_sentpair))
+                loss_doc_causal = self.calculate_ere_loss(logits_sentpair_causal, labels_sentpair_causal, inputs_sentpair, size_causal, label_causal_ids, task_name, doc_ere_task_type, pair_weights)
                 return loss_doc_causal, logits_sentpair_causal, labels_sentpair_causal 
             elif doc_ere_task_type == "doc_sub":
                 # logits_sentpair_sub = F.softmax(self.ere_classifier_sub_maven(inputs_sentpair))
-                logits_sentpair_sub = F.relu(self.ere_classifier_sub_maven(inputs_sentpair))
-                loss_doc_sub = self.calculate_ere_loss(logits_sentpair_sub, labels_sentpair_sub, inputs_sentpair, size_sub, label_sub_ids, task_name, doc_ere_task_type)  
+                logits_sentpair_sub = F.relu(self.score_pairs(self.ere_classifier_sub_maven, inputs_sentpair))
+                loss_doc_sub = self.calculate_ere_loss(logits_sentpair_sub, labels_sentpair_sub, inputs_sentpair, size_sub, label_sub_ids, task_name, doc_ere_task_type, pair_weights)
                 return loss_doc_sub, logits_sentpair_sub, labels_sentpair_sub
             elif doc_ere_task_type == "doc_corref":
                 # logits_sentpair_corref = F.softmax(self.ere_classifier_corref_maven(inputs_sentpair))
-                logits_sentpair_corref = F.relu(self.ere_classifier_corref_maven(inputs_sentpair))
-                loss_doc_corref = self.calculate_ere_loss(logits_sentpair_corref, labels_sentpair_corref, inputs_sentpair, size_corref, label_corref_ids, task_name, doc_ere_task_type)                
+                logits_sentpair_corref = F.relu(self.score_pairs(self.ere_classifier_corref_maven, inputs_sentpair))
+                loss_doc_corref = self.calculate_ere_loss(logits_sentpair_corref, labels_sentpair_corref, inputs_sentpair, size_corref, label_corref_ids, task_name, doc_ere_task_type, pair_weights)
                 return loss_doc_corref, logits_sentpair_corref, labels_sentpair_corref
             elif doc_ere_task_type == "doc_joint": 
                 # logits_sentpair_temp = F.softmax(self.ere_classifier_temp_maven(inputs_sentpair))
                 # logits_sentpair_causal = F.softmax(self.ere_classifier_causal_maven(inputs_sentpair))
                 # logits_sentpair_sub = F.softmax(self.ere_classifier_sub_maven(inputs_sentpair))
                 # logits_sentpair_corref = F.softmax(self.ere_classifier_corref_maven(inputs_sentpair))
-                logits_sentpair_temp = F.relu(self.ere_classifier_temp_maven(inputs_sentpair))
-                logits_sentpair_causal = F.relu(self.ere_classifier_causal_maven(inputs_sentpair))
-                logits_sentpair_sub = F.relu(self.ere_classifier_sub_maven(inputs_sentpair))
-                logits_sentpair_corref = F.relu(self.ere_classifier_corref_maven(inputs_sentpair))
-                loss_doc_temp = self.calculate_ere_loss(logits_sentpair_temp, labels_sentpair_temporal, inputs_sentpair, size_temp, label_temp_ids, task_name, "doc_temporal")
-                loss_doc_causal = self.calculate_ere_loss(logits_sentpair_causal, labels_sentpair_causal, inputs_sentpair, size_causal, label_causal_ids, task_name, "doc_causal")
-                loss_doc_sub = self.calculate_ere_loss(logits_sentpair_sub, labels_sentpair_sub, inputs_sentpair, size_sub, label_sub_ids, task_name, "doc_sub")
-                loss_doc_corref = self.calculate_ere_loss(logits_sentpair_corref, labels_sentpair_corref, inputs_sentpair, size_corref, label_corref_ids, task_name, "doc_corref")               
+                logits_sentpair_temp = F.relu(self.score_pairs(self.ere_classifier_temp_maven, inputs_sentpair))
+                logits_sentpair_causal = F.relu(self.score_pairs(self.ere_classifier_causal_maven, inputs_sentpair))
+                logits_sentpair_sub = F.relu(self.score_pairs(self.ere_classifier_sub_maven, inputs_sentpair))
+                logits_sentpair_corref = F.relu(self.score_pairs(self.ere_classifier_corref_maven, inputs_sentpair))
+                loss_doc_temp = self.calculate_ere_loss(logits_sentpair_temp, labels_sentpair_temporal, inputs_sentpair, size_temp, label_temp_ids, task_name, "doc_temporal", pair_weights)
+                loss_doc_causal = self.calculate_ere_loss(logits_sentpair_causal, labels_sentpair_causal, inputs_sentpair, size_causal, label_causal_ids, task_name, "doc_causal", pair_weights)
+                loss_doc_sub = self.calculate_ere_loss(logits_sentpair_sub, labels_sentpair_sub, inputs_sentpair, size_sub, label_sub_ids, task_name, "doc_sub", pair_weights)
+                loss_doc_corref = self.calculate_ere_loss(logits_sentpair_corref, labels_sentpair_corref, inputs_sentpair, size_corref, label_corref_ids, task_name, "doc_corref", pair_weights)
                 loss_doc_joint = ratio_temp*loss_doc_temp + ratio_causal*loss_doc_causal + ratio_sub*loss_doc_sub + ratio_corref*loss_doc_corref
                 return loss_doc_joint, logits_sentpair_temp, labels_sentpair_temporal, logits_sentpair_causal, labels_sentpair_causal, logits_sentpair_sub, labels_sentpair_sub, logits_sentpair_corref, labels_sentpair_corref
         elif task_name == "ontoevent-doc":
@@ -918,35 +911,33 @@ class Document(nn.Module):
             size_temp = 1 + 3 # +1 for NA
             size_causal = 1 + 2 # +1 for NA
             size_sub = 1 + 3 # +1 for NA
-            label_temp_ids = list(range(0, size_temp))
-            label_causal_ids = [0, 4, 5]
-            label_sub_ids = [0, 6, 7, 8]
-            inputs_sentpair, labels_sentpair_temporal, labels_sentpair_causal, labels_sentpair_sub = self.get_event_re_task(sent_embed, mat_rel_label, mention_size, task_name, doc_ere_task_type)
+            label_temp_ids, label_causal_ids, label_sub_ids = RELATION_FAMILIES[task_name].values()
+            inputs_sentpair, labels_sentpair_temporal, labels_sentpair_causal, labels_sentpair_sub, pair_weights = self.get_event_re_task(sent_embed, rel_triples, ragged, task_name, doc_ere_task_type)
             if doc_ere_task_type == "doc_temporal":
                 # logits_sentpair_temp = F.softmax(self.ere_classifier_temp_onto(inputs_sentpair))
-                logits_sentpair_temp = F.relu(self.ere_classifier_temp_onto(inputs_sentpair))
-                loss_doc_temp = self.calculate_ere_loss(logits_sentpair_temp, labels_sentpair_temporal, inputs_sentpair, size_temp, label_temp_ids, task_name, doc_ere_task_type)
+                logits_sentpair_temp = F.relu(self.score_pairs(self.ere_classifier_temp_onto, inputs_sentpair))
+                loss_doc_temp = self.calculate_ere_loss(logits_sentpair_temp, labels_sentpair_temporal, inputs_sentpair, size_temp, label_temp_ids, task_name, doc_ere_task_type, pair_weights)
                 return loss_doc_temp, logits_sentpair_temp, labels_sentpair_temporal
             elif doc_ere_task_type == "doc_causal":
                 # logits_sentpair_causal = F.softmax(self.ere_classifier_causal_onto(inputs_sentpair))
-                logits_sentpair_causal = F.relu(self.ere_classifier_causal_onto(inputs_sentpair))
-                loss_doc_causal = self.calculate_ere_loss(logits_sentpair_causal, labels_sentpair_causal, inputs_sentpair, size_causal, label_causal_ids, task_name, doc_ere_task_type)
+                logits_sentpair_causal = F.relu(self.score_pairs(self.ere_classifier_causal_onto, inputs_sentpair))
+                loss_doc_causal = self.calculate_ere_loss(logits_sentpair_causal, labels_sentpair_causal, inputs_sentpair, size_causal, label_causal_ids, task_name, doc_ere_task_type, pair_weights)
                 return loss_doc_causal, logits_sentpair_causal, labels_sentpair_causal 
             elif doc_ere_task_type == "doc_sub":
                 # logits_sentpair_sub = F.softmax(self.ere_classifier_sub_onto(inputs_sentpair))
-                logits_sentpair_sub = F.relu(self.ere_classifier_sub_onto(inputs_sentpair))
-                loss_doc_sub = self.calculate_ere_loss(logits_sentpair_sub, labels_sentpair_sub, inputs_sentpair, size_sub, label_sub_ids, task_name, doc_ere_task_type)
+                logits_sentpair_sub = F.relu(self.score_pairs(self.ere_classifier_sub_onto, inputs_sentpair))
+                loss_doc_sub = self.calculate_ere_loss(logits_sentpair_sub, labels_sentpair_sub, inputs_sentpair, size_sub, label_sub_ids, task_name, doc_ere_task_type, pair_weights)
                 return loss_doc_sub, logits_sentpair_sub, labels_sentpair_sub  
             elif doc_ere_task_type == "doc_joint":
                 # logits_sentpair_temp = F.softmax(self.ere_classifier_temp_onto(inputs_sentpair))
                 # logits_sentpair_causal = F.softmax(self.ere_classifier_causal_onto(inputs_sentpair))
                 # logits_sentpair_sub = F.softmax(self.ere_classifier_sub_onto(inputs_sentpair))
-                logits_sentpair_temp = F.relu(self.ere_classifier_temp_onto(inputs_sentpair))
-                logits_sentpair_causal = F.relu(self.ere_classifier_causal_onto(inputs_sentpair))
-                logits_sentpair_sub = F.relu(self.ere_classifier_sub_onto(inputs_sentpair))
-                loss_doc_temp = self.calculate_ere_loss(logits_sentpair_temp, labels_sentpair_temporal, inputs_sentpair, size_temp, label_temp_ids, task_name, "doc_temporal")
-                loss_doc_causal = self.calculate_ere_loss(logits_sentpair_causal, labels_sentpair_causal, inputs_sentpair, size_causal, label_causal_ids, task_name, "doc_causal")
-                loss_doc_sub = self.calculate_ere_loss(logits_sentpair_sub, labels_sentpair_sub, inputs_sentpair, size_sub, label_sub_ids, task_name, "doc_sub")
+                logits_sentpair_temp = F.relu(self.score_pairs(self.ere_classifier_temp_onto, inputs_sentpair))
+                logits_sentpair_causal = F.relu(self.score_pairs(self.ere_classifier_causal_onto, inputs_sentpair))
+                logits_sentpair_sub = F.relu(self.score_pairs(self.ere_classifier_sub_onto, inputs_sentpair))
+                loss_doc_temp = self.calculate_ere_loss(logits_sentpair_temp, labels_sentpair_temporal, inputs_sentpair, size_temp, label_temp_ids, task_name, "doc_temporal", pair_weights)
+                loss_doc_causal = self.calculate_ere_loss(logits_sentpair_causal, labels_sentpair_causal, inputs_sentpair, size_causal, label_causal_ids, task_name, "doc_causal", pair_weights)
+                loss_doc_sub = self.calculate_ere_loss(logits_sentpair_sub, labels_sentpair_sub, inputs_sentpair, size_sub, label_sub_ids, task_name, "doc_sub", pair_weights)
                 loss_doc_joint = ratio_temp*loss_doc_temp + ratio_causal*loss_doc_causal + ratio_sub*loss_doc_sub
                 return loss_doc_joint, logits_sentpair_temp, labels_sentpair_temporal, logits_sentpair_causal, labels_sentpair_causal, logits_sentpair_sub, labels_sentpair_sub
 
@@ -977,9 +968,9 @@ class MultiheadAttention(nn.Module):
                 reshaped_tensor = inner_tensor.view(1, -1, 1)
                 token_dependent_padded.append(reshaped_tensor)
 
-            token_dependent = torch.stack(token_dependent_padded, dim=0).to("cuda:0")
-            token_dependent = token_dependent.squeeze(1).to("cuda:0")
-            token_dependent = token_dependent.unsqueeze(0).to("cuda:0")
+            token_dependent = torch.stack(token_dependent_padded, dim=0)
+            token_dependent = token_dependent.squeeze(1)
+            token_dependent = token_dependent.unsqueeze(0)
 
         head_outputs = []
         for _ in range(self.num_heads):
@@ -1075,13 +1066,13 @@ class SelfAttention(nn.Module):
 
         # These compute the queries, keys and values for all
         # heads (as a single concatenated vector)
-        self.tokeys = nn.Linear(k, k * heads, bias=False).cuda()
-        self.toqueries = nn.Linear(k, k * heads, bias=False).cuda()
-        self.tovalues = nn.Linear(k, k * heads, bias=False).cuda()
+        self.tokeys = nn.Linear(k, k * heads, bias=False)
+        self.toqueries = nn.Linear(k, k * heads, bias=False)
+        self.tovalues = nn.Linear(k, k * heads, bias=False)
 
         # This unifies the outputs from the different heads into
         # a single k-vector
-        self.unifyheads = nn.Linear(heads * k, k).cuda()
+        self.unifyheads = nn.Linear(heads * k, k)
 
     def forward(self, x):
         b, t, k = x.size()
@@ -20,6 +20,7 @@ import sys
 sys.path.append("../")
 
 import argparse
+import functools
 import glob
 import logging
 import os
@@ -27,7 +28,7 @@ import random
 
 import numpy as np
 import torch
-from torch.utils.data import DataLoader, RandomSampler, SequentialSampler, TensorDataset
+from torch.utils.data import DataLoader, IterableDataset, RandomSampler, SequentialSampler
 from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm, trange
 
@@ -63,7 +64,7 @@ from transformers import (
     get_linear_schedule_with_warmup,
 )
 
-from data_utils import convert_examples_to_features, processors
+from data_utils import BucketBatchSampler, ConcatFeatureDataset, FeatureDataset, PipelinedFeatureDataset, StreamingFeatureDataset, collate_features, feature_cache_key, feature_cache_lock, is_feature_cache_complete, iter_examples_to_features, processors, prune_feature_caches, read_feature_shards, sentence_packing, window_starts, write_feature_shards
 from sklearn.metrics import f1_score, precision_score, recall_score, classification_report
 from speech import SPEECH
 # from speech_roberta import SPEECH_Roberta
@@ -114,6 +115,49 @@ def calculate_scores(preds, labels, dimE, task_type):
     return p_micro, r_micro, f1_micro
 
 
+def window_output_keys(batch):
+    """ Document-level keys of the rows of the token, sentence and sentence pair outputs of the model for a batch, in the order they are emitted: 
+        (example_id, sentence, n-th labelled token of the sentence), (example_id, sentence) and (example_id, head, tail), the sentences 
+        being numbered in the document rather than in the window. The first and last rows the token outputs add are keyed None. 
+    """
+    example_id, mention_size, pad_token_label_id, labels4token, window_start = [batch[k].cpu().numpy() for k in (0, 1, 2, 6, 9)]
+    num_rows = labels4token.shape[1]
+    token_keys, sent_keys, pair_keys = [], [], []
+    for b in range(len(example_id)):
+        eid, start, size = int(example_id[b]), int(window_start[b]), min(int(mention_size[b]), num_rows)
+        for r in range(size):
+            sent_keys.append((eid, start + r))
+            valid = labels4token[b, r] != pad_token_label_id[0]
+            token_rank = np.cumsum(valid) - 1
+            token_keys.extend((eid, start + r, int(token_rank[c])) if valid[c] else None for c in range(len(valid)))
+        if size == 1:
+            pair_keys.append((eid, start, start))
+        else:
+            pair_keys.extend((eid, start + i, start + j) for i in range(size) for j in range(size) if i != j)
+    # the token head keeps the labelled tokens only, between the first and last rows of the batch
+    valid_keys = [key for key in token_keys if key is not None]
+    if len(valid_keys) > 1:
+        token_keys = [None] + valid_keys + [None]
+    return token_keys, sent_keys, pair_keys
+
+
+def stitch_window_outputs(keys, logits, labels):
+    """ Merges the output rows of all the windows of the documents that share a key (a sentence, a pair, a token of a sentence) 
+        by averaging their logits, and drops the rows keyed None. Returns the logits and labels of the keys, in sorted key order. 
+    """
+    if len(keys) != len(logits):
+        raise ValueError("{} output rows for {} keys, the outputs do not follow the layout of window_output_keys".format(len(logits), len(keys)))
+    rows = [i for i, key in enumerate(keys) if key is not None]
+    unique_keys = sorted(set(keys[i] for i in rows))
+    position = {key: i for i, key in enumerate(unique_keys)}
+    inverse = np.array([position[keys[i]] for i in rows], dtype=np.int64)
+    logits_sum = np.zeros((len(unique_keys),) + logits.shape[1:], dtype=logits.dtype)
+    np.add.at(logits_sum, inverse, logits[rows])
+    stitched_labels = np.zeros([len(unique_keys)], dtype=labels.dtype)
+    stitched_labels[inverse] = labels[rows]
+    return logits_sum / np.bincount(inverse, minlength=len(unique_keys))[:, None], stitched_labels
+
+
 def set_seed(args): # 需要重复出现同样的模拟结果
     random.seed(args.seed)
     np.random.seed(args.seed)
@@ -122,11 +166,79 @@ def set_seed(args): # 需要重复出现同样的模拟结果
         torch.cuda.manual_seed_all(args.seed) # GPU中设置的随机种子
 
 
+def batch_collate(args):
+    """ The collate_fn of the data loaders, which plans the sentence packing of every batch along with it """
+    return functools.partial(collate_features, pack_length=args.max_seq_length if args.pack_sentences else 0)
+
+
+def check_sentence_packing(args, model, num_sent=16, atol=1e-4):
+    """ Encodes random sentences of at most --max_seq_length tokens packed and one per row, and raises if the embeddings of their tokens differ,
+        as they would once the encoder layers that encode_packed reruns with its block-diagonal mask no longer match those of the model
+    """
+    model = model.module if hasattr(model, "module") else model
+    lengths = np.random.RandomState(args.seed).randint(1, args.max_seq_length + 1, size=num_sent)
+    attention_mask = torch.from_numpy(np.arange(args.max_seq_length) < lengths[:, None]).long().to(args.device)
+    input_ids = torch.randint(1, model.config.vocab_size, attention_mask.size(), device=args.device) * attention_mask
+    sentence_pack = tuple(torch.from_numpy(array).to(args.device) for array in sentence_packing(lengths, args.max_seq_length))
+    training = model.training
+    model.eval()
+    with torch.no_grad():
+        packed = model.encode_packed(input_ids, attention_mask, sentence_pack)[0]
+        unpacked = model.encode_windows(input_ids, attention_mask=attention_mask)[0]
+    model.train(training)
+    error = (packed - unpacked)[attention_mask > 0].abs().max().item()
+    if error > atol:
+        raise ValueError("--pack_sentences encodes the tokens {} away from the model itself, the packed encoder no longer matches it".format(error))
+    logger.info("Packed sentence encoding matches the model within %.2e", error)
+
+
+def batch_to_inputs(args, batch):
+    """ Model inputs of a batch of collate_features, whose sentence rows and token columns are cut to the batch itself """
+    num_rows, seq_length = batch[3].size(1), batch[3].size(2)
+    inputs = {
+        "example_id": batch[0],
+        "task_name": args.task_name,
+        "doc_ere_task_type": args.ere_task_type,
+        "max_mention_size": torch.tensor([num_rows], dtype=torch.long),
+        "mention_size": batch[1],
+        "pad_token_label_id": batch[2],
+        "input_ids": batch[3].view(-1, seq_length),
+        "input_dependent": batch[4].view(-1, seq_length),
+        "attention_mask": batch[5].view(-1, seq_length),
+        "labels4token": batch[6],
+        "labels4sent": batch[7],
+        "rel_triples": batch[8],
+    }
+    if len(batch) > 10: # the packing plan of the sentences
+        inputs["sentence_pack"] = batch[10:13]
+    return inputs
+
+
 def train(args, train_dataset, model, tokenizer):
     """ Train the model """
     args.train_batch_size = args.per_gpu_train_batch_size * max(1, args.n_gpu) # 预训练的gpu的batch_size，根据gpu个数决定
-    train_sampler = RandomSampler(train_dataset) if args.local_rank == -1 else DistributedSampler(train_dataset) # RamdomSample：数据随机采样  DistributedSample：分布式采样器
-    train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=args.train_batch_size)
+    if isinstance(train_dataset, IterableDataset): # 流式读取分片, 在数据集内部打乱
+        if args.max_sentences_per_batch > 0 or args.max_tokens_per_batch > 0:
+            raise ValueError("--max_sentences_per_batch and --max_tokens_per_batch cannot be used with --streaming_dataset or --pipelined_preprocessing")
+        # the features of a pipelined dataset are produced in this process, the conversion has its own workers
+        num_workers = 0 if isinstance(train_dataset, PipelinedFeatureDataset) else args.dataloader_workers
+        train_sampler = None
+        train_dataloader = DataLoader(train_dataset, batch_size=args.train_batch_size, collate_fn=batch_collate(args), num_workers=num_workers)
+    elif args.max_sentences_per_batch > 0 or args.max_tokens_per_batch > 0: # 按文档大小分桶, 每个batch的句子数/token数不超过预算
+        train_sampler = BucketBatchSampler(
+            *train_dataset.document_sizes(),
+            max_sentences=args.max_sentences_per_batch,
+            max_tokens=args.max_tokens_per_batch,
+            shuffle=True,
+            bucket_size=args.bucket_size,
+            num_replicas=torch.distributed.get_world_size() if args.local_rank != -1 else 1,
+            rank=torch.distributed.get_rank() if args.local_rank != -1 else 0,
+            seed=args.seed,
+        )
+        train_dataloader = DataLoader(train_dataset, batch_sampler=train_sampler, collate_fn=batch_collate(args), num_workers=args.dataloader_workers)
+    else:
+        train_sampler = RandomSampler(train_dataset) if args.local_rank == -1 else DistributedSampler(train_dataset) # RamdomSample：数据随机采样  DistributedSample：分布式采样器
+        train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=args.train_batch_size, collate_fn=batch_collate(args), num_workers=args.dataloader_workers)
 
     if args.max_steps > 0:
         t_total = args.max_steps
@@ -171,7 +283,10 @@ def train(args, train_dataset, model, tokenizer):
     logger.info("***** Running training *****")
     logger.info("  Num examples = %d", len(train_dataset))
     logger.info("  Num Epochs = %d", args.num_train_epochs)
-    logger.info("  Instantaneous batch size per GPU = %d", args.per_gpu_train_batch_size)
+    if isinstance(train_sampler, BucketBatchSampler):
+        logger.info("  Batch budget per GPU = %d sentences, %d tokens (0 for none)", args.max_sentences_per_batch, args.max_tokens_per_batch)
+    else:
+        logger.info("  Instantaneous batch size per GPU = %d", args.per_gpu_train_batch_size)
     logger.info(
         "  Total train batch size (w. parallel, distributed & accumulation) = %d",
         args.train_batch_size # 1
@@ -188,28 +303,16 @@ def train(args, train_dataset, model, tokenizer):
     model.zero_grad() # 将所有模型参数的梯度置为0
     train_iterator = trange(int(args.num_train_epochs), desc="Epoch", disable=args.local_rank not in [-1, 0]) # 加载进度条
     set_seed(args)  # Added here for reproductibility
-    for _ in train_iterator:
+    for epoch in train_iterator:
+        if hasattr(train_sampler, "set_epoch"):
+            train_sampler.set_epoch(epoch)
+        if hasattr(train_dataset, "set_epoch"):
+            train_dataset.set_epoch(epoch)
         epoch_iterator = tqdm(train_dataloader, desc="Iteration", disable=args.local_rank not in [-1, 0]) # 2622
         for step, batch in enumerate(epoch_iterator):
             model.train()
             batch = tuple(t.to(args.device) for t in batch)
-            inputs = {
-                "example_id": batch[0],
-                "task_name": args.task_name,
-                "doc_ere_task_type": args.ere_task_type,  
-                "max_mention_size": torch.tensor([args.max_mention_size], dtype=torch.long),  
-                "mention_size": batch[1],
-                "pad_token_label_id": batch[2], 
-                "input_ids": batch[3].view(-1, args.max_seq_length),
-                "input_dependent": batch[4].view(-1,args.max_seq_length),
-                "attention_mask": batch[5].view(-1, args.max_seq_length),
-                "token_type_ids": batch[6].view(-1, args.max_seq_length)
-                if args.model_type not in ["xlmroberta"] or (args.model_type.startswith("xlmroberta") is False)
-                else None,  # XLM don't use segment_ids
-                "labels4token": batch[7],
-                "labels4sent": batch[8],
-                "mat_rel_label": batch[9],
-            }
+            inputs = batch_to_inputs(args, batch)
  
             outputs = model(**inputs)
             loss = outputs[0]  # model outputs are always tuple in transformers (see doc)
@@ -315,8 +418,13 @@ def evaluate(args, model, tokenizer, global_step, prefix="", test=False, infer=T
 
         args.eval_batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
         # Note that DistributedSampler samples randomly
-        eval_sampler = SequentialSampler(eval_dataset)
-        eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler, batch_size=args.eval_batch_size)
+        if args.max_sentences_per_batch > 0 or args.max_tokens_per_batch > 0:
+            # documents are evaluated in order of size, the order is saved along with the predictions
+            eval_sampler = BucketBatchSampler(*eval_dataset.document_sizes(), max_sentences=args.max_sentences_per_batch, max_tokens=args.max_tokens_per_batch)
+            eval_dataloader = DataLoader(eval_dataset, batch_sampler=eval_sampler, collate_fn=batch_collate(args), num_workers=args.dataloader_workers)
+        else:
+            eval_sampler = SequentialSampler(eval_dataset)
+            eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler, batch_size=args.eval_batch_size, collate_fn=batch_collate(args), num_workers=args.dataloader_workers)
 
         """Evaluation!"""
         logger.info("***** Running evaluation {} *****".format(prefix))
@@ -338,28 +446,13 @@ def evaluate(args, model, tokenizer, global_step, prefix="", test=False, infer=T
         out_label4doc_causal_ids = None  
         out_label4doc_sub_ids = None  
         out_label4doc_corref_ids = None   
+        token_keys, sent_keys, pair_keys = [], [], []
         for batch in tqdm(eval_dataloader, desc="Evaluating"):
             model.eval()
             batch = tuple(t.to(args.device) for t in batch)
 
             with torch.no_grad():
-                inputs = {
-                    "example_id": batch[0],
-                    "task_name": args.task_name,
-                    "doc_ere_task_type": args.ere_task_type,
-                    "max_mention_size": torch.tensor([args.max_mention_size], dtype=torch.long),
-                    "mention_size": batch[1],
-                    "pad_token_label_id": batch[2],
-                    "input_ids": batch[3].view(-1, args.max_seq_length),
-                    "input_dependent": batch[4].view(-1,args.max_seq_length),
-                    "attention_mask": batch[5].view(-1, args.max_seq_length),
-                    "token_type_ids": batch[6].view(-1, args.max_seq_length)
-                    if args.model_type not in ["xlmroberta"] or (args.model_type.startswith("xlmroberta") is False)
-                    else None,  # XLM don't use segment_ids
-                    "labels4token": batch[7],
-                    "labels4sent": batch[8],
-                    "mat_rel_label": batch[9],
-                }
+                inputs = batch_to_inputs(args, batch)
                 outputs = model(**inputs)
                 if "_ere" not in args.model_type and "_ec" not in args.model_type:
                     if args.ere_task_type != "doc_joint":
@@ -379,6 +472,11 @@ def evaluate(args, model, tokenizer, global_step, prefix="", test=False, infer=T
                             tmp_eval_loss, logits_doc_temp, label_doc_temp, logits_doc_causal, label_doc_causal, logits_doc_sub, label_doc_sub = outputs[:7] 
                 eval_loss += tmp_eval_loss.mean().item()
             nb_eval_steps += 1
+            if args.window_stride > 0:
+                batch_token_keys, batch_sent_keys, batch_pair_keys = window_output_keys(batch)
+                token_keys += batch_token_keys
+                sent_keys += batch_sent_keys
+                pair_keys += batch_pair_keys
 
             if "_ere" not in args.model_type: # or, only for ERE task 
                 if "_ec" not in args.model_type: # or, only for EC task 
@@ -435,6 +533,20 @@ def evaluate(args, model, tokenizer, global_step, prefix="", test=False, infer=T
                         out_label4doc_corref_ids = np.append(out_label4doc_corref_ids, label_doc_corref.detach().cpu().numpy(), axis=0)
 
         eval_loss = eval_loss / nb_eval_steps
+        if args.window_stride > 0:
+            # the outputs of the windows are stitched back into one output per sentence / pair / token of each document
+            if "_ere" not in args.model_type:
+                if "_ec" not in args.model_type:
+                    preds_token, out_label4token_ids = stitch_window_outputs(token_keys, preds_token, out_label4token_ids)
+                preds_sent, out_label4sent_ids = stitch_window_outputs(sent_keys, preds_sent, out_label4sent_ids)
+            if args.ere_task_type != "doc_joint":
+                preds_doc, out_label4doc_ids = stitch_window_outputs(pair_keys, preds_doc, out_label4doc_ids)
+            else:
+                preds_doc_temp, out_label4doc_temp_ids = stitch_window_outputs(pair_keys, preds_doc_temp, out_label4doc_temp_ids)
+                preds_doc_causal, out_label4doc_causal_ids = stitch_window_outputs(pair_keys, preds_doc_causal, out_label4doc_causal_ids)
+                preds_doc_sub, out_label4doc_sub_ids = stitch_window_outputs(pair_keys, preds_doc_sub, out_label4doc_sub_ids)
+                if args.task_name == "maven-ere":
+                    preds_doc_corref, out_label4doc_corref_ids = stitch_window_outputs(pair_keys, preds_doc_corref, out_label4doc_corref_ids)
         if "_ere" not in args.model_type:
             preds_token = np.argmax(preds_token, axis=1)
             preds_sent = np.argmax(preds_sent, axis=1)
@@ -502,6 +614,11 @@ def evaluate(args, model, tokenizer, global_step, prefix="", test=False, infer=T
                     p_micro_corref_joint, r_micro_corref_joint, f1_micro_corref_joint = calculate_scores(preds_doc_corref, out_label4doc_corref_ids, 1+1, "doc_corref") 
                 
         if infer:
+            if args.window_stride > 0: # the stitched predictions follow their (example_id, sentence[, sentence or token]) keys
+                np.save(os.path.join(eval_output_dir, str(prefix) + "_preds-sentence-keys.npy"), np.array(sorted(set(sent_keys))))
+                np.save(os.path.join(eval_output_dir, str(prefix) + "_preds-document-keys.npy"), np.array(sorted(set(pair_keys))))
+            elif isinstance(eval_sampler, BucketBatchSampler):
+                np.save(os.path.join(eval_output_dir, str(prefix) + "_preds-doc-order.npy"), np.array([index for batch in eval_sampler for index in batch]))
             if "_ere" not in args.model_type: # or, only for document-level task
                 np.save(os.path.join(eval_output_dir, str(prefix) + "_preds-token.npy"), preds_token)
                 np.save(os.path.join(eval_output_dir, str(prefix) + "_preds-sentence.npy"), preds_sent)
@@ -567,10 +684,14 @@ def evaluate(args, model, tokenizer, global_step, prefix="", test=False, infer=T
 
 
 def load_and_cache_examples(args, task, tokenizer, evaluate=False, test=False):
-    if args.local_rank not in [-1, 0]:
+    # in pipelined mode the training set is converted by every process while it trains, nobody waits for the cache
+    pipelined = args.pipelined_preprocessing and not evaluate and not test
+    if args.local_rank not in [-1, 0] and not pipelined:
         torch.distributed.barrier()  # Make sure only the first process in distributed training process the dataset, and the others will use the cache
 
-    processor = processors[task]()
+    features_cache_dir = args.features_cache_dir or args.data_dir
+    os.makedirs(features_cache_dir, exist_ok=True)
+    processor = processors[task](index_dir=features_cache_dir)
     # Load data features from cache or dataset file
     if evaluate:
         cached_mode = "valid"
@@ -579,71 +700,127 @@ def load_and_cache_examples(args, task, tokenizer, evaluate=False, test=False):
     else:
         cached_mode = "train"
     assert not (evaluate and test)
-    cached_features_file = os.path.join(
-        args.data_dir,
-        "Cached_{}_{}_{}_{}_{}".format(
-            cached_mode,
-            list(filter(None, args.model_name_or_path.split("/"))).pop(),
-            str(args.max_seq_length), # 128
-            str(args.max_mention_size), # 50
-            str(task),
-        ),
-    )
-    if os.path.exists(cached_features_file) and not args.overwrite_cache:
-        logger.info("Loading features from cached file %s", cached_features_file)
-        features = torch.load(cached_features_file)
-    else:
-        logger.info("Creating features from dataset file at %s", args.data_dir)
-        label4sent_list = processor.get_labels4sent() # 句子的事件类型
-        label4token_list = processor.get_labels4tokens() # 触发词的类型
-        label4rel_list = processor.get_labels4doc() 
+    label4sent_list = processor.get_labels4sent() # 句子的事件类型
+    label4token_list = processor.get_labels4tokens() # 触发词的类型
+    label4rel_list = processor.get_labels4doc() 
+    # sentences up to max_sentence_length tokens are kept whole, the model encodes them in windows of max_seq_length tokens
+    max_length = max(args.max_seq_length, args.max_sentence_length)
+    conversion_params = dict(
+        max_length=max_length,
+        max_size=args.max_mention_size,
+        cls_token_at_end=bool(args.model_type.startswith("xlnet")), # xlnet has a cls token at the end,
+        cls_token=tokenizer.cls_token,
+        cls_token_segment_id=2 if args.model_type.startswith("xlnet") else 0,
+        sep_token=tokenizer.sep_token,
+        sep_token_extra=bool(args.model_type.startswith("roberta")), # roberta uses an extra separator b/w pairs of sentences, cf. github.com/pytorch/fairseq/commit/1684e166e3da03f5b600dbb7855cb98ddfcd0805
+        pad_on_left=bool(args.model_type.startswith("xlnet")), # pad on the left for xlnet
+        pad_token=tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0],
+        pad_token_segment_id=4 if args.model_type.startswith("xlnet") else 0,
+        window_stride=args.window_stride,
+    )
+    # the cache is named after a hash of its inputs (data files, tokenizer, labels, conversion parameters, format version),
+    # so a stale cache is never reused and an unchanged one is never rebuilt
+    label_lists = [label4token_list, label4sent_list, label4rel_list]
+    cache_key = feature_cache_key(
+        processor.get_input_files(args.data_dir, cached_mode),
+        tokenizer,
+        label_lists,
+        conversion_params,
+        memo_file=os.path.join(features_cache_dir, "file_digests.json"),
+    )
+    cache_name = "{}_{}_{}_{}".format(
+        list(filter(None, args.model_name_or_path.split("/"))).pop(),
+        str(max_length), # 128
+        str(args.max_mention_size), # 50
+        str(task),
+    )
+    cached_features_file = os.path.join(features_cache_dir, "Cached_{}_{}_{}".format(cached_mode, cache_name, cache_key))
+    # features of single documents, shared by all splits and kept across changes of the data files,
+    # so that only new or edited documents are converted again
+    doc_features_dir = os.path.join(
+        features_cache_dir, "DocFeatures_{}_{}".format(cache_name, feature_cache_key([], tokenizer, label_lists, conversion_params))
+    )
+    # vocabulary ids of the untruncated sentences, shared by all splits and all max_seq_length / max_mention_size
+    token_ids_dir = os.path.join(
+        features_cache_dir, "TokenIds_{}_{}".format(list(filter(None, args.model_name_or_path.split("/"))).pop(), feature_cache_key([], tokenizer, [], {}))
+    )
+    is_writer = args.local_rank in [-1, 0]
+    if is_writer:
+        # the caches of earlier versions of the data, labels or tokenizer are never read again
+        for cache_dir in (cached_features_file, doc_features_dir, token_ids_dir):
+            prune_feature_caches(cache_dir, remove=args.prune_features_cache)
+
+    def convert_features():
         if evaluate:
             examples = processor.get_valid_examples(args.data_dir)
         elif test:
             examples = processor.get_test_examples(args.data_dir)
         else:
             examples = processor.get_train_examples(args.data_dir)      
-        logger.info("Training number: %s", str(len(examples)))
         
-        features = convert_examples_to_features(
+        return iter_examples_to_features(
             examples,
             label4token_list,
             label4sent_list,
             label4rel_list,
-            args.max_seq_length,
-            args.max_mention_size,
-            tokenizer,
-            cls_token_at_end=bool(args.model_type.startswith("xlnet")), # xlnet has a cls token at the end,
-            cls_token=tokenizer.cls_token,
-            cls_token_segment_id=2 if args.model_type.startswith("xlnet") else 0,
-            sep_token=tokenizer.sep_token,
-            sep_token_extra=bool(args.model_type.startswith("roberta")), # roberta uses an extra separator b/w pairs of sentences, cf. github.com/pytorch/fairseq/commit/1684e166e3da03f5b600dbb7855cb98ddfcd0805
-            pad_on_left=bool(args.model_type.startswith("xlnet")), # pad on the left for xlnet
-            pad_token=tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0],
-            pad_token_segment_id=4 if args.model_type.startswith("xlnet") else 0,
+            tokenizer=tokenizer,
             model_name=args.model_name_or_path,
-            task_name=args.task_name
+            task_name=args.task_name if is_writer else None, # the MAVEN-ERE id maps are written by one process only
+            num_workers=args.preprocess_workers,
+            doc_cache_dir=None if args.overwrite_cache else doc_features_dir,
+            token_ids_dir=None if args.overwrite_cache else token_ids_dir,
+            doc_cache_max_bytes=int(args.doc_cache_max_mb * 2**20),
+            **conversion_params,
         )
-        if args.local_rank in [-1, 0]:
+
+    with feature_cache_lock(cached_features_file):
+        cache_complete = is_feature_cache_complete(cached_features_file) and not args.overwrite_cache
+        if cache_complete:
+            logger.info("Loading features from cached file %s", cached_features_file)
+        elif not pipelined:
+            logger.info("Creating features from dataset file at %s", args.data_dir)
+            # the features are written shard by shard as they are converted
             logger.info("Saving features into cached file [%s]", cached_features_file)
-            torch.save(features, cached_features_file)
+            num_features = write_feature_shards(convert_features(), cached_features_file, max_length, args.max_mention_size, shard_size=args.feature_shard_size)
+            logger.info("Training number: %s", str(num_features))
 
-    if args.local_rank == 0:
+    if args.local_rank == 0 and not pipelined:
         torch.distributed.barrier()  # Make sure only the first process in distributed training process the dataset, and the others will use the cache
 
-    # Convert to Tensors and build dataset
-    all_example_id = torch.tensor([f.example_id for f in features], dtype=torch.long)
-    all_mention_size = torch.tensor([f.mention_size for f in features], dtype=torch.long)
-    all_pad_token_label_id = torch.tensor([f.pad_token_label_id for f in features], dtype=torch.long) 
-    all_list_input_ids = torch.tensor([f.list_input_ids for f in features], dtype=torch.long)
-    all_list_input_dependent = torch.tensor([f.list_input_dependent for f in features], dtype=torch.long)
-    all_list_input_mask = torch.tensor([f.list_input_mask for f in features], dtype=torch.long)
-    all_list_segment_ids = torch.tensor([f.list_segment_ids for f in features], dtype=torch.long)
-    all_list_label4token_ids = torch.tensor([f.list_token_labels for f in features], dtype=torch.long)
-    all_list_label4sent_ids = torch.tensor([f.list_sent_label for f in features], dtype=torch.long)
-    all_mat_rel_label_ids = torch.tensor([f.mat_rel_label for f in features], dtype=torch.long)
-    
-    dataset = TensorDataset(all_example_id, all_mention_size, all_pad_token_label_id, all_list_input_ids, all_list_input_dependent, all_list_input_mask, all_list_segment_ids, all_list_label4token_ids, all_list_label4sent_ids, all_mat_rel_label_ids)
+    if pipelined and not cache_complete:
+        if args.window_stride > 0: # the windows are counted from the mention sizes, the examples are not built
+            num_features = sum(len(window_starts(mention_size, args.max_mention_size, args.window_stride)) for mention_size in processor.get_mention_sizes(args.data_dir, cached_mode))
+        else:
+            num_features = processor.get_num_examples(args.data_dir, cached_mode)
+        logger.info("Creating features from dataset file at %s while training, %d documents", args.data_dir, num_features)
+        if is_writer:
+            logger.info("Saving features into cached file [%s]", cached_features_file)
+        return PipelinedFeatureDataset(
+            convert_features,
+            cached_features_file,
+            num_features,
+            max_length,
+            args.max_mention_size,
+            write_cache=is_writer,
+            shard_size=args.feature_shard_size,
+            shuffle_buffer_size=args.shuffle_buffer_size,
+            num_replicas=torch.distributed.get_world_size() if args.local_rank != -1 else 1,
+            rank=torch.distributed.get_rank() if args.local_rank != -1 else 0,
+            seed=args.seed,
+        )
+
+    # The columns are memory-mapped in their compact dtypes, nothing is read before a batch is collated
+    shards = read_feature_shards(cached_features_file)
+    if args.streaming_dataset and not evaluate and not test:
+        dataset = StreamingFeatureDataset(
+            shards,
+            shuffle_buffer_size=args.shuffle_buffer_size,
+            num_replicas=torch.distributed.get_world_size() if args.local_rank != -1 else 1,
+            rank=torch.distributed.get_rank() if args.local_rank != -1 else 0,
+            seed=args.seed,
+        )
+    else:
+        dataset = ConcatFeatureDataset([FeatureDataset(columns) for columns in shards])
     return dataset
 
 
@@ -722,12 +899,89 @@ def main():
         type=str,
         help="Where do you want to store the pre-trained models downloaded from s3",
     )
+    parser.add_argument(
+        "--features_cache_dir",
+        default="",
+        type=str,
+        help="Where to store the cached features, e.g. a directory shared by parallel runs. Defaults to --data_dir.",
+    )
+    parser.add_argument(
+        "--window_stride",
+        default=0,
+        type=int,
+        help="Split the documents longer than --max_mention_size into overlapping windows of max_mention_size sentences, "
+        "one every window_stride sentences, instead of truncating them. The predictions of the windows are stitched back per document.",
+    )
+    parser.add_argument("--feature_shard_size", default=256, type=int, help="Number of documents per shard of the cached features.")
+    parser.add_argument(
+        "--streaming_dataset",
+        action="store_true",
+        help="Stream the training features shard by shard through a shuffle buffer instead of sampling them at random, so memory does not grow with the corpus.",
+    )
+    parser.add_argument(
+        "--pipelined_preprocessing",
+        action="store_true",
+        help="Start training on the first converted documents when the training features are not cached yet, "
+        "and write the cache alongside. The documents are streamed through a shuffle buffer as with --streaming_dataset. "
+        "In distributed training every process converts the whole split in that first epoch, so each needs its --preprocess_workers; "
+        "only the first one writes the cache.",
+    )
+    parser.add_argument("--shuffle_buffer_size", default=1000, type=int, help="Number of documents in the shuffle buffer of --streaming_dataset and --pipelined_preprocessing.")
+    parser.add_argument("--dataloader_workers", default=0, type=int, help="Number of DataLoader worker processes.")
+    parser.add_argument(
+        "--prune_features_cache",
+        action="store_true",
+        help="Delete the cached features of earlier versions of the data files, labels or tokenizer, and the leftovers of interrupted cache writes, "
+        "instead of only logging them. Not safe while another run on such an earlier version shares --features_cache_dir.",
+    )
     parser.add_argument(
         "--max_seq_length",
         default=128,
         type=int,
         help="The maximum total input sequence length after tokenization. Sequences longer than this will be truncated, sequences shorter will be padded.",
     )
+    parser.add_argument(
+        "--max_sentence_length",
+        default=0,
+        type=int,
+        help="Keep the sentences of up to this many tokens instead of truncating them at --max_seq_length. The encoder still runs on "
+        "max_seq_length tokens: longer sentences are encoded as overlapping windows and their token embeddings are averaged back per position.",
+    )
+    parser.add_argument(
+        "--token_window_stride",
+        default=0,
+        type=int,
+        help="Number of tokens between the starts of two windows of a sentence longer than --max_seq_length. Defaults to half a window.",
+    )
+    parser.add_argument(
+        "--pair_scoring",
+        default="concat",
+        choices=["concat", "factorized"],
+        help="concat: the relation classifiers run on the [h_i, h_j, h_i*h_j] features of every sentence pair. factorized: the same classifiers "
+        "are computed from per-sentence projections and a per-doc bilinear product, without materializing the pair features.",
+    )
+    parser.add_argument(
+        "--pair_memory_mb",
+        default=0,
+        type=float,
+        help="Score the sentence pairs in tiles whose pair features take at most this many MB, recomputed in the backward pass, "
+        "so that documents with hundreds of mentions fit in memory. With --pair_scoring factorized, only the h_i*h_j products are tiled. "
+        "0 scores all the pairs of a batch at once.",
+    )
+    parser.add_argument(
+        "--na_pair_ratio",
+        default=0,
+        type=float,
+        help="In training, score all the sentence pairs with a relation but only this fraction of the NA pairs, sampled anew at every step "
+        "and weighted up in the relation losses to stand for all of them. Evaluation always scores all the pairs. 0 keeps all the NA pairs.",
+    )
+    parser.add_argument("--max_na_pairs", default=0, type=int, help="In training, score at most this many NA sentence pairs per batch, sampled as with --na_pair_ratio.")
+    parser.add_argument(
+        "--pack_sentences",
+        action="store_true",
+        help="Pack the short sentences one after the other into shared encoder rows of --max_seq_length tokens, "
+        "each attending to itself only, instead of encoding every sentence in a padded row of its own.",
+    )
     parser.add_argument(
         "--max_mention_size",
         default=50,
@@ -748,6 +1002,19 @@ def main():
     parser.add_argument(
         "--per_gpu_eval_batch_size", default=2, type=int, help="Batch size per GPU/CPU for evaluation."
     )
+    parser.add_argument(
+        "--max_sentences_per_batch",
+        default=0,
+        type=int,
+        help="If > 0: batch documents of similar size so that batch size * largest mention size stays under this budget, instead of a fixed number of documents per batch.",
+    )
+    parser.add_argument(
+        "--max_tokens_per_batch",
+        default=0,
+        type=int,
+        help="If > 0: same as --max_sentences_per_batch, for the padded tokens of the batch (sentences times longest sentence).",
+    )
+    parser.add_argument("--bucket_size", default=100, type=int, help="Number of documents of similar size shuffled together when batching by budget.")
     parser.add_argument(
         "--gradient_accumulation_steps",
         type=int,
@@ -783,6 +1050,18 @@ def main():
     parser.add_argument(
         "--overwrite_cache", action="store_true", help="Overwrite the cached training and evaluation sets"
     )
+    parser.add_argument(
+        "--preprocess_workers",
+        type=int,
+        default=1,
+        help="Number of worker processes converting examples to features when the cache is (re)built. The features do not depend on it.",
+    )
+    parser.add_argument(
+        "--doc_cache_max_mb",
+        default=1024,
+        type=float,
+        help="Size of the per-document feature cache, and of the token ids cache, the entries used least recently are evicted past it. 0 for no limit.",
+    )
     parser.add_argument("--seed", type=int, default=42, help="random seed for initialization")
 
     parser.add_argument(
@@ -814,6 +1093,11 @@ def main():
             )
         )
 
+    if args.max_sentence_length > args.max_seq_length and args.model_type.lower().startswith("xlnet"):
+        raise ValueError("--max_sentence_length needs the [CLS] token first and the padding on the right, which xlnet does not use")
+    if args.pack_sentences and args.model_type.lower().startswith("xlnet"):
+        raise ValueError("--pack_sentences needs the padding on the right, which xlnet does not use")
+
     # Setup distant debugging if needed
     if args.server_ip and args.server_port:
         # Distant debugging - see https://code.visualstudio.com/docs/python/debugging#_attach-to-a-local-script
@@ -833,6 +1117,8 @@ def main():
         torch.distributed.init_process_group(backend="nccl")
         args.n_gpu = 1
     args.device = device
+    if args.pack_sentences and args.n_gpu > 1:
+        raise ValueError("--pack_sentences plans the packing of a whole batch, which DataParallel would split, use one GPU per process instead")
 
     # Setup logging
     logging.basicConfig(
@@ -848,6 +1134,8 @@ def main():
         bool(args.local_rank != -1),
         args.fp16,
     )
+    if args.pair_scoring == "factorized" and args.pair_memory_mb > 0:
+        logger.warning("--pair_memory_mb with --pair_scoring factorized computes the h_i*h_j products of the pairs tile by tile instead of one bilinear product per document")
 
     # Set seed
     set_seed(args)
@@ -876,6 +1164,14 @@ def main():
         finetuning_task=args.task_name,
         cache_dir=args.cache_dir if args.cache_dir else None,
     ) # 加载预训练模型
+    # the model encodes the sentences longer than max_seq_length in windows of max_seq_length tokens
+    config.encoder_max_length = args.max_seq_length if args.max_sentence_length > args.max_seq_length else 0
+    config.token_window_stride = args.token_window_stride
+    config.pack_length = args.max_seq_length if args.pack_sentences else 0
+    config.pair_scoring = args.pair_scoring
+    config.pair_memory_mb = args.pair_memory_mb
+    config.na_pair_ratio = args.na_pair_ratio
+    config.max_na_pairs = args.max_na_pairs
     tokenizer = tokenizer_class.from_pretrained(
         args.tokenizer_name if args.tokenizer_name else args.model_name_or_path,
         do_lower_case=args.do_lower_case,
@@ -892,6 +1188,8 @@ def main():
         torch.distributed.barrier()  # Make sure only the first process in distributed training will download model & vocab
 
     model.to(args.device)
+    if args.pack_sentences:
+        check_sentence_packing(args, model)
 
     logger.info("Training/evaluation parameters %s", args)
     best_steps = 0
@@ -0,0 +1,117 @@
+"""Round trip of a tiny in-memory example set through the feature cache: conversion, shards on disk, reading back and
+collation, against the [max_size, max_length] tensors of the original one-sentence-at-a-time padding."""
+import numpy as np
+import pytest
+from transformers import DistilBertTokenizer
+
+import data_utils
+from data_utils import NAME_NO_RELATION, NAME_NON_TRIGGER, NAME_PADDING
+
+MAX_LENGTH = 8
+MAX_SIZE = 4
+WORDS = ["the", "army", "attacked", "city", "police", "arrested", "him", "after", "a", "long", "siege", "and", "then", "left"]
+LABELS4SENT = ["None", "Attack", "Arrest"]
+LABELS4TOKEN = LABELS4SENT + [NAME_NON_TRIGGER, NAME_PADDING]
+LABELS4REL = [NAME_NO_RELATION, "BEFORE", "CAUSE"]
+
+
+def make_docs(num_docs=9, seed=0):
+    """Documents of 1 to 5 sentences of 1 to 9 words, so some are truncated in both directions."""
+    rng = np.random.RandomState(seed)
+    docs = []
+    for d in range(num_docs):
+        sentences = []
+        for _ in range(rng.randint(1, 6)):
+            tokens = [WORDS[k] for k in rng.randint(len(WORDS), size=rng.randint(1, 10))]
+            dependent = rng.randint(0, 2, size=len(tokens)).tolist()
+            trigger_l = rng.randint(len(tokens))
+            trigger_r = rng.randint(trigger_l + 1, len(tokens) + 1)
+            sentences.append((tokens, dependent, trigger_l, trigger_r, LABELS4SENT[rng.randint(len(LABELS4SENT))]))
+        relations = [(h, t, LABELS4REL[rng.randint(len(LABELS4REL))]) for h in range(len(sentences)) for t in range(len(sentences)) if h != t and rng.rand() < 0.4]
+        docs.append({"id": "doc-%d" % d, "sentences": sentences, "relations": relations})
+    return docs
+
+
+def make_example(doc):
+    sentences = doc["sentences"]
+    token_labels = [
+        np.array([LABELS4TOKEN.index(NAME_NON_TRIGGER if not l <= j < r else event_type) for j in range(len(tokens))], dtype=np.int16)
+        for tokens, _, l, r, event_type in sentences
+    ]
+    return data_utils.InputExample(
+        example_id=doc["id"],
+        mention_size=len(sentences),
+        list_tokens=[s[0] for s in sentences],
+        list_tokens_dependent=[s[1] for s in sentences],
+        list_triggerL=[s[2] for s in sentences],
+        list_triggerR=[s[3] for s in sentences],
+        token_label_ids=data_utils.concat_label_ids(token_labels),
+        sent_label_ids=np.array([LABELS4SENT.index(s[4]) for s in sentences], dtype=np.int16),
+        rel_triples=data_utils.pair2rel_to_triples({(h, t): rel for h, t, rel in doc["relations"]}, {label: i for i, label in enumerate(LABELS4REL)}),
+    )
+
+
+def baseline_padded(doc, tokenizer):
+    """The fields of a document as the original conversion padded them, sentence by sentence."""
+    label4token = {label: i for i, label in enumerate(LABELS4TOKEN)}
+    input_ids = np.zeros([MAX_SIZE, MAX_LENGTH], dtype=np.int64)
+    input_dependent = np.zeros([MAX_SIZE, MAX_LENGTH], dtype=np.int64)
+    attention_mask = np.zeros([MAX_SIZE, MAX_LENGTH], dtype=np.int64)
+    token_labels = np.full([MAX_SIZE, MAX_LENGTH], label4token[NAME_PADDING], dtype=np.int64)
+    sent_label = np.full([MAX_SIZE], len(LABELS4SENT), dtype=np.int64)
+    num_rows = min(len(doc["sentences"]), MAX_SIZE)
+    for i, (tokens, dependent, l, r, event_type) in enumerate(doc["sentences"][:num_rows]):
+        tokens = tokens[:MAX_LENGTH - 2]
+        ids = tokenizer.convert_tokens_to_ids([tokenizer.cls_token] + tokens + [tokenizer.sep_token])
+        input_ids[i, :len(ids)] = ids
+        attention_mask[i, :len(ids)] = 1
+        input_dependent[i, 1:1 + len(tokens)] = dependent[:len(tokens)]
+        token_labels[i, 1:1 + len(tokens)] = [label4token[event_type if l <= j < r else NAME_NON_TRIGGER] for j in range(len(tokens))]
+        sent_label[i] = LABELS4SENT.index(event_type)
+    rel_triples = [[h, t, LABELS4REL.index(rel)] for h, t, rel in doc["relations"] if h < num_rows and t < num_rows and rel != NAME_NO_RELATION]
+    return input_ids, input_dependent, attention_mask, token_labels, sent_label, np.array(rel_triples, dtype=np.int64).reshape(-1, 3)
+
+
+@pytest.fixture(scope="module")
+def tokenizer(tmp_path_factory):
+    vocab_file = tmp_path_factory.mktemp("vocab") / "vocab.txt"
+    vocab_file.write_text("\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"] + WORDS) + "\n")
+    return DistilBertTokenizer(str(vocab_file), do_lower_case=True)
+
+
+def repad(tensor, fill):
+    """A collated [B, rows(, columns)] field padded back to [B, MAX_SIZE(, MAX_LENGTH)]."""
+    array = tensor.numpy()
+    padded = np.full(array.shape[:1] + (MAX_SIZE, MAX_LENGTH)[:array.ndim - 1], fill, dtype=np.int64)
+    padded[tuple(slice(0, n) for n in array.shape)] = array
+    return padded
+
+
+@pytest.mark.parametrize("num_workers", [1, 3])
+@pytest.mark.parametrize("doc_cache", [False, True])
+def test_round_trip(tmp_path, tokenizer, num_workers, doc_cache):
+    docs = make_docs()
+    cache_kwargs = dict(doc_cache_dir=str(tmp_path / "docs"), token_ids_dir=str(tmp_path / "token_ids")) if doc_cache else {}
+    for _ in range(2 if doc_cache else 1): # with the document cache, the second pass reads every document from it
+        features = data_utils.convert_examples_to_features(
+            [make_example(doc) for doc in docs], LABELS4TOKEN, LABELS4SENT, LABELS4REL, MAX_LENGTH, MAX_SIZE, tokenizer,
+            num_workers=num_workers, docs_per_shard=2, **cache_kwargs
+        )
+    cache_dir = str(tmp_path / "features")
+    assert data_utils.write_feature_shards(features, cache_dir, MAX_LENGTH, MAX_SIZE, shard_size=4) == len(docs)
+    assert data_utils.is_feature_cache_complete(cache_dir)
+    dataset = data_utils.ConcatFeatureDataset([data_utils.FeatureDataset(columns) for columns in data_utils.read_feature_shards(cache_dir)])
+    assert len(dataset) == len(docs)
+
+    pad_label = LABELS4TOKEN.index(NAME_PADDING)
+    for start in range(0, len(docs), 2):
+        batch = data_utils.collate_features([dataset[i] for i in range(start, min(start + 2, len(docs)))])
+        example_id, mention_size, pad_token_label_id, input_ids, input_dependent, attention_mask, token_labels, sent_label, rel_triples = batch[:9]
+        expected = [baseline_padded(doc, tokenizer) for doc in docs[start:start + 2]]
+        assert example_id.tolist() == list(range(start + 1, start + 1 + len(expected)))
+        assert mention_size.tolist() == [len(doc["sentences"]) for doc in docs[start:start + 2]]
+        assert (pad_token_label_id == pad_label).all()
+        for tensor, fill, k in [(input_ids, 0, 0), (input_dependent, 0, 1), (attention_mask, 0, 2), (token_labels, pad_label, 3), (sent_label, len(LABELS4SENT), 4)]:
+            np.testing.assert_array_equal(repad(tensor, fill), np.stack([e[k] for e in expected]))
+        expected_triples = [np.concatenate([np.full([len(e[5]), 1], b), e[5]], axis=1) for b, e in enumerate(expected)]
+        np.testing.assert_array_equal(rel_triples.numpy(), np.concatenate(expected_triples).reshape(-1, 4))
@@ -0,0 +1,52 @@
+"""SentencePairs.linear, concatenated or factorized and whole or tiled, against F.linear over the concatenated pair features."""
+import pytest
+import torch
+import torch.nn.functional as F
+
+from distilbert import SentencePairs
+
+HIDDEN_SIZE = 16
+NUM_OUTPUTS = 5
+
+
+def random_pairs(mention_sizes=(5, 3, 1), seed=0):
+    """A random [batch_size, max_size, hidden_size] sent_embed and the (doc, head, tail) of all its ordered sentence pairs,
+    a document of a single sentence being paired with itself."""
+    generator = torch.Generator().manual_seed(seed)
+    sent_embed = torch.randn(len(mention_sizes), max(mention_sizes), HIDDEN_SIZE, generator=generator, dtype=torch.float64)
+    pairs = [(d, i, j) for d, n in enumerate(mention_sizes) for i in range(n) for j in range(n) if i != j or n == 1]
+    doc, head, tail = torch.tensor(pairs).t()
+    return sent_embed, doc, head, tail
+
+
+def reference_scores(sent_embed, doc, head, tail, dim_expand, weight, bias):
+    t1, t2 = sent_embed[doc, head], sent_embed[doc, tail]
+    return F.linear(torch.cat([t1, t2, t1 * t2, t1 - t2][:dim_expand], dim=-1), weight, bias)
+
+
+@pytest.mark.parametrize("dim_expand", [2, 3, 4])
+@pytest.mark.parametrize("factorized", [False, True])
+@pytest.mark.parametrize("tile_size", [0, 1, 4, 7, 1000])
+def test_linear(dim_expand, factorized, tile_size):
+    sent_embed, doc, head, tail = random_pairs()
+    generator = torch.Generator().manual_seed(1)
+    weight = torch.randn(NUM_OUTPUTS, dim_expand * HIDDEN_SIZE, generator=generator, dtype=torch.float64)
+    bias = torch.randn(NUM_OUTPUTS, generator=generator, dtype=torch.float64)
+    grad_output = torch.randn(len(doc), NUM_OUTPUTS, generator=generator, dtype=torch.float64)
+
+    results = []
+    for score in (
+        lambda e, w, b: reference_scores(e, doc, head, tail, dim_expand, w, b),
+        lambda e, w, b: SentencePairs(e, doc, head, tail, dim_expand, factorized=factorized, tile_size=tile_size).linear(w, b),
+    ):
+        params = [p.clone().requires_grad_() for p in (sent_embed, weight, bias)]
+        scores = score(*params)
+        scores.backward(grad_output)
+        results.append([scores.detach()] + [p.grad for p in params])
+
+    for expected, actual in zip(*results):
+        torch.testing.assert_close(actual, expected)
+
+    with torch.no_grad():
+        scores = SentencePairs(sent_embed, doc, head, tail, dim_expand, factorized=factorized, tile_size=tile_size).linear(weight, bias)
+    torch.testing.assert_close(scores, results[0][0])